@@ -17,13 +17,16 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 
-import os, sys, time, struct, socket, logging, logging.config, subprocess, json
+import os, sys, time, socket, logging, logging.config, subprocess, json
+from collections import deque
 
 from modules.inhouse.mhiabuttons import MhiaButtons 
 from modules.inhouse.mhialcd import MhiaDisplay
 #from modules.inhouse.mhiaqr import MhiaQR
 from modules.inhouse.signalhandler import SignalHandler
 from modules.inhouse.mhiacfg import MhiaConfig
+from modules.inhouse.mhiaframing import SampleDecoder, SequenceTracker, COMPACT, SOCKET, SHARED_MEMORY, hello, subscribe
+from modules.inhouse.mhiashm import SampleRingReader
 
 CONFIG_PATH = "./config.yaml" if os.path.isfile("./config.yaml") else "./config_default.yaml"
 CONFIG = MhiaConfig(CONFIG_PATH).get_config()
@@ -39,6 +42,8 @@ def main():
     Main Function of displayer: UI of the device
     """     
     common_logger.info(f"Config loaded from {CONFIG_PATH}.")
+    # the display has room for the 8 channels of the mhia pi board, channels of further ADC pairs (9 and up) are only published
+    CONFIG['active_channels'] = [i for i in CONFIG['active_channels'] if i <= 8]
     
     #Preperations for QR and info screen, includes getting some info from host
     ip_json_output = json.loads(subprocess.run(["ip", "-4", "-j", "address"], capture_output=True, text=True).stdout)
@@ -97,6 +102,7 @@ def main():
                 sys.exit(1)
         else:                           # if connected (no exception) send "disp" and break this while-loop
             sock.send("disp".encode(encoding = 'UTF-8'))
+            sock.send(hello(encoding=COMPACT, transport=CONFIG.get('sample_transport', SOCKET), sequence=True))  # raw counts and integer times, converted to volts here
             break
     
     common_logger.info("Connected to sampler...")
@@ -113,13 +119,59 @@ def main():
 
     (channel, timestamp, value) = (1, time.time(), 0)
     sleeptime = 0.01
+    # the sampler sends frames of several samples, they are taken one by one from "received" in the main loop
+    # the sequence numbers of the samples are counted for the log, as long as the sampler doesn't leave out samples for keeping to max_rate
+    tracker = SequenceTracker()
+    tracker_logged = time.monotonic()
+    decoder = SampleDecoder(tracker)
+    received = deque()
+    # with sample_transport shared_memory the samples are taken from the ring of the sampler, the next ones only when all received are shown,
+    # so a display lagging behind loses samples in the ring instead of holding up the sampler, the socket brings just NOTIFY frames then
+    ring = SampleRingReader() if CONFIG.get('sample_transport', SOCKET) == SHARED_MEMORY else None
+
+    # the sampler sends only the channels the current display mode shows, the values at most display.max_rate times per second (the graph gets
+    # every sample), a new subscription is sent whenever the mode changes. With the ring the channels are picked here.
+    max_rate = CONFIG['display'].get('max_rate')
+    def subscription(mode):
+        if mode == 9: return active_channels, max_rate
+        if 10 < mode < 19: return [mode - 10], max_rate
+        if 20 < mode < 29: return [mode - 20], None
+        return [], None     # QR code and info pages show no values
+    subscribed_mode = None
+    subscribed_channels = active_channels
    
     # here the main loop starts and runs till process is interrupted by signal, this while-block can still be optimized imo!    
     while not (signalhandler.interrupt or signalhandler.terminate):    
         display_mode = lcd.getmode()
-        # try to receive and unpack struct
+        if display_mode != subscribed_mode:
+            subscribed_channels, rate = subscription(display_mode)
+            try:
+                if ring is None: sock.send(subscribe(subscribed_channels, rate))
+            except BlockingIOError:
+                pass    # tried again in the next cycle
+            else:
+                subscribed_mode = display_mode
+                received.clear()    # samples of the channels shown before
+                tracker.restart()   # the samples not subscribed to meanwhile are no gaps
+                decoder.tracker = tracker if ring is not None or rate is None else None
+        if time.monotonic() - tracker_logged >= 60:
+            common_logger.info(f"Sequence counters of received samples: {tracker.stats()}" + (f", {ring.lost} samples lost in the ring" if ring is not None else ""))
+            tracker_logged = time.monotonic()
+        # try to receive a frame, if no sample is left from the last one
         try:
-            channel, timestamp, value = struct.unpack('!idd', sock.recv(20)) # remember socket is set to non-blocking, meaning we will have here very often 'BlockingIOError'
+            if ring is not None:
+                if not received:
+                    for seq, channel, monotonic_ns, timestamp, raw, value, channel_seq in ring.read().tolist():
+                        if channel not in subscribed_channels: continue
+                        received.append((channel, timestamp, value))
+                        tracker.add(channel, channel_seq)
+                try:
+                    while sock.recv(65536): pass    # NOTIFY frames, not needed when polling the ring
+                except BlockingIOError:
+                    pass
+            elif not received:
+                received.extend(decoder.feed(sock.recv(65536))) # remember socket is set to non-blocking, meaning we will have here very often 'BlockingIOError'
+            channel, timestamp, value = received.popleft()   # IndexError if just a part of a frame arrived
         except Exception as e: # (remember the "try" doesn't block because socket non-blocking) when exception arises the else block will be skipped and finally block executed
             display_is_laggy = False # when exception then the sampler didn't have a new value yet...
             new_sample_ready =  False
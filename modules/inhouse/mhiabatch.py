@@ -0,0 +1,130 @@
+# mhiabatch.py - a module of the mhia pi application, batching samples into MQTT payloads
+# Copyright (C) 2023  Iman Ayatollahi, Talwiese IoT Solutions e.U.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import struct, zlib
+import numpy as np
+
+# the payload of a batch and its decoding are described in mhiapayload.py, which subscribers can use without the rest of the application
+from modules.inhouse.mhiapayload import BATCH_MAGIC, BATCH_HEADER, BATCH_COMPACT, BATCH_SEQUENCE, BATCH_CHANNEL_PREFIX, BATCH_COLUMNAR, BATCH_DEFLATE, MAX_RECORDS
+
+# batching modes in config
+PER_CHANNEL = "channel"
+ALL_CHANNELS = "all"
+
+# encodings of the batches in config
+PACKED = "packed"       # one packed sample after the other, as they would be published on their own
+COLUMNAR = "columnar"   # delta encoded columns, for uplinks where every byte counts
+
+def _zigzag(numbers):
+    numbers = numbers.astype(np.int64)
+    return ((numbers << 1) ^ (numbers >> 63)).view(np.uint64)
+
+def _varints(numbers):
+    # all numbers at once: a row of their ten 7 bit groups each, of which the leading zero groups are dropped
+    numbers = numbers.astype(np.uint64)
+    shifts = np.arange(10, dtype=np.uint64) * np.uint64(7)
+    groups = (numbers[:, None] >> shifts) & np.uint64(0x7F)
+    lengths = 1 + np.count_nonzero(numbers[:, None] >> shifts[1:], axis=1)
+    k = np.arange(10)
+    groups |= np.where(k < (lengths - 1)[:, None], np.uint64(0x80), np.uint64(0))
+    return groups.astype(np.uint8)[k < lengths[:, None]].tobytes()
+
+def encode_columnar(channels, timestamps_ns, values, seqs=None, compact=True):
+    """
+    Returns the columnar body (see mhiapayload.py) of samples given as numpy arrays: channels, timestamps in ns (int64), raw counts if compact else volts,
+    and the sequence numbers or None
+    """
+    order = np.argsort(channels, kind='stable')     # groups the channels, the samples of a channel keep their order
+    channels, timestamps_ns, values = channels[order], timestamps_ns[order], values[order]
+    if seqs is not None: seqs = seqs[order].astype(np.int64)
+    firsts = np.flatnonzero(np.r_[True, channels[1:] != channels[:-1]])
+    lasts = np.r_[firsts[1:], len(channels)]
+    body = [_varints(np.array([len(firsts)]))]
+    for first, last in zip(firsts.tolist(), lasts.tolist()):
+        body.append(_varints(np.array([channels[first], last - first])))
+        times = timestamps_ns[first:last].astype(np.int64)
+        deltas = np.diff(times)
+        body.append(_varints(_zigzag(np.r_[times[:1], np.diff(deltas, prepend=0)])))
+        if compact:
+            raws = values[first:last].astype(np.int64)
+            body.append(_varints(_zigzag(np.r_[raws[:1], np.diff(raws)])))
+        else:
+            bits = values[first:last].astype(np.float64).view(np.uint64)
+            body.append(_varints(bits ^ np.r_[np.uint64(0), bits[:-1]]))
+        if seqs is not None:
+            body.append(_varints(np.r_[seqs[first:first + 1], np.diff(seqs[first:last]) % (1 << 32)]))
+    return b"".join(body)
+
+class PayloadBatcher:
+    def __init__(self, mode, compact, sequence, window, max_bytes, encoding=PACKED, deflate=False):
+        """
+        Collects samples into batches, one per channel with mode PER_CHANNEL or one for all channels with ALL_CHANNELS. A batch is due when its first sample
+        is window seconds old or when the next sample would make it longer than max_bytes, counted packed and uncompressed (header included).
+        encoding is PACKED or COLUMNAR, with deflate the body is compressed too.
+        """
+        self.per_channel = mode == PER_CHANNEL
+        self.compact, self.sequence, self.columnar, self.deflate = compact, sequence, encoding == COLUMNAR, deflate
+        self.flags = (BATCH_COMPACT if compact else 0) | (BATCH_SEQUENCE if sequence else 0) | (BATCH_COLUMNAR if self.columnar else 0) | (BATCH_DEFLATE if deflate else 0)
+        if compact and not self.per_channel and not self.columnar: self.flags |= BATCH_CHANNEL_PREFIX
+        # packed as in mhiapayload.unpack_batch(), also the size a sample counts for max_bytes
+        self.record = struct.Struct('!' + ('B' if self.flags & BATCH_CHANNEL_PREFIX else '') + ('qi' if compact else 'idd') + ('I' if sequence else ''))
+        self.window = window
+        self.max_bytes = max_bytes
+        self.batches = {}   # key (channel or 0) -> [time of the first sample, list of samples, bytes so far]
+
+    def add(self, channel, timestamp, value, seq, now):
+        """
+        Adds a sample of channel received at now (time.monotonic()): timestamp in ns and raw count if compact, else timestamp in s and volts.
+        Returns the list of (key, payload) of batches that are due because of it, key is the channel or 0 for the batch of all channels.
+        """
+        key = channel if self.per_channel else 0
+        due = []
+        batch = self.batches.get(key)
+        if batch is not None and (batch[2] + self.record.size > self.max_bytes or len(batch[1]) == MAX_RECORDS):
+            due.append((key, self._payload(key)))
+            batch = None
+        if batch is None:
+            batch = self.batches[key] = [now, [], BATCH_HEADER.size]
+        batch[1].append((channel, timestamp, value, seq))
+        batch[2] += self.record.size
+        return due
+
+    def due(self, now):
+        """
+        Returns the list of (key, payload) of the batches whose window has passed, flush() for all of them regardless
+        """
+        return [(key, self._payload(key)) for key in [key for key, batch in self.batches.items() if now - batch[0] >= self.window]]
+
+    def flush(self):
+        return [(key, self._payload(key)) for key in list(self.batches)]
+
+    def _payload(self, key):
+        samples = self.batches.pop(key)[1]
+        if self.columnar:
+            channels, timestamps, values, seqs = (np.array(column) for column in zip(*samples))
+            timestamps = timestamps.astype(np.int64) if self.compact else np.round(timestamps * 1e9).astype(np.int64)
+            body = encode_columnar(channels, timestamps, values, seqs if self.sequence else None, self.compact)
+        else:
+            fields = []
+            for channel, timestamp, value, seq in samples:
+                record = (timestamp, value) if self.compact else (channel, timestamp, value)
+                if self.flags & BATCH_CHANNEL_PREFIX: record = (channel,) + record
+                fields.append(self.record.pack(*record, seq) if self.sequence else self.record.pack(*record))
+            body = b"".join(fields)
+        if self.deflate:
+            compressor = zlib.compressobj(9, zlib.DEFLATED, -15)   # raw deflate, without the zlib header and checksum
+            body = compressor.compress(body) + compressor.flush()
+        return BATCH_HEADER.pack(BATCH_MAGIC, self.flags, key, len(samples)) + body
@@ -0,0 +1,173 @@
+# mhiabus.py - a module of the mhia pi application, sampling the ADC pairs on one I²C bus
+# Copyright (C) 2023  Iman Ayatollahi, Talwiese IoT Solutions e.U.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time, logging, threading
+import numpy as np
+
+from modules.thirdparty.abelectronics.ADCPi import SWEEP_DTYPE
+from modules.inhouse.mhiasched import ChannelScheduler, TimingHistogram
+from modules.inhouse.mhiadecim import NoiseFloor, decimate, lsb_volts
+from modules.inhouse.mhiaframing import SEQ_MODULO
+
+common_logger = logging.getLogger("standard")
+error_logger = logging.getLogger("error")
+
+# every ADC pair has 8 channels, the first pair in config has channels 1 to 8, the second 9 to 16 and so on
+# put into the output queue after every sweep, the sampler may send the samples collected so far then
+SWEEP_END = "sweep end"
+
+def pair_of(channel):
+    return (channel - 1) // 8
+
+def local_channel(channel):
+    return (channel - 1) % 8 + 1
+
+class BusSampler(threading.Thread):
+    def __init__(self, bus, adcs, output, pga, rate, oversampling, interval_ns, conversion_ns, continuous=False, pipelined=True):
+        """
+        Samples all ADC pairs on one I²C bus in a thread of its own, so pairs on separate buses convert in parallel.
+        adcs is a dict with the index of the pair (its position in config) as key and its ADCPi object as value.
+        pga, rate, oversampling, interval_ns and conversion_ns are dicts with the (global) channel number as key, covering the active channels of these pairs.
+        Every sample is put into the queue output as a tuple (channel, monotonic_ns, timestamp, raw, value, seq), SWEEP_END after each sweep and None if sampling failed.
+        raw is the count of the ADC, value = raw * scale[channel] in volts. For oversampled channels raw counts in steps of 1/oversampling of an LSB.
+        seq numbers the samples of each channel from 0 on (modulo 2^32), the processes getting the samples tell lost ones by gaps in it.
+        """
+        super().__init__(name=f"bus{bus}", daemon=True)
+        self.bus = bus
+        self.adcs = adcs
+        self.output = output
+        self.channels = sorted(interval_ns)
+        self.pga, self.rate, self.oversampling = pga, rate, oversampling
+        self.interval_ns, self.conversion_ns = interval_ns, conversion_ns
+        self.continuous, self.pipelined = continuous, pipelined
+        self.stop = threading.Event()
+        self.failed = False
+        # ADCPi takes pga and rate as lists indexed by its own channel number 1 to 8, index 0 isn't used
+        self.local_pga, self.local_rate = {}, {}
+        for pair in adcs:
+            self.local_pga[pair], self.local_rate[pair] = [None] * 9, [None] * 9
+            for i in self.channels:
+                if pair_of(i) == pair:
+                    self.local_pga[pair][local_channel(i)] = pga[i]
+                    self.local_rate[pair][local_channel(i)] = rate[i]
+        self.noise = {i: NoiseFloor(oversampling[i], rate[i], pga[i]) for i in self.channels if oversampling[i] > 1}
+        self.scale = {i: lsb_volts(rate[i], pga[i]) / oversampling[i] for i in self.channels}
+
+    def run(self):
+        try:
+            self.sample()
+        except Exception as e:
+            error_logger.exception(f"bus {self.bus}: sampling failed: {e}")
+            self.failed = True
+            self.output.put(None)   # wakes up the sampler, which exits then
+
+    def sample(self):
+        # the scheduler gives each channel its own grid of deadlines and pairs up conversions of the chips wherever possible
+        scheduler = ChannelScheduler(self.interval_ns, lookahead_ns=min(self.conversion_ns.values()))
+        for chip, busy in scheduler.utilization(self.conversion_ns).items():
+            name = f"bus {self.bus} pair {chip // 2} chip{chip % 2 + 1}"
+            if busy > 1:
+                common_logger.warning(f"Requested sampling intervals are infeasible: {name} would have to convert {busy*100:.0f}% of the time, some samples will be skipped!")
+            else:
+                common_logger.info(f"{name} is busy converting {busy*100:.0f}% of the time.")
+        for i in self.channels:
+            if self.interval_ns[i] < self.conversion_ns[i]:
+                common_logger.warning(f"Sampling interval of channel {i} is shorter than {self.oversampling[i]} {self.rate[i]} bit conversion(s) ({self.conversion_ns[i]/1e6:.2f} ms)!")
+
+        period_of_time_for_eval = 60 # seconds, used for info level logging of the timing statistics
+        jitter = {i: TimingHistogram() for i in self.channels}
+        overrun = {i: TimingHistogram() for i in self.channels}
+        last_sample_ns = dict.fromkeys(self.channels, None)
+        samples_since_eval = dict.fromkeys(self.channels, 0)  # for reporting the achieved samples per second of each channel
+        last_eval_ns = time.monotonic_ns()
+        missed_slots_reported = dict.fromkeys(self.channels, 0)
+        seq = dict.fromkeys(self.channels, 0)
+
+        while not self.stop.is_set():
+            if self.continuous:
+                now_ns = time.monotonic_ns() # the free running chips set the pace, read_sweep waits for their next results
+                deadlines = {i: now_ns for i in self.channels}
+            else:
+                picked = scheduler.wait(all_due=self.pipelined)
+                if picked is None: continue  # sleep interrupted by a signal
+                deadlines = dict(picked)
+                for i, skipped in scheduler.last_skipped.items():
+                    common_logger.debug(f"Sampling overran, skipped {skipped} slot(s) of channel {i}.")  # summed up in the periodic warning below
+            for i, monotonic_ns, timestamp, raw, value in self.convert(deadlines):
+                samples_since_eval[i] += 1
+                if last_sample_ns[i] is not None:
+                    jitter[i].add(abs(monotonic_ns - last_sample_ns[i] - self.interval_ns[i]))
+                last_sample_ns[i] = monotonic_ns
+                self.output.put((i, monotonic_ns, timestamp, raw, value, seq[i]))
+                seq[i] = (seq[i] + 1) % SEQ_MODULO
+            self.output.put(SWEEP_END)
+            done_ns = time.monotonic_ns()
+            for i in deadlines:
+                overrun[i].add(max(done_ns - deadlines[i] - self.interval_ns[i], 0))
+            if done_ns - last_eval_ns >= period_of_time_for_eval * 1e9:
+                achieved_sps = {i: round(samples_since_eval[i] * 1e9 / (done_ns - last_eval_ns), 2) for i in self.channels}
+                common_logger.info(f"bus {self.bus}: achieved samples per second per channel ({'pipelined' if self.pipelined else 'not pipelined'}): {achieved_sps}")
+                for i in self.channels:
+                    common_logger.info(f"channel {i} jitter {jitter[i].summary()}")
+                    common_logger.info(f"channel {i} overrun {overrun[i].summary()}")
+                    jitter[i].reset()
+                    overrun[i].reset()
+                for i in self.noise:
+                    common_logger.info(f"channel {i} oversampled {self.noise[i].summary()}, compare to LSB of native 16 bit {lsb_volts(16, self.pga[i])*1000:.3f} mV and 18 bit {lsb_volts(18, self.pga[i])*1000:.3f} mV")
+                    self.noise[i].reset()
+                for i in self.channels:
+                    if scheduler.missed_slots[i] > missed_slots_reported[i]:
+                        common_logger.warning(f"channel {i} missed {scheduler.missed_slots[i] - missed_slots_reported[i]} slots in the last {period_of_time_for_eval} s, requested sampling interval is too short!")
+                        missed_slots_reported[i] = scheduler.missed_slots[i]
+                samples_since_eval = dict.fromkeys(self.channels, 0)
+                last_eval_ns = done_ns
+
+    def convert(self, deadlines):
+        """
+        Generator converting the channels in deadlines (in their order) on their ADC pairs, yields (channel, monotonic_ns, timestamp, raw, value) per channel.
+        The sweeps of all pairs are started before any result is read and the pairs take turn in handing out results, so all chips on the bus keep converting.
+        Pipelined, each result is yielded as soon as it is read. Otherwise, and for oversampled channels, whose conversions are averaged per sweep, the rows
+        of a pair are collected and yielded when the sweeps of all pairs are done.
+        """
+        sweeps, collected = {}, {}
+        for pair, adc in self.adcs.items():
+            local = [local_channel(i) for i in deadlines if pair_of(i) == pair]
+            if not local: continue
+            channels = [c for c in local for k in range(self.oversampling[pair * 8 + c])]
+            # yields (channel, raw, voltage, timestamp, monotonic_ns) while the chips convert the next channels, the first conversion of each chip starts right away
+            sweeps[pair] = adc.iter_sweep(channels, self.local_pga[pair], self.local_rate[pair])
+            if not (self.pipelined and len(channels) == len(local)): collected[pair] = (len(local), [])
+        while sweeps:
+            for pair in list(sweeps):
+                row = next(sweeps[pair], None)
+                if row is None:
+                    del sweeps[pair]
+                    continue
+                if pair in collected:
+                    collected[pair][1].append(row)
+                    continue
+                c, raw, value, timestamp, monotonic_ns = row
+                yield pair * 8 + c, monotonic_ns, timestamp, raw, value
+        for pair, (count, rows) in collected.items():
+            sweep = np.array(rows, dtype=SWEEP_DTYPE)   # as ADCPi.read_sweep() returns it, one row per conversion
+            if len(sweep) > count:
+                sweep, burst_std = decimate(sweep)
+                for c, std in zip(sweep['channel'].tolist(), burst_std.tolist()):
+                    if pair * 8 + c in self.noise: self.noise[pair * 8 + c].add(std)
+            for c, raw, value, timestamp, monotonic_ns in sweep.tolist():
+                i = pair * 8 + c
+                if self.oversampling[i] > 1: raw = round(value / self.scale[i])  # keeps the bits gained by averaging
+                yield i, monotonic_ns, timestamp, raw, value
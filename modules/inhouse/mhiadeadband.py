@@ -0,0 +1,108 @@
+# mhiadeadband.py - a module of the mhia pi application, report by exception: publishing values only when they move
+# Copyright (C) 2023  Iman Ayatollahi, Talwiese IoT Solutions e.U.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import numpy as np
+
+# A sample of a channel with a deadband is published only if its value differs from the last published one by more than the deadband,
+# or if the last published one is heartbeat seconds old, so a subscriber can tell a steady channel from a dead one. The first sample is always published.
+# Whether a sample passes depends on the last one that passed, so the samples can't be judged all at once. Instead the next sample that passes is searched
+# vectorized in a window of the samples after the last one, which doubles while nothing passes: a quiet channel is done with a few numpy calls per read,
+# a moving one is tested sample by sample in plain python as long as most of its samples pass.
+
+class Deadband:
+    def __init__(self, channels_config):
+        """
+        Reads the rules of each channel from channels_config: deadband in V, or deadband_percent of the range from min_voltage to max_voltage,
+        and heartbeat in seconds. Channels without deadband and heartbeat are not filtered.
+        """
+        self.rules = {}     # channel -> (deadband in V, heartbeat in s or None)
+        for channel, config in channels_config.items():
+            deadband, heartbeat = config.get('deadband'), config.get('heartbeat')
+            if config.get('deadband_percent') is not None:
+                deadband = config['deadband_percent'] / 100 * (config['max_voltage'] - config['min_voltage'])
+            if deadband is None and heartbeat is None: continue
+            # a heartbeat alone publishes every heartbeat seconds whatever the value does
+            self.rules[int(channel)] = (float(deadband) if deadband is not None else np.inf, float(heartbeat) if heartbeat else None)
+        self.last = {}          # channel -> (value, timestamp) of the last published sample
+        self.published = {channel: 0 for channel in self.rules}
+        self.suppressed = {channel: 0 for channel in self.rules}
+
+    def filter(self, samples):
+        """
+        Returns the samples (channel, timestamp, raw, scale, seq) that are to be published, in their order. The value of a sample is raw * scale.
+        seq isn't looked at, it may be None (samples of a process that didn't ask for sequence numbers).
+        """
+        if not self.rules or not samples: return samples
+        channels, timestamps, raws, scales = np.array(list(zip(*samples))[:4], dtype=np.float64)    # by column, without seq
+        values = raws * scales
+        keep = np.ones(len(samples), dtype=bool)
+        for channel in np.unique(channels).astype(np.int64).tolist():
+            if channel not in self.rules: continue
+            index = np.flatnonzero(channels == channel)
+            passed = self._passing(channel, timestamps[index], values[index])
+            keep[index] = False
+            keep[index[passed]] = True
+            self.published[channel] += len(passed)
+            self.suppressed[channel] += len(index) - len(passed)
+        return [sample for sample, kept in zip(samples, keep.tolist()) if kept]
+
+    def _passing(self, channel, timestamps, values):
+        # the indices of the samples of one channel that pass, starting from the last published sample of the channel
+        deadband, heartbeat = self.rules[channel]
+        value_list, timestamp_list = values.tolist(), timestamps.tolist()
+        passed = []
+        if channel in self.last:
+            value, timestamp = self.last[channel]
+            position = 0
+        else:
+            passed.append(0)
+            value, timestamp = value_list[0], timestamp_list[0]
+            position = 1
+        window, one_by_one, misses = 16, False, 0
+        while position < len(values):
+            if one_by_one:
+                # while most samples pass a numpy call for each would cost more than testing them one by one, after 16 suppressed ones in a row it's searching again
+                if abs(value_list[position] - value) > deadband or (heartbeat is not None and timestamp_list[position] - timestamp >= heartbeat):
+                    passed.append(position)
+                    value, timestamp = value_list[position], timestamp_list[position]
+                    misses = 0
+                else:
+                    misses += 1
+                    if misses == 16: window, one_by_one = 32, False
+                position += 1
+                continue
+            end = min(position + window, len(values))
+            hits = np.abs(values[position:end] - value) > deadband
+            if heartbeat is not None: hits |= timestamps[position:end] - timestamp >= heartbeat
+            if not hits.any():
+                position = end
+                window *= 2
+                continue
+            offset = int(hits.argmax())
+            position += offset
+            passed.append(position)
+            value, timestamp = value_list[position], timestamp_list[position]
+            position += 1
+            window = 16
+            if offset < 4: one_by_one, misses = True, 0
+        self.last[channel] = (value, timestamp)
+        return np.array(passed, dtype=np.int64)
+
+    def stats(self):
+        """
+        Returns the published and suppressed samples of each filtered channel since the start as a dict (for json)
+        """
+        return {channel: {'published': self.published[channel], 'suppressed': self.suppressed[channel]} for channel in self.rules}
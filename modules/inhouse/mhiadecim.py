@@ -0,0 +1,90 @@
+# mhiadecim.py - a module of the mhia pi application, oversampling and decimation of sampled values
+# Copyright (C) 2023  Iman Ayatollahi, Talwiese IoT Solutions e.U.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import math
+import numpy as np
+
+def lsb_volts(resolution, gain):
+    """
+    Returns the voltage of one quantization step on a channel of the mhia pi board (2.048 V reference of the MCP3424, 2.471 input divider of the board)
+    """
+    return 2 * 2.048 / (1 << resolution) / gain * 2.471
+
+def decimate(sweep):
+    """
+    Averages the rows of a sweep (numpy array of ADCPi.SWEEP_DTYPE) that belong to the same channel to one row, which is a boxcar filter followed by decimation.
+    Voltage and timestamp are averaged, raw is the rounded mean, monotonic_ns is the start of the first conversion.
+    Returns the decimated sweep (one row per channel, ordered by channel) and the standard deviation of the voltages of each channel within the sweep.
+    """
+    channels, inverse, counts = np.unique(sweep['channel'], return_inverse=True, return_counts=True)
+    inverse = inverse.ravel()
+    decimated = np.zeros(len(channels), dtype=sweep.dtype)
+    decimated['channel'] = channels
+    voltage = np.bincount(inverse, weights=sweep['voltage']) / counts
+    decimated['voltage'] = voltage
+    decimated['timestamp'] = np.bincount(inverse, weights=sweep['timestamp']) / counts
+    decimated['raw'] = np.rint(np.bincount(inverse, weights=sweep['raw']) / counts)
+    decimated['monotonic_ns'] = np.iinfo(np.int64).max
+    np.minimum.at(decimated['monotonic_ns'], inverse, sweep['monotonic_ns'])
+    deviation = np.bincount(inverse, weights=(sweep['voltage'] - voltage[inverse]) ** 2)
+    std = np.sqrt(deviation / np.maximum(counts - 1, 1))
+    return decimated, std
+
+class NoiseFloor:
+    def __init__(self, factor, resolution, gain):
+        """
+        Collects the noise within the bursts of one oversampled channel and estimates the noise floor of the averaged values.
+        factor is the number of conversions averaged to one value, resolution and gain those of each single conversion.
+        """
+        self.factor = factor
+        self.resolution = resolution
+        self.lsb = lsb_volts(resolution, gain)
+        self.reset()
+
+    def reset(self):
+        self.bursts = 0
+        self.variance_sum = 0.0
+
+    def add(self, std):
+        self.bursts += 1
+        self.variance_sum += std * std
+
+    def single_noise(self):
+        """
+        Returns the rms noise of a single conversion in V, measured within the bursts
+        """
+        return math.sqrt(self.variance_sum / self.bursts) if self.bursts else 0.0
+
+    def floor(self):
+        """
+        Returns the rms noise of an averaged value in V. Averaging reduces the noise by sqrt(factor), the quantization noise (lsb/sqrt(12)) included.
+        This holds as long as the input noise dithers the quantization, that is a single_noise of about lsb/2 or more.
+        """
+        return math.sqrt((self.single_noise() ** 2 + self.lsb ** 2 / 12) / self.factor)
+
+    def effective_bits(self):
+        """
+        Returns the resolution in bits an ideal converter with the same noise floor would have, counted like the mhia pi does (positive range only)
+        """
+        full_scale = (1 << (self.resolution - 1)) * self.lsb
+        return math.log2(full_scale / (self.floor() * math.sqrt(12)))
+
+    def summary(self):
+        text = (f"{self.factor}x {self.resolution} bit: single conversion noise {self.single_noise()*1000:.3f} mV rms, "
+                f"noise floor {self.floor()*1000:.3f} mV rms, {self.effective_bits():.1f} effective bits")
+        if self.bursts and self.single_noise() < self.lsb / 2:
+            text += " (too little noise to dither the quantization, the real gain is lower)"
+        return text
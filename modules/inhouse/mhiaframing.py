@@ -0,0 +1,262 @@
+# mhiaframing.py - a module of the mhia pi application, frames on the unix domain socket between sampler and the other processes
+# Copyright (C) 2023  Iman Ayatollahi, Talwiese IoT Solutions e.U.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json, struct
+
+# Every frame starts with a header: length of the body in bytes (uint32) and the kind of the frame (uint8), network byte order.
+# A stream socket may hand over a frame in pieces or several frames at once, FrameDecoder puts them together again.
+FRAME_HEADER = struct.Struct('!IB')
+MAX_BODY = 1 << 20  # longer frames mean the stream got out of step
+
+# kinds of frames
+SAMPLES = 1     # body is a batch of samples, one SAMPLE record after the other
+HELLO = 2       # sent once by a process right after its 4 byte name, body is a json object with the wanted options, e.g. {"encoding": "compact"}
+COMPACT_SAMPLES = 3 # body is a batch of samples, one COMPACT_SAMPLE record after the other
+ANCHOR = 4      # body is an ANCHOR_BODY, the COMPACT_SAMPLES after it count their time from there
+META = 5        # body is one SCALE record per channel, sent before the first COMPACT_SAMPLES
+NOTIFY = 6      # empty body, new samples are in the ring in shared memory (see mhiashm.py), for processes that asked for that transport
+SUBSCRIBE = 7   # sent by a process at any time after its name, body is a json object with the channels it wants and their maximum rate, see subscribe()
+SEQ_SAMPLES = 8 # like SAMPLES, with SEQ_SAMPLE records, for processes that asked for {"sequence": true}
+COMPACT_SEQ_SAMPLES = 9 # like COMPACT_SAMPLES, with COMPACT_SEQ_SAMPLE records
+
+# one sample: channel (int), epoch timestamp in seconds (double), voltage (double), that is 4+8+8=20 bytes
+SAMPLE = struct.Struct('!idd')
+
+# the same with the sequence number of the sample in its channel (uint32) after the channel, 24 bytes. The sampler counts the samples of every channel,
+# so a process can tell from gaps in the numbers how many samples got lost on the way (see SequenceTracker)
+SEQ_SAMPLE = struct.Struct('!iIdd')
+
+# one sample in compact encoding: channel (uint8), ns since the monotonic time of the last anchor (int64), raw count of the ADC (int32), 13 bytes
+# the voltage is the raw count times the scale of the channel, converting is left to the receiving process
+COMPACT_SAMPLE = struct.Struct('!Bqi')
+COMPACT_SEQ_SAMPLE = struct.Struct('!BIqi')    # with the sequence number after the channel, 17 bytes
+SEQ_MODULO = 1 << 32    # sequence numbers start again at 0 after 2^32 - 1
+ANCHOR_BODY = struct.Struct('!qd')  # time.monotonic_ns() and epoch timestamp in seconds of the same moment
+SCALE = struct.Struct('!Bd')        # channel and volts per raw count
+
+# encodings a process can ask for in its HELLO frame
+PLAIN = "plain"
+COMPACT = "compact"
+
+# transports a process can ask for in its HELLO frame, e.g. {"transport": "shared_memory"}, without one it gets SAMPLES or COMPACT_SAMPLES frames
+SOCKET = "socket"
+SHARED_MEMORY = "shared_memory"
+
+def frame(kind, body):
+    """
+    Returns the frame of the given kind with body (bytes) as bytes, ready for sending
+    """
+    return FRAME_HEADER.pack(len(body), kind) + body
+
+def unpack_samples(body):
+    """
+    Returns the samples in the body of a SAMPLES frame as a list of (channel, timestamp, value)
+    """
+    return list(SAMPLE.iter_unpack(body))
+
+def hello(**options):
+    """
+    Returns the HELLO frame with the given options, send it right after the 4 byte name of the process
+    """
+    return frame(HELLO, json.dumps(options).encode())
+
+def subscribe(channels=None, max_rate=None):
+    """
+    Returns the SUBSCRIBE frame for the given channels (a list, None for all) with at most max_rate samples per second and channel (None for all samples).
+    The sampler sends only these samples from then on, the same keys can also be part of the HELLO frame.
+    """
+    return frame(SUBSCRIBE, json.dumps({'channels': channels, 'max_rate': max_rate}).encode())
+
+def meta(scales):
+    """
+    Returns the META frame for scales, a dict with the channel as key and volts per raw count as value
+    """
+    return frame(META, b"".join(SCALE.pack(channel, scale) for channel, scale in scales.items()))
+
+class SampleFramer:
+    def __init__(self, encoding=PLAIN, anchor_period_ns=10 * 10**9, sequence=False):
+        """
+        Collects the samples for one process in frames of the encoding it asked for. With the compact encoding an ANCHOR frame is put in front of
+        the first samples and then every anchor_period_ns, so the receiver can tell the wall clock time of each sample.
+        With sequence the samples carry their sequence number (SEQ_SAMPLES and COMPACT_SEQ_SAMPLES frames).
+        """
+        self.encoding = encoding
+        self.sequence = sequence
+        self.anchor_period_ns = anchor_period_ns
+        self.frames = bytearray()   # complete frames not taken yet
+        self.body = bytearray()     # samples of the frame being collected
+        self.anchor_ns = None
+        self.anchor_frame = b""  # the last ANCHOR frame, the samples collected since count their time from it
+
+    def __len__(self):
+        return len(self.frames) + len(self.body)
+
+    def add(self, channel, monotonic_ns, timestamp, raw, value, seq=0):
+        if self.encoding == COMPACT:
+            if self.anchor_ns is None or monotonic_ns - self.anchor_ns >= self.anchor_period_ns:
+                self.close()
+                self.anchor_ns = monotonic_ns
+                self.anchor_frame = frame(ANCHOR, ANCHOR_BODY.pack(monotonic_ns, timestamp))
+                self.frames += self.anchor_frame
+            if self.sequence: self.body += COMPACT_SEQ_SAMPLE.pack(channel, seq, monotonic_ns - self.anchor_ns, raw)
+            else: self.body += COMPACT_SAMPLE.pack(channel, monotonic_ns - self.anchor_ns, raw)
+        elif self.sequence:
+            self.body += SEQ_SAMPLE.pack(channel, seq, timestamp, value)
+        else:
+            self.body += SAMPLE.pack(channel, timestamp, value)
+
+    def close(self):
+        if self.body:
+            if self.encoding == COMPACT: kind = COMPACT_SEQ_SAMPLES if self.sequence else COMPACT_SAMPLES
+            else: kind = SEQ_SAMPLES if self.sequence else SAMPLES
+            self.frames += frame(kind, self.body)
+            self.body.clear()
+
+    def take(self):
+        """
+        Returns all collected frames as bytes for sending, the framer is empty afterwards
+        """
+        self.close()
+        data = bytes(self.frames)
+        self.frames.clear()
+        return data
+
+class SampleDecoder:
+    def __init__(self, tracker=None):
+        """
+        Decodes the frames a process receives from the sampler in either encoding, keeping the anchor and scales of the compact encoding.
+        The sequence numbers of the samples are counted in tracker (a SequenceTracker) if one is given.
+        Frames of other kinds are kept in the list "others" for the caller.
+        """
+        self.frames = FrameDecoder()
+        self.scales = {}
+        self.anchor = None
+        self.tracker = tracker
+        self.others = []
+
+    def feed_raw(self, data):
+        """
+        Adds received data and returns the completed samples as a list of (channel, timestamp, raw, scale, seq), with the compact encoding only.
+        Plain samples are returned as (channel, timestamp, value, 1.0, seq). Nothing is converted to volts, voltage = raw * scale.
+        seq is None if the process didn't ask for sequence numbers.
+        """
+        samples = []
+        for kind, body in self.frames.feed(data):
+            if kind == COMPACT_SAMPLES or kind == COMPACT_SEQ_SAMPLES:
+                anchor_ns, anchor_time = self.anchor
+                scales = self.scales
+                if kind == COMPACT_SAMPLES:
+                    samples.extend((channel, anchor_time + delta_ns / 1e9, raw, scales.get(channel, 0.0), None) for channel, delta_ns, raw in COMPACT_SAMPLE.iter_unpack(body))
+                else:
+                    samples.extend((channel, anchor_time + delta_ns / 1e9, raw, scales.get(channel, 0.0), seq) for channel, seq, delta_ns, raw in COMPACT_SEQ_SAMPLE.iter_unpack(body))
+            elif kind == SAMPLES:
+                samples.extend((channel, timestamp, value, 1.0, None) for channel, timestamp, value in SAMPLE.iter_unpack(body))
+            elif kind == SEQ_SAMPLES:
+                samples.extend((channel, timestamp, value, 1.0, seq) for channel, seq, timestamp, value in SEQ_SAMPLE.iter_unpack(body))
+            elif kind == ANCHOR:
+                self.anchor = ANCHOR_BODY.unpack(body)
+            elif kind == META:
+                self.scales.update(SCALE.iter_unpack(body))
+            else:
+                self.others.append((kind, body))
+        if self.tracker is not None:
+            for sample in samples:
+                if sample[4] is not None: self.tracker.add(sample[0], sample[4])
+        return samples
+
+    def feed(self, data):
+        """
+        Adds received data and returns the completed samples as a list of (channel, timestamp, value), value in volts
+        """
+        return [(channel, timestamp, raw * scale) for channel, timestamp, raw, scale, seq in self.feed_raw(data)]
+
+class SequenceTracker:
+    def __init__(self, memory=1024):
+        """
+        Counts per channel the samples received, the gaps in their sequence numbers (samples lost on the way), samples arriving twice (duplicates)
+        and samples arriving after later ones (late, they were counted as gap before and are taken off the gaps then).
+        The last memory missing sequence numbers of each channel are remembered for telling late samples from duplicates.
+        """
+        self.memory = memory
+        self.reset()
+
+    def reset(self):
+        self.expected = {}  # the next sequence number per channel
+        self.missing = {}   # per channel the sequence numbers of the gaps, oldest first (dict keeps the order)
+        self.received, self.gaps, self.duplicates, self.late = {}, {}, {}, {}
+
+    def restart(self):
+        """
+        Forgets the sequence numbers seen so far but keeps the counters, e.g. after subscribing to other channels, so the samples not subscribed
+        to in between don't count as gaps
+        """
+        self.expected = {}
+        self.missing = {}
+
+    def add(self, channel, seq):
+        if channel not in self.received:
+            self.received[channel] = self.gaps[channel] = self.duplicates[channel] = self.late[channel] = 0
+        self.received[channel] += 1
+        expected = self.expected.get(channel)
+        if expected is None:
+            self.expected[channel] = (seq + 1) % SEQ_MODULO
+            return
+        ahead = (seq - expected) % SEQ_MODULO
+        if ahead < SEQ_MODULO // 2:  # seq is expected or later, everything in between is missing
+            self.gaps[channel] += ahead
+            missing = self.missing.setdefault(channel, {})
+            for lost in range(max(ahead - self.memory, 0), ahead): missing[(expected + lost) % SEQ_MODULO] = None
+            while len(missing) > self.memory: del missing[next(iter(missing))]
+            self.expected[channel] = (seq + 1) % SEQ_MODULO
+        elif seq in self.missing.get(channel, {}):
+            del self.missing[channel][seq]
+            self.gaps[channel] -= 1
+            self.late[channel] += 1
+        else:
+            self.duplicates[channel] += 1
+
+    def stats(self):
+        """
+        Returns the counters as a dict with the channel as key and a dict of received, gaps, duplicates and late as value
+        """
+        return {channel: {'received': self.received[channel], 'gaps': self.gaps[channel], 'duplicates': self.duplicates[channel], 'late': self.late[channel]}
+                for channel in sorted(self.received)}
+
+class FrameDecoder:
+    def __init__(self):
+        """
+        Collects received bytes and cuts them into frames, partial frames are kept until the rest arrives.
+        """
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """
+        Adds received data and returns the frames completed by it as a list of (kind, body), body as bytes.
+        Raises ValueError if a header announces an impossible length, the stream can't be decoded any further then.
+        """
+        self.buffer += data
+        frames = []
+        start = 0
+        while len(self.buffer) - start >= FRAME_HEADER.size:
+            length, kind = FRAME_HEADER.unpack_from(self.buffer, start)
+            if length > MAX_BODY:
+                raise ValueError(f"frame of {length} bytes, the stream is out of step")
+            end = start + FRAME_HEADER.size + length
+            if end > len(self.buffer): break
+            frames.append((kind, bytes(self.buffer[start + FRAME_HEADER.size:end])))
+            start = end
+        del self.buffer[:start]
+        return frames
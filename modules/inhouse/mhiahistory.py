@@ -0,0 +1,155 @@
+# mhiahistory.py - a module of the mhia pi application, recent samples of each channel in memory for answering history requests
+# Copyright (C) 2023  Iman Ayatollahi, Talwiese IoT Solutions e.U.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import math
+import numpy as np
+
+from modules.inhouse.mhiapayload import HISTORY_MAGIC, HISTORY_HEADER
+
+# Each channel has two rings: the latest samples (timestamp and volts) and rollups of the samples per rollup seconds (start, min, max, sum and count),
+# which reach back much further for the same memory. A query is answered from the samples as long as they reach back to the start of the query,
+# from the rollups otherwise, with buckets of at least one rollup then. Either way the buckets are computed at once with numpy, nothing is kept per bucket.
+# The rings are filled with all samples the publisher gets, deadband or not. Samples are collected in a list first and put into the rings PENDING at a time
+# or before a query, the numpy calls per channel would cost more than the samples themselves with the few samples of each read from the sampler.
+
+SAMPLE_DTYPE = np.dtype([('timestamp', np.float64), ('value', np.float64)])
+ROLLUP_DTYPE = np.dtype([('start', np.float64), ('min', np.float64), ('max', np.float64), ('sum', np.float64), ('count', np.int64)])
+MAX_BUCKETS = 10000
+PENDING = 4096
+
+class _Ring:
+    def __init__(self, capacity, dtype):
+        self.rows = np.zeros(capacity, dtype=dtype)
+        self.head = 0       # rows written so far, the next one goes to head % capacity
+
+    def extend(self, rows):
+        capacity = len(self.rows)
+        if len(rows) >= capacity:
+            rows = rows[-capacity:]
+        start = self.head % capacity
+        first = min(len(rows), capacity - start)
+        self.rows[start:start + first] = rows[:first]
+        self.rows[:len(rows) - first] = rows[first:]
+        self.head += len(rows)
+
+    def ordered(self):
+        # the rows in the order they were written, oldest first
+        capacity = len(self.rows)
+        if self.head <= capacity: return self.rows[:self.head]
+        start = self.head % capacity
+        return np.concatenate((self.rows[start:], self.rows[:start]))
+
+    def last(self):
+        return self.rows[(self.head - 1) % len(self.rows)] if self.head else None
+
+class History:
+    def __init__(self, samples, rollups, rollup=1.0):
+        """
+        Keeps the latest samples (number per channel) and rollups of rollup seconds each (number per channel) of every channel
+        """
+        self.capacity = samples
+        self.rollup_capacity = rollups
+        self.rollup = rollup
+        self.samples = {}   # channel -> _Ring of SAMPLE_DTYPE
+        self.rollups = {}   # channel -> _Ring of ROLLUP_DTYPE
+        self.pending = []
+
+    def add(self, samples):
+        """
+        Adds samples (channel, timestamp, raw, scale, seq) as they come from the sampler, the value is raw * scale. seq isn't kept, it may be None.
+        """
+        self.pending.extend(samples)
+        if len(self.pending) >= PENDING: self._flush()
+
+    def _flush(self):
+        if not self.pending: return
+        channels, timestamps, raws, scales = np.array(list(zip(*self.pending))[:4], dtype=np.float64)     # by column, without seq
+        self.pending = []
+        channels = channels.astype(np.int64)
+        values = raws * scales
+        for channel in np.unique(channels).tolist():
+            selected = channels == channel
+            rows = np.empty(np.count_nonzero(selected), dtype=SAMPLE_DTYPE)
+            rows['timestamp'] = timestamps[selected]
+            rows['value'] = values[selected]
+            if channel not in self.samples:
+                self.samples[channel] = _Ring(self.capacity, SAMPLE_DTYPE)
+                self.rollups[channel] = _Ring(self.rollup_capacity, ROLLUP_DTYPE)
+            self.samples[channel].extend(rows)
+            self._roll_up(self.rollups[channel], rows)
+
+    def _roll_up(self, ring, rows):
+        # one rollup per run of samples within the same rollup period, the first one is merged into the last rollup of the ring if it is the same period
+        starts = np.floor(rows['timestamp'] / self.rollup) * self.rollup
+        firsts = np.flatnonzero(np.r_[True, starts[1:] != starts[:-1]])
+        rollups = np.empty(len(firsts), dtype=ROLLUP_DTYPE)
+        rollups['start'] = starts[firsts]
+        rollups['min'] = np.minimum.reduceat(rows['value'], firsts)
+        rollups['max'] = np.maximum.reduceat(rows['value'], firsts)
+        rollups['sum'] = np.add.reduceat(rows['value'], firsts)
+        rollups['count'] = np.diff(np.r_[firsts, len(rows)])
+        last = ring.last()
+        if last is not None and last['start'] == rollups[0]['start']:
+            last['min'] = min(last['min'], rollups[0]['min'])
+            last['max'] = max(last['max'], rollups[0]['max'])
+            last['sum'] += rollups[0]['sum']
+            last['count'] += rollups[0]['count']
+            rollups = rollups[1:]
+        ring.extend(rollups)
+
+    def query(self, channel, seconds, bucket, now):
+        """
+        Returns min, max, mean and count of the values of channel in buckets of bucket seconds from now - seconds until now, as numpy arrays
+        (NaN and 0 for empty buckets), and the start of the first bucket and the bucket length actually used. Buckets of the rollups are whole
+        multiples of rollup seconds. Raises ValueError for an unknown channel, for seconds or bucket that are not finite and greater than 0 (they come
+        from requests over MQTT) and for too many buckets.
+        """
+        if not (math.isfinite(seconds) and seconds > 0 and math.isfinite(bucket) and bucket > 0):
+            raise ValueError(f"seconds and bucket have to be finite and greater than 0, not {seconds} and {bucket}")
+        self._flush()
+        if channel not in self.samples: raise ValueError(f"no samples of channel {channel}")
+        start = now - seconds
+        samples = self.samples[channel].ordered()
+        if self.samples[channel].head <= self.capacity or samples['timestamp'][0] <= start:
+            timestamps, mins, maxs, sums, counts = samples['timestamp'], samples['value'], samples['value'], samples['value'], None
+        else:
+            bucket = max(1, round(bucket / self.rollup)) * self.rollup
+            start = math.floor(start / self.rollup) * self.rollup
+            rollups = self.rollups[channel].ordered()
+            timestamps, mins, maxs, sums, counts = rollups['start'], rollups['min'], rollups['max'], rollups['sum'], rollups['count']
+        buckets = math.ceil((now - start) / bucket)
+        if buckets > MAX_BUCKETS: raise ValueError(f"{buckets} buckets are too many, at most {MAX_BUCKETS}")
+        inside = (timestamps >= start) & (timestamps < start + buckets * bucket)
+        index = ((timestamps[inside] - start) // bucket).astype(np.int64)
+        count = np.bincount(index, weights=counts[inside] if counts is not None else None, minlength=buckets).astype(np.int64)
+        total = np.bincount(index, weights=sums[inside], minlength=buckets)
+        low = np.full(buckets, np.inf)
+        high = np.full(buckets, -np.inf)
+        np.minimum.at(low, index, mins[inside])
+        np.maximum.at(high, index, maxs[inside])
+        empty = count == 0
+        low[empty] = high[empty] = np.nan
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / count
+        return low, high, mean, count, start, bucket
+
+    def response(self, channel, seconds, bucket, now):
+        """
+        Returns the answer to a history request as payload, see mhiapayload.py
+        """
+        low, high, mean, count, start, bucket = self.query(channel, seconds, bucket, now)
+        header = HISTORY_HEADER.pack(HISTORY_MAGIC, channel, start, bucket, len(count))
+        return header + low.astype('>f4').tobytes() + high.astype('>f4').tobytes() + mean.astype('>f4').tobytes() + np.minimum(count, 0xFFFFFFFF).astype('>u4').tobytes()
@@ -0,0 +1,408 @@
+# mhiahub.py - a module of the mhia pi application, hands the samples out to any number of connected processes
+# Copyright (C) 2023  Iman Ayatollahi, Talwiese IoT Solutions e.U.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json, time, logging, selectors
+from collections import deque
+
+from modules.inhouse.mhiaframing import SampleFramer, FrameDecoder, COMPACT, PLAIN, SHARED_MEMORY, HELLO, NOTIFY, SUBSCRIBE, META, FRAME_HEADER, frame, meta
+
+common_logger = logging.getLogger("standard")
+error_logger = logging.getLogger("error")
+
+# what happens to the frames for a process whose queue is full:
+DROP_OLDEST = "drop-oldest"     # the oldest frames not sent yet are dropped, the process gets the latest samples (suits the display)
+DROP_NEWEST = "drop-newest"     # the new frames are dropped, the process gets a gap at the end of its queue
+BLOCK = "block"                 # the sampler waits up to block_timeout for the process, it is disconnected as broken then (no samples are lost before),
+                                # the other processes are served meanwhile, but get no new samples
+DROP_POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+# seconds a process may take for a name or HELLO frame it started sending, it is disconnected after that (hello_timeout is for a HELLO that never starts)
+HANDSHAKE_LIMIT = 2.0
+
+class Consumer:
+    def __init__(self, sock, tag, encoding, over_ring, policy, queue_limit, sequence=False):
+        """
+        A process connected to the sampler, with its own framer and a bounded queue of frames not sent yet.
+        over_ring means it reads the samples from the ring in shared memory and gets just NOTIFY frames, policy is one of DROP_POLICIES, queue_limit in bytes.
+        With sequence its samples carry their sequence numbers.
+        """
+        self.sock = sock
+        self.tag = tag
+        self.encoding = encoding
+        self.over_ring = over_ring
+        self.policy = policy
+        self.queue_limit = queue_limit
+        self.framer = SampleFramer(self.encoding, sequence=sequence)
+        self.allowed = range(1, 9) if tag == "disp" else None   # None means all channels, the display shows channels 1 to 8 only
+        self.channels = self.allowed    # the channels it subscribed to
+        self.min_interval_ns = 0        # from the maximum rate it subscribed to, 0 for every sample
+        self.last_ns = {}               # time of the last sample sent per channel, for keeping to the maximum rate
+        self.decoder = FrameDecoder()   # for the frames it sends, e.g. SUBSCRIBE
+        self.queue = deque()    # (enqueued_ns, start_anchor, end_anchor, data) per flush, see SampleHub._enqueue()
+        self.queued_bytes = 0
+        self.sent = 0           # bytes of the first entry in queue already sent
+        self.taken_anchor = self.sent_anchor = b""  # the anchor in effect after the last entry queued and after the last entry sent
+        self.scales_dropped = False     # an entry with the META frame was dropped, _send puts the scales in front of the next entry
+        self.frames_sent = self.frames_dropped = self.bytes_sent = self.bytes_dropped = 0
+        self.connected_ns = time.monotonic_ns()
+
+    def subscribe(self, channels=None, max_rate=None):
+        """
+        Sets the channels (None for all) and the maximum rate in samples per second per channel (None for all samples) the process wants
+        """
+        min_interval_ns = int(1e9 / max_rate) if max_rate else 0
+        self.channels = self.allowed if channels is None else [channel for channel in channels if self.allowed is None or channel in self.allowed]
+        self.min_interval_ns = min_interval_ns
+        self.last_ns = {}
+
+    def wants(self, channel, monotonic_ns):
+        """
+        Tells if the sample of channel taken at monotonic_ns goes to this process, only call it for samples that are sent then
+        """
+        if self.channels is not None and channel not in self.channels: return False
+        if self.min_interval_ns:
+            last_ns = self.last_ns.get(channel)
+            # 1/8 of the interval as slack, otherwise the jitter of sampling would skip every second sample when the rates are close
+            if last_ns is not None and monotonic_ns - last_ns < self.min_interval_ns - self.min_interval_ns // 8: return False
+            self.last_ns[channel] = monotonic_ns
+        return True
+
+    def lag_ns(self, now_ns):
+        """
+        Returns how long the oldest frame not sent yet is waiting, 0 if the queue is empty
+        """
+        return now_ns - self.queue[0][0] if self.queue else 0
+
+    def stats(self, now_ns):
+        return {'policy': self.policy, 'queued_bytes': self.queued_bytes, 'lag_ms': round(self.lag_ns(now_ns) / 1e6, 1), 'frames_sent': self.frames_sent,
+                'bytes_sent': self.bytes_sent, 'frames_dropped': self.frames_dropped, 'bytes_dropped': self.bytes_dropped}
+
+class SampleHub:
+    def __init__(self, listener, scales, queue_limit=256 * 1024, policies=None, default_policy=DROP_OLDEST, block_timeout=2.0, hello_timeout=0.2, shared_memory=False):
+        """
+        Accepts processes on the listening unix domain socket listener at any time and sends each of them the samples in frames of the encoding it
+        asked for. Processes may connect and disconnect while sampling, a process that doesn't take its frames in time loses frames as its drop policy
+        says, but never takes the sampler down. scales is a dict with the volts per raw count of each channel, for the META frame of the compact encoding.
+        policies is a dict with the 4 byte name of a process as key and its drop policy as value, processes not in there get default_policy.
+        A process may also ask for a policy in its HELLO frame, e.g. {"drop_policy": "block"}. With shared_memory the samples are in the ring of the sampler,
+        processes asking for that transport get NOTIFY frames instead of samples then (see notify()).
+        Call poll() regularly, it accepts processes, reads from them and sends what their sockets take without waiting.
+        """
+        self.listener = listener
+        self.listener.setblocking(False)
+        self.scales = scales
+        self.queue_limit = queue_limit
+        self.policies = policies or {}
+        self.default_policy = default_policy
+        self.block_timeout = block_timeout
+        self.hello_timeout = hello_timeout
+        self.shared_memory = shared_memory
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(listener, selectors.EVENT_READ, None)
+        self.pending = {}       # sockets that connected, but didn't finish the handshake yet, as key, (deadline_ns, received bytes) as value
+        self.consumers = {}     # socket as key, its Consumer as value
+        self.polling = False    # within poll(), see _wait_for()
+
+    def tags(self):
+        return [consumer.tag for consumer in self.consumers.values()]
+
+    def add(self, sample):
+        """
+        Adds a sample (channel, monotonic_ns, timestamp, raw, value, seq) to the frames of every process that subscribed to it and doesn't read the ring,
+        samples above the maximum rate a process subscribed to are left out for it.
+        Returns the longest frame collected in bytes, the caller flushes when that gets too long.
+        """
+        longest = 0
+        for consumer in self.consumers.values():
+            if consumer.over_ring or not consumer.wants(sample[0], sample[1]): continue
+            consumer.framer.add(*sample)
+            longest = max(longest, len(consumer.framer))
+        return longest
+
+    def flush(self):
+        """
+        Puts the collected frames into the queues of the processes and sends what their sockets take.
+        """
+        for consumer in list(self.consumers.values()):
+            if consumer.sock not in self.consumers: continue    # disconnected while waiting for a blocking process before it
+            data = consumer.framer.take()
+            if data: self._enqueue(consumer, data, consumer.framer.anchor_frame)
+
+    def notify(self):
+        """
+        Tells the processes reading the ring that new samples are there. A NOTIFY frame that is still queued isn't repeated.
+        """
+        for consumer in list(self.consumers.values()):
+            if consumer.sock not in self.consumers: continue
+            if consumer.over_ring and not consumer.queue: self._enqueue(consumer, frame(NOTIFY, b""))
+
+    def poll(self, timeout=0):
+        """
+        Accepts new processes, finishes handshakes, notices disconnected processes and sends queued frames, waiting at most timeout seconds for any of it.
+        """
+        self.polling = True
+        try:
+            self._poll(timeout)
+        finally:
+            self.polling = False
+
+    def _poll(self, timeout):
+        for key, events in self.selector.select(timeout):
+            if key.fileobj is self.listener:
+                self._accept()
+            elif key.fileobj in self.pending:
+                self._handshake(key.fileobj)
+            elif key.fileobj in self.consumers:
+                consumer = self.consumers[key.fileobj]
+                if events & selectors.EVENT_READ: self._receive(consumer)
+                if events & selectors.EVENT_WRITE and consumer.sock in self.consumers: self._send(consumer)
+        now_ns = time.monotonic_ns()
+        for sock, (deadline_ns, received) in list(self.pending.items()):
+            if now_ns < deadline_ns: continue
+            try:
+                frames, complete = self._handshake_frames(received)
+            except ValueError:
+                frames, complete = [], True
+            if complete:
+                self._ready(sock, {})   # no HELLO frame, the process gets the plain encoding
+                self._received(self.consumers[sock], frames)
+            elif now_ns >= deadline_ns + int(HANDSHAKE_LIMIT * 1e9):
+                # waiting on, the bytes of a partial name or HELLO can't be handed to the decoder of the process without misaligning its frames
+                error_logger.error(f"A process didn't finish its name or HELLO frame within {HANDSHAKE_LIMIT} s, disconnecting it.")
+                del self.pending[sock]
+                self.selector.unregister(sock)
+                sock.close()
+
+    def report(self):
+        """
+        Logs the counters of every connected process
+        """
+        now_ns = time.monotonic_ns()
+        for consumer in self.consumers.values():
+            common_logger.info(f"{consumer.tag}: {consumer.stats(now_ns)}")
+            if consumer.frames_dropped:
+                common_logger.warning(f"{consumer.tag} didn't take its frames in time, {consumer.frames_dropped} frames ({consumer.bytes_dropped} bytes) dropped so far!")
+
+    def close(self):
+        for sock in list(self.consumers) + list(self.pending):
+            self._disconnect(sock, None)
+        self.selector.close()
+
+    def _accept(self):
+        try:
+            sock, address = self.listener.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        self.pending[sock] = (time.monotonic_ns() + int(self.hello_timeout * 1e9), bytearray())
+        self.selector.register(sock, selectors.EVENT_READ, None)
+
+    def _handshake(self, sock):
+        # the process sends its 4 byte name, optionally followed by a HELLO frame with its options
+        deadline_ns, received = self.pending[sock]
+        try:
+            data = sock.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            del self.pending[sock]
+            self.selector.unregister(sock)
+            sock.close()
+            return
+        received += data
+        if len(received) < 4: return
+        try:
+            frames, complete = self._handshake_frames(received)
+            hellos = [body for kind, body in frames if kind == HELLO]
+            options = json.loads(hellos[0]) if hellos else None
+        except ValueError:
+            frames, options = [], {}
+        else:
+            if hellos and not isinstance(options, dict):
+                # valid json, but no object with options, e.g. [1] or null
+                common_logger.warning(f"A process sent the HELLO {options!r}, which is no json object, it gets the plain encoding.")
+                options = {}
+        if options is not None:
+            self._ready(sock, options)
+            self._received(self.consumers[sock], [(kind, body) for kind, body in frames if kind != HELLO])
+
+    def _handshake_frames(self, received):
+        # the frames after the name and whether the handshake is complete so far: the whole name and no partial frame. Raises ValueError like FrameDecoder
+        decoder = FrameDecoder()
+        frames = decoder.feed(bytes(received[4:]))
+        return frames, len(received) >= 4 and not decoder.buffer
+
+    def _ready(self, sock, options):
+        deadline_ns, received = self.pending.pop(sock)
+        tag = bytes(received[:4]).decode(encoding='UTF-8', errors='replace')
+        policy = options.get('drop_policy', self.policies.get(tag, self.default_policy))
+        if policy not in DROP_POLICIES:
+            common_logger.warning(f"{tag} asked for the unknown drop policy {policy}, using {self.default_policy}.")
+            policy = self.default_policy
+        encoding = COMPACT if options.get('encoding') == COMPACT else PLAIN
+        consumer = Consumer(sock, tag, encoding, self.shared_memory and options.get('transport') == SHARED_MEMORY, policy, self.queue_limit, bool(options.get('sequence')))
+        self.consumers[sock] = consumer
+        common_logger.info(f"{tag} connected, {consumer.encoding} encoding{' over shared memory' if consumer.over_ring else ''}, {policy} when its queue is full!")
+        if 'channels' in options or 'max_rate' in options: self._subscribe(consumer, options)
+        else: self._send_scales(consumer)
+
+    def _send_scales(self, consumer):
+        # the compact encoding needs the volts per raw count of the channels a process gets
+        if consumer.encoding == COMPACT: self._enqueue(consumer, self._scales_frame(consumer))
+
+    def _scales_frame(self, consumer):
+        return meta({channel: scale for channel, scale in self.scales.items() if consumer.channels is None or channel in consumer.channels})
+
+    def _receive(self, consumer):
+        try:
+            data = consumer.sock.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self._disconnect(consumer.sock, e)
+            return
+        if not data:
+            self._disconnect(consumer.sock, None)
+            return
+        try:
+            frames = consumer.decoder.feed(data)
+        except ValueError as e:
+            self._disconnect(consumer.sock, e)
+            return
+        self._received(consumer, frames)
+
+    def _received(self, consumer, frames):
+        for kind, body in frames:
+            if kind != SUBSCRIBE: continue
+            try:
+                request = json.loads(body)
+            except ValueError as e:
+                error_logger.error(f"{consumer.tag} sent an invalid subscription {body}: {e}")
+                continue
+            if not isinstance(request, dict):
+                error_logger.error(f"{consumer.tag} sent the subscription {request!r}, which is no json object.")
+                continue
+            self._subscribe(consumer, request)
+
+    def _subscribe(self, consumer, request):
+        try:
+            consumer.subscribe(request.get('channels'), request.get('max_rate'))
+        except (TypeError, AttributeError, ZeroDivisionError, ValueError, OverflowError) as e:    # e.g. a max_rate of "5", NaN or 1e-320
+            error_logger.error(f"{consumer.tag} sent an invalid subscription {request}: {e}")
+            return
+        common_logger.info(f"{consumer.tag} subscribed to channels {'all' if consumer.channels is None else list(consumer.channels)} at {request.get('max_rate') or 'full'} sps.")
+        self._send_scales(consumer)
+
+    def _enqueue(self, consumer, data, end_anchor=None):
+        # frames that don't fit into the queue are dropped as the policy of the process says, the entry being sent is never dropped
+        # and an empty queue takes any entry.
+        # With the compact encoding an entry may depend on an ANCHOR frame sent in an entry before, so each entry keeps the anchor in effect at
+        # its start (start_anchor) and after it (end_anchor), that way _send can put the anchor in front again if the entry with it got dropped.
+        # The same goes for a dropped META frame, _send puts the scales in front of the next entry then (see _drop).
+        start_anchor = consumer.taken_anchor
+        if end_anchor is None: end_anchor = start_anchor
+        consumer.taken_anchor = end_anchor
+        if consumer.queue and consumer.queued_bytes + len(data) > consumer.queue_limit:
+            if consumer.policy == BLOCK:
+                self._wait_for(consumer, len(data))
+                if consumer.sock not in self.consumers: return
+            elif consumer.policy == DROP_OLDEST:
+                first = 1 if consumer.sent else 0
+                while len(consumer.queue) > first and consumer.queued_bytes + len(data) > consumer.queue_limit:
+                    dropped = consumer.queue[first][3]
+                    del consumer.queue[first]
+                    consumer.queued_bytes -= len(dropped)
+                    self._drop(consumer, dropped)
+            if consumer.queue and consumer.queued_bytes + len(data) > consumer.queue_limit:
+                self._drop(consumer, data)
+                return
+        consumer.queue.append((time.monotonic_ns(), start_anchor, end_anchor, data))
+        consumer.queued_bytes += len(data)
+        self._send(consumer)
+
+    def _drop(self, consumer, data):
+        consumer.frames_dropped += 1
+        consumer.bytes_dropped += len(data)
+        if FRAME_HEADER.unpack_from(data)[1] == META: consumer.scales_dropped = True
+
+    def _wait_for(self, consumer, length):
+        # the block policy: waits until the socket of the process took enough for length more bytes to fit.
+        # It waits in poll(), so the other processes still get what is in their queues, new processes finish their handshakes and subscriptions are taken.
+        # Only a wait started from within poll() (a subscription of a blocking process) waits on the socket of the process alone, one wait at a time is enough.
+        # The sampler doesn't take samples from its workers meanwhile, they wait once their queue is full (see sampler.py).
+        deadline = time.monotonic() + self.block_timeout
+        while consumer.queue and consumer.queued_bytes + length > consumer.queue_limit:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self._disconnect(consumer.sock, f"didn't take its frames for {self.block_timeout} s")
+                return
+            if self.polling:
+                with selectors.DefaultSelector() as waiting:
+                    waiting.register(consumer.sock, selectors.EVENT_WRITE)
+                    waiting.select(remaining)
+                self._send(consumer)
+            else:
+                self.poll(remaining)    # the socket of the process is registered for writing as long as its queue isn't empty
+            if consumer.sock not in self.consumers: return
+
+    def _send(self, consumer):
+        while consumer.queue:
+            enqueued_ns, start_anchor, end_anchor, data = consumer.queue[0]
+            prefix = b""
+            if consumer.sent == 0 and start_anchor != consumer.sent_anchor:
+                # the entry with the anchor these samples count their time from was dropped, so the anchor goes in front of them
+                prefix = start_anchor
+            if consumer.sent == 0 and consumer.scales_dropped:
+                # the scales that were dropped, as they are now, before the samples that need them
+                prefix = self._scales_frame(consumer) + prefix
+            try:
+                sent = consumer.sock.send(memoryview(prefix + data if prefix else data)[consumer.sent:])
+            except BlockingIOError:
+                # nothing went out, the entry stays as it was: it may still be dropped, and the anchor and scales with it
+                break
+            except OSError as e:
+                self._disconnect(consumer.sock, e)
+                return
+            if prefix:
+                # only now the consumer has them, an entry partly sent isn't dropped any more
+                data = prefix + data
+                consumer.queue[0] = (enqueued_ns, start_anchor, end_anchor, data)
+                consumer.queued_bytes += len(prefix)
+                consumer.sent_anchor = start_anchor
+                consumer.scales_dropped = False
+            consumer.sent += sent
+            consumer.bytes_sent += sent
+            consumer.queued_bytes -= sent
+            if consumer.sent < len(data): break
+            consumer.queue.popleft()
+            consumer.sent = 0
+            consumer.sent_anchor = end_anchor
+            consumer.frames_sent += 1
+        self.selector.modify(consumer.sock, selectors.EVENT_READ | (selectors.EVENT_WRITE if consumer.queue else 0), None)
+
+    def _disconnect(self, sock, reason):
+        consumer = self.consumers.pop(sock, None)
+        self.pending.pop(sock, None)
+        if consumer is not None:
+            text = f"{consumer.tag} disconnected" + (f" ({reason})" if reason else "") + f", {consumer.stats(time.monotonic_ns())}"
+            if reason: error_logger.error(text)
+            else: common_logger.info(text)
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+        sock.close()
@@ -0,0 +1,104 @@
+# mhiamqtt.py - a module of the mhia pi application, driving the paho mqtt client from an asyncio event loop
+# Copyright (C) 2023  Iman Ayatollahi, Talwiese IoT Solutions e.U.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio, threading, ssl, logging
+import paho.mqtt.client as mqtt
+
+common_logger = logging.getLogger("standard")
+
+# Instead of loop_start(), which runs the client in a thread of its own, the socket of the client is watched by the event loop: readable calls loop_read(),
+# writable (while paho has something to send) calls loop_write() and a task calls loop_misc() every second for the keepalive. So all callbacks of the client
+# (on_connect, on_message ...) run in the event loop, between the coroutines, and share their data with them without locks.
+# Only connecting (TCP and TLS handshake) blocks, it is done in a thread of the default executor, the socket callbacks of paho are handed over to the loop then.
+
+class AsyncMQTT:
+    def __init__(self, client, loop):
+        self.client = client
+        self.loop = loop
+        self.thread = threading.get_ident()     # of the event loop
+        self.fd = None
+        self.misc = None
+        self.closed = asyncio.Event()
+        client.on_socket_open = lambda client, userdata, sock: self._in_loop(self._open, sock.fileno())
+        client.on_socket_close = lambda client, userdata, sock: self._in_loop(self._close)
+        client.on_socket_register_write = lambda client, userdata, sock: self._in_loop(self._register_write)
+        client.on_socket_unregister_write = lambda client, userdata, sock: self._in_loop(self._unregister_write)
+
+    def _in_loop(self, callback, *args):
+        if threading.get_ident() == self.thread: callback(*args)
+        else: self.loop.call_soon_threadsafe(callback, *args)
+
+    def _open(self, fd):
+        self.fd = fd
+        self.closed.clear()
+        self.loop.add_reader(fd, self.client.loop_read)
+        self.misc = self.loop.create_task(self._misc())
+
+    def _close(self):
+        if self.fd is None: return
+        self.loop.remove_reader(self.fd)
+        self.loop.remove_writer(self.fd)
+        self.fd = None
+        self.misc.cancel()
+        self.closed.set()
+
+    def _register_write(self):
+        if self.fd is not None: self.loop.add_writer(self.fd, self.client.loop_write)
+
+    def _unregister_write(self):
+        if self.fd is not None: self.loop.remove_writer(self.fd)
+
+    async def _misc(self):
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+    async def connect(self, host, port, keepalive=60):
+        """
+        Connects the client in a thread of the executor, raises what client.connect() raises
+        """
+        await self.loop.run_in_executor(None, self.client.connect, host, port, keepalive)
+
+    async def keep_connected(self, host, port, keepalive=60, min_delay=1, max_delay=60):
+        """
+        Connects the client whenever it is not connected, waiting min_delay seconds after losing the connection and twice as long after every
+        failed attempt, up to max_delay. Runs until cancelled, a certificate the broker doesn't accept (ssl.SSLCertVerificationError) is raised though,
+        trying again won't help then.
+        """
+        delay = min_delay
+        while True:
+            if self.fd is not None:
+                await self.closed.wait()
+                delay = min_delay
+                await asyncio.sleep(delay)
+                continue
+            try:
+                await self.connect(host, port, keepalive)
+            except ssl.SSLCertVerificationError:
+                raise
+            except Exception as e:
+                common_logger.warning(f"Could not connect to MQTT broker at {host}:{port} ({e}), trying again in {delay} s.")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, max_delay)
+
+    def close(self):
+        """
+        Sends what paho still has queued as far as the socket takes it without waiting, then disconnects
+        """
+        if self.fd is not None:
+            self.client.disconnect()
+            for attempt in range(1000):
+                if self.fd is None or not self.client.want_write() or self.client.loop_write() != mqtt.MQTT_ERR_SUCCESS: break
+        self._close()
@@ -0,0 +1,133 @@
+# mhiapayload.py - a module of the mhia pi application, decoding the batches of samples and the history published over MQTT
+# Copyright (C) 2023  Iman Ayatollahi, Talwiese IoT Solutions e.U.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Plain python on purpose, no numpy and nothing else of the mhia pi application, subscribers of the batches can copy this file as it is.
+# The publisher builds the batches with mhiabatch.py and the answers to history requests with mhiahistory.py.
+
+import struct, zlib
+
+# Without batching the publisher publishes every sample on its own on live/ch_N, the payload is just the packed sample (see publisher.py).
+# Batched, the samples of a channel (or of all channels) are collected for a while and published together on live/batch/ch_N (or live/batch/all).
+# Every batch payload starts with a BATCH_HEADER: the magic b"MHIB" marks the content type, the flags tell the layout of the body after it,
+# channel is the channel of all records or 0 for a batch of all channels, count is the number of samples. Network byte order.
+BATCH_MAGIC = b"MHIB"
+BATCH_HEADER = struct.Struct('!4sBBH')
+BATCH_COMPACT = 1       # samples are compact: epoch timestamp in ns (int64) and raw count (int32), else channel (int32), timestamp in s (double), volts (double)
+BATCH_SEQUENCE = 2      # each sample comes with the sequence number of the sample in its channel (uint32)
+BATCH_CHANNEL_PREFIX = 4    # each record starts with its channel (uint8), only in packed batches of all channels with compact records
+BATCH_COLUMNAR = 8      # the body is columnar and delta encoded (see below) instead of one packed record after the other
+BATCH_DEFLATE = 16      # the body is compressed with raw deflate (zlib with wbits -15)
+MAX_RECORDS = 0xFFFF
+
+# The columnar body, all numbers are varints (7 bits per byte, least significant first, the high bit set on all bytes but the last), signed ones zig-zag encoded
+# (0, -1, 1, -2, 2 ... as 0, 1, 2, 3, 4 ...): the number of channel groups, then per group the channel, the number of its samples n and its columns of n numbers each:
+# timestamps in ns: the first one, the difference of the first two, then the change of the difference from sample to sample (delta of delta, signed),
+#   samples taken on a regular grid take a single byte each. Timestamps in s of plain batches are rounded to the ns.
+# compact: raw counts, the first one and then the differences (signed)
+# plain: volts, the bits of the double (IEEE 754) XOR the bits of the previous one (the first one XOR 0), unsigned. Close values share sign, exponent and the
+#   high bits of the mantissa, so the XOR is a small number (Gorilla style, but byte aligned).
+# with BATCH_SEQUENCE: the sequence numbers, the first one and then the differences modulo 2^32 (unsigned, 1 for no lost sample)
+# The samples of a channel keep their order, the channels are in ascending order.
+
+def _varints(body, pos, n):
+    numbers = []
+    for k in range(n):
+        number = shift = 0
+        while True:
+            byte = body[pos]
+            pos += 1
+            number |= (byte & 0x7F) << shift
+            if byte < 0x80: break
+            shift += 7
+        numbers.append(number)
+    return numbers, pos
+
+def _unzigzag(number):
+    return (number >> 1) ^ -(number & 1)
+
+def _columnar(body, flags):
+    records = []
+    (groups,), pos = _varints(body, 0, 1)
+    for g in range(groups):
+        (channel, n), pos = _varints(body, pos, 2)
+        column, pos = _varints(body, pos, n)
+        timestamps, delta = [], 0
+        for k, number in enumerate(column):
+            if k == 0: timestamp = _unzigzag(number)
+            else:
+                delta += _unzigzag(number)
+                timestamp += delta
+            timestamps.append(timestamp)
+        column, pos = _varints(body, pos, n)
+        values = []
+        if flags & BATCH_COMPACT:
+            raw = 0
+            for number in column:
+                raw += _unzigzag(number)
+                values.append(raw)
+        else:
+            bits = 0
+            for number in column:
+                bits ^= number
+                values.append(struct.unpack('!d', bits.to_bytes(8, 'big'))[0])
+        if flags & BATCH_SEQUENCE:
+            column, pos = _varints(body, pos, n)
+            seqs, seq = [], 0
+            for number in column:
+                seq = (seq + number) % (1 << 32)
+                seqs.append(seq)
+        if not flags & BATCH_COMPACT: timestamps = [t / 1e9 for t in timestamps]
+        for k in range(n):
+            record = (channel, timestamps[k], values[k])
+            records.append(record + (seqs[k],) if flags & BATCH_SEQUENCE else record)
+    return records
+
+def unpack_batch(payload):
+    """
+    Returns the samples of a batch payload as a list of tuples: (channel, timestamp in s, volts) or compact (channel, timestamp in ns, raw count),
+    with the sequence number appended if the batch carries it. Raises ValueError if the payload is no batch.
+    """
+    magic, flags, channel, count = BATCH_HEADER.unpack_from(payload)
+    if magic != BATCH_MAGIC: raise ValueError("payload is no batch of samples")
+    body = payload[BATCH_HEADER.size:]
+    if flags & BATCH_DEFLATE: body = zlib.decompress(body, -15)
+    if flags & BATCH_COLUMNAR:
+        records = _columnar(body, flags)
+    else:
+        record = '!' + ('B' if flags & BATCH_CHANNEL_PREFIX else '') + ('qi' if flags & BATCH_COMPACT else 'idd') + ('I' if flags & BATCH_SEQUENCE else '')
+        records = list(struct.iter_unpack(record, body))
+        if flags & BATCH_COMPACT and not flags & BATCH_CHANNEL_PREFIX:
+            records = [(channel,) + r for r in records]
+    if len(records) != count: raise ValueError(f"batch says {count} samples, has {len(records)}")
+    return records
+
+# A history request on the topic requests (below the top level topic) is json, e.g. {"history": 3, "seconds": 600, "bucket": 1} for the last 10 minutes
+# of channel 3 in buckets of 1 s. The answer on history/ch_N starts with a HISTORY_HEADER: the magic b"MHIH", the channel, the start of the first bucket
+# (epoch s), the length of the buckets in s (can be longer than requested, see mhiahistory.py) and the number of buckets n. Then come four columns of n each:
+# min, max and mean volts (float32, NaN for empty buckets) and the number of samples (uint32). Network byte order.
+HISTORY_MAGIC = b"MHIH"
+HISTORY_HEADER = struct.Struct('!4sHddI')
+
+def unpack_history(payload):
+    """
+    Returns the channel and a list of the buckets of a history answer: (start in epoch s, min, max, mean, number of samples) each.
+    Raises ValueError if the payload is no history.
+    """
+    magic, channel, start, bucket, n = HISTORY_HEADER.unpack_from(payload)
+    if magic != HISTORY_MAGIC: raise ValueError("payload is no history")
+    if len(payload) != HISTORY_HEADER.size + 16 * n: raise ValueError(f"history says {n} buckets, has {(len(payload) - HISTORY_HEADER.size) / 16:g}")
+    columns = struct.unpack_from(f'!{3 * n}f{n}I', payload, HISTORY_HEADER.size)
+    return channel, [(start + k * bucket, columns[k], columns[n + k], columns[2 * n + k], columns[3 * n + k]) for k in range(n)]
@@ -0,0 +1,140 @@
+# mhiasched.py - a module of the mhia pi application, timing of the sampling
+# Copyright (C) 2023  Iman Ayatollahi, Talwiese IoT Solutions e.U.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import sys, time, bisect, ctypes, ctypes.util
+from itertools import zip_longest
+
+# clock_nanosleep with TIMER_ABSTIME sleeps until an absolute point in time, so time spent before the call doesn't add up.
+# time.monotonic_ns() reads CLOCK_MONOTONIC on linux, the same clock is used here. Other systems fall back to time.sleep().
+class _Timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+_CLOCK_MONOTONIC = 1
+_TIMER_ABSTIME = 1
+_clock_nanosleep = None
+if sys.platform.startswith("linux"):
+    try:
+        _clock_nanosleep = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True).clock_nanosleep
+        _clock_nanosleep.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(_Timespec), ctypes.POINTER(_Timespec)]
+        _clock_nanosleep.restype = ctypes.c_int
+    except (OSError, AttributeError, TypeError):
+        _clock_nanosleep = None
+
+def sleep_until(deadline_ns):
+    """
+    Sleeps until time.monotonic_ns() reaches deadline_ns. Returns False if a signal interrupted the sleep before, so the caller can check its signal flags.
+    """
+    if _clock_nanosleep is not None:
+        timespec = _Timespec(deadline_ns // 1000000000, deadline_ns % 1000000000)
+        return _clock_nanosleep(_CLOCK_MONOTONIC, _TIMER_ABSTIME, ctypes.byref(timespec), None) == 0
+    remaining = deadline_ns - time.monotonic_ns()
+    if remaining > 0: time.sleep(remaining / 1e9)
+    return time.monotonic_ns() >= deadline_ns
+
+class ChannelScheduler:
+    def __init__(self, intervals_ns, start_ns=None, lookahead_ns=0):
+        """
+        Hands out conversions for channels with their own sampling intervals. intervals_ns is a dict with channel as key and interval in ns as value.
+        Each channel has a fixed grid of absolute deadlines (time.monotonic_ns), so its sampling doesn't drift.
+        Channels 1 to 4 are converted on the first chip, channels 5 to 8 on the second chip and so on (9 to 12 on the third chip for a second
+        ADC pair), each chip converts one channel at a time.
+        Per chip the channel with the earliest deadline is chosen (earliest deadline first), on equal deadlines the one with the shorter interval.
+        A channel that is due within lookahead_ns is converted together with a due channel of the other chip, so both share one slot.
+        Slots of a channel that already passed completely when it gets converted are skipped and counted in missed_slots.
+        """
+        start_ns = start_ns if start_ns is not None else time.monotonic_ns()
+        self.intervals_ns = {channel: int(interval) for channel, interval in intervals_ns.items()}
+        self.deadlines = dict.fromkeys(self.intervals_ns, start_ns)
+        self.chips = {}     # chip index (0 for channels 1 to 4, 1 for 5 to 8, ...) as key, its channels as value
+        for channel in sorted(self.intervals_ns):
+            self.chips.setdefault((channel - 1) // 4, []).append(channel)
+        self.lookahead_ns = lookahead_ns
+        self.missed_slots = dict.fromkeys(self.intervals_ns, 0)
+        self.last_skipped = {}
+
+    def utilization(self, conversion_ns):
+        """
+        Returns the share of time each chip is busy converting, as a dict with the chip index as key. conversion_ns is a dict with the conversion time in ns of each channel.
+        A value above 1 means that the requested intervals can't be met.
+        """
+        return {index: sum(conversion_ns[c] / self.intervals_ns[c] for c in chip) for index, chip in self.chips.items()}
+
+    def wait(self, all_due=False):
+        """
+        Sleeps until the earliest deadline and returns a list of (channel, deadline) to convert now, at most one channel per chip.
+        With all_due every due channel is returned, in earliest deadline first order per chip and taking turns between the chips,
+        so they can be converted back to back with read ahead (see ADCPi.iter_sweep).
+        Returns None if the sleep got interrupted by a signal, the conversions are then still pending.
+        """
+        if not sleep_until(min(self.deadlines.values())): return None
+        now = time.monotonic_ns()
+        due_ns = now + self.lookahead_ns   # at least one channel is due at now, the other chip may take one a bit early
+        per_chip = []
+        self.last_skipped = {}
+        for chip in self.chips.values():
+            due = sorted((c for c in chip if self.deadlines[c] <= due_ns), key=lambda c: (self.deadlines[c], self.intervals_ns[c]))
+            if not all_due: due = due[:1]
+            picked = []
+            for channel in due:
+                deadline, interval = self.deadlines[channel], self.intervals_ns[channel]
+                skipped = max(now - deadline, 0) // interval
+                if skipped:
+                    self.last_skipped[channel] = skipped
+                    self.missed_slots[channel] += skipped
+                self.deadlines[channel] = deadline + (skipped + 1) * interval
+                picked.append((channel, deadline))
+            per_chip.append(picked)
+        return [pick for turn in zip_longest(*per_chip) for pick in turn if pick is not None]
+
+class TimingHistogram:
+    # upper edges of the bins in microseconds, one more bin takes everything above the last edge
+    _edges_us = (50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000, 100000)
+
+    def __init__(self):
+        """
+        Histogram of durations in ns with logarithmic bins from 50 us to 100 ms, keeps also count, mean and max.
+        """
+        self._edges_ns = [edge * 1000 for edge in self._edges_us]
+        self.reset()
+
+    def reset(self):
+        self.bins = [0] * (len(self._edges_ns) + 1)
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def add(self, value_ns):
+        self.bins[bisect.bisect_left(self._edges_ns, value_ns)] += 1
+        self.count += 1
+        self.total_ns += value_ns
+        if value_ns > self.max_ns: self.max_ns = value_ns
+
+    def summary(self):
+        """
+        Returns a short text for logging, e.g. "n=1800 mean=0.21ms max=1.90ms [<=0.2ms:1500 <=0.5ms:250 <=2ms:50]", empty bins are left out.
+        """
+        if not self.count: return "n=0"
+        labels = [f"<={edge/1000:g}ms" for edge in self._edges_us] + [f">{self._edges_us[-1]/1000:g}ms"]
+        bins = " ".join(f"{labels[k]}:{n}" for k, n in enumerate(self.bins) if n)
+        return f"n={self.count} mean={self.total_ns/self.count/1e6:.2f}ms max={self.max_ns/1e6:.2f}ms [{bins}]"
+
+    def stats(self):
+        """
+        Returns count, mean and max in ms and the bins as a dict for json, e.g. {"n": 1800, "mean_ms": 0.21, "max_ms": 1.9, "bins": {"<=0.2ms": 1500, ...}}
+        """
+        labels = [f"<={edge/1000:g}ms" for edge in self._edges_us] + [f">{self._edges_us[-1]/1000:g}ms"]
+        return {'n': self.count, 'mean_ms': round(self.total_ns / self.count / 1e6, 3) if self.count else None, 'max_ms': round(self.max_ns / 1e6, 3),
+                'bins': {labels[k]: n for k, n in enumerate(self.bins) if n}}
@@ -0,0 +1,217 @@
+# mhiashm.py - a module of the mhia pi application, ring buffer of samples in shared memory
+# Copyright (C) 2023  Iman Ayatollahi, Talwiese IoT Solutions e.U.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time, struct
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+# The sampler is the only writer, every other process reads at its own pace with a cursor of its own, nobody waits for anybody.
+# The header holds two counters of records: "claimed" is raised before the writer overwrites slots, "committed" after the records are complete.
+# A reader copies the records between its cursor and "committed", then reads "claimed" again: records older than claimed - capacity may have been
+# overwritten during the copy and are dropped. Records a reader didn't fetch in time are lost and counted, the writer never waits for a reader.
+# This relies on the stores of the writer (claimed, the records, committed) becoming visible to a reader in that order, and on the loads of the reader
+# (committed, the records, claimed) not being reordered either. There are no memory barriers in between, the numpy assignments are plain copies.
+# x86 keeps stores in order with stores and loads with loads, so it holds there. A multi-core ARM (the Raspberry Pi) doesn't promise that: a reader
+# could see the new committed before all records of the batch, or miss a raised claimed and keep a record that is being overwritten. The window is
+# a few instructions against a ring of many thousand records, and tests/ringtest.py runs it across processes, but it is an assumption, not a guarantee.
+RING_NAME = "mhia_samples"
+RING_MAGIC = 0x6D686961   # "mhia"
+HEADER_DTYPE = np.dtype([('magic', np.uint64), ('capacity', np.uint64), ('claimed', np.uint64), ('committed', np.uint64)])
+# seq numbers the records in the ring, channel_seq the samples of each channel (as the sampler counts them, see mhiabus.py)
+RECORD_DTYPE = np.dtype([('seq', np.uint64), ('channel', np.uint8), ('monotonic_ns', np.int64), ('timestamp', np.float64),
+                         ('raw', np.int32), ('value', np.float64), ('channel_seq', np.uint32)])
+
+def _create(name, size):
+    # a segment left over from a crashed sampler is replaced
+    try:
+        stale = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        pass
+    else:
+        stale.close()
+        stale.unlink()
+    return shared_memory.SharedMemory(name=name, create=True, size=size)
+
+def _attach(name):
+    shm = shared_memory.SharedMemory(name=name)
+    # the sampler owns the segment, without this the resource tracker of python < 3.13 would remove it when this process ends
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+def _views(buf, capacity):
+    header = np.ndarray((1,), dtype=HEADER_DTYPE, buffer=buf)
+    records = np.ndarray((capacity,), dtype=RECORD_DTYPE, buffer=buf, offset=HEADER_DTYPE.itemsize)
+    return header, records
+
+class SampleRing:
+    def __init__(self, capacity, name=RING_NAME):
+        """
+        Creates the ring for capacity records in shared memory, a ring left over from a crashed sampler is replaced.
+        """
+        self.capacity = int(capacity)
+        self.shm = _create(name, HEADER_DTYPE.itemsize + self.capacity * RECORD_DTYPE.itemsize)
+        self.header, self.records = _views(self.shm.buf, self.capacity)
+        self.header[0] = (RING_MAGIC, self.capacity, 0, 0)
+
+    def write(self, samples):
+        """
+        Appends samples, a list of (channel, monotonic_ns, timestamp, raw, value, channel_seq). Returns the sequence number after the last one written.
+        """
+        if not samples: return int(self.header['committed'][0])
+        batch = np.array([(0,) + sample for sample in samples[-self.capacity:]], dtype=RECORD_DTYPE)
+        start = int(self.header['committed'][0]) + len(samples) - len(batch)
+        end = start + len(batch)
+        batch['seq'] = np.arange(start, end, dtype=np.uint64)
+        self.header['claimed'] = end
+        first = start % self.capacity
+        split = min(len(batch), self.capacity - first)
+        self.records[first:first + split] = batch[:split]
+        self.records[:len(batch) - split] = batch[split:]
+        self.header['committed'] = end
+        return end
+
+    def close(self):
+        del self.header, self.records
+        self.shm.close()
+        self.shm.unlink()
+
+class SampleRingReader:
+    def __init__(self, name=RING_NAME, from_start=False):
+        """
+        Attaches to the ring of the sampler, raises FileNotFoundError if there is none. Reading starts with the next record written,
+        or with the oldest one still in the ring if from_start.
+        """
+        self.shm = _attach(name)
+        capacity = int(np.ndarray((1,), dtype=HEADER_DTYPE, buffer=self.shm.buf)['capacity'][0])
+        self.header, self.records = _views(self.shm.buf, capacity)
+        if int(self.header['magic'][0]) != RING_MAGIC:
+            raise ValueError(f"shared memory {name} is no sample ring")
+        self.capacity = capacity
+        committed = int(self.header['committed'][0])
+        self.cursor = max(committed - capacity, 0) if from_start else committed
+        self.lost = 0   # records overwritten before this reader fetched them
+
+    def read(self, limit=None):
+        """
+        Returns the records written since the last call as a numpy array of RECORD_DTYPE (a copy), at most limit records (the oldest ones).
+        Records that were overwritten before they could be read are skipped and counted in lost.
+        """
+        committed = int(self.header['committed'][0])
+        if committed - self.cursor > self.capacity:
+            self.lost += committed - self.capacity - self.cursor
+            self.cursor = committed - self.capacity
+        end = committed if limit is None else min(committed, self.cursor + limit)
+        if end <= self.cursor: return self.records[:0].copy()
+        first, last = self.cursor % self.capacity, (end - 1) % self.capacity + 1
+        if first < last:
+            batch = self.records[first:last].copy()
+        else:
+            batch = np.concatenate((self.records[first:], self.records[:last]))
+        # the writer may have claimed slots of this batch meanwhile
+        oldest_intact = int(self.header['claimed'][0]) - self.capacity
+        if oldest_intact > self.cursor:
+            torn = min(oldest_intact, end) - self.cursor
+            self.lost += torn
+            batch = batch[torn:]
+        self.cursor = end
+        return batch
+
+    def close(self):
+        del self.header, self.records
+        self.shm.close()
+
+# The latest sample of every channel in a table of fixed slots, the slot of channel i is at LATEST_HEADER.size + i * LATEST_SLOT.size.
+# Each slot is guarded by a seqlock: the writer makes the counter odd, writes the sample and makes it even again. A reader copies the slot and
+# takes the copy if the counter was even and unchanged before and after, otherwise the writer was busy and it tries again. So reading costs the
+# same whatever the rate of sampling, no process has to follow the stream or connect to the sampler for it.
+# The seqlock relies on the writes of the writer becoming visible to the reader in the order they are made: each pack_into is one copy under the GIL,
+# and there are no memory barriers in between. That holds on x86, which doesn't reorder stores with stores nor loads with loads. On a multi-core ARM
+# (the Raspberry Pi) the hardware may reorder them, and a reader may then take a torn sample whose counter looked unchanged. This is rare, because a
+# reader copies the 40 bytes of a slot in one go, but it isn't ruled out. Python has no portable fence, a C extension would be needed for one.
+LATEST_NAME = "mhia_latest"
+LATEST_HEADER = struct.Struct('=QQ')        # magic, number of slots (highest channel + 1)
+LATEST_COUNTER = struct.Struct('=Q')
+LATEST_SLOT = struct.Struct('=QIqdid')      # seqlock counter, channel_seq, monotonic_ns, timestamp, raw, value
+LATEST_SAMPLE = struct.Struct('=Iqdid')     # the slot without the counter
+LATEST_MAGIC = 0x6D6869616C    # "mhial"
+
+class LatestValues:
+    def __init__(self, channels, name=LATEST_NAME):
+        """
+        Creates the table in shared memory for channels 1 to channels
+        """
+        self.slots = int(channels) + 1
+        self.shm = _create(name, LATEST_HEADER.size + self.slots * LATEST_SLOT.size)
+        self.buf = self.shm.buf
+        LATEST_HEADER.pack_into(self.buf, 0, LATEST_MAGIC, self.slots)
+        self.counters = [0] * self.slots
+
+    def write(self, channel, monotonic_ns, timestamp, raw, value, seq):
+        offset = LATEST_HEADER.size + channel * LATEST_SLOT.size
+        counter = self.counters[channel]
+        LATEST_COUNTER.pack_into(self.buf, offset, counter + 1)   # odd: being written
+        LATEST_SAMPLE.pack_into(self.buf, offset + LATEST_COUNTER.size, seq, monotonic_ns, timestamp, raw, value)
+        LATEST_COUNTER.pack_into(self.buf, offset, counter + 2)
+        self.counters[channel] = counter + 2
+
+    def close(self):
+        self.buf.release()
+        self.shm.close()
+        self.shm.unlink()
+
+class LatestValuesReader:
+    def __init__(self, name=LATEST_NAME):
+        """
+        Attaches to the table of the sampler, raises FileNotFoundError if there is none
+        """
+        self.shm = _attach(name)
+        self.buf = self.shm.buf
+        magic, self.slots = LATEST_HEADER.unpack_from(self.buf, 0)
+        if magic != LATEST_MAGIC:
+            raise ValueError(f"shared memory {name} is no table of latest values")
+
+    def read(self, channel, timeout=1.0):
+        """
+        Returns the latest sample of channel as (channel_seq, monotonic_ns, timestamp, raw, value), None if the channel has no sample (yet).
+        Raises TimeoutError if the writer stays busy for timeout seconds, it died while writing then.
+        """
+        if not 0 < channel < self.slots: return None
+        offset = LATEST_HEADER.size + channel * LATEST_SLOT.size
+        busy, deadline, tries = None, None, 0
+        while True:
+            counter, *sample = LATEST_SLOT.unpack_from(self.buf, offset)
+            if counter % 2 == 0 and LATEST_COUNTER.unpack_from(self.buf, offset)[0] == counter:
+                return tuple(sample) if counter else None
+            # a writer that keeps writing changes the counter, only the same odd counter for timeout seconds means it got stuck
+            if counter != busy: busy, deadline = counter, time.monotonic() + timeout
+            elif time.monotonic() > deadline: raise TimeoutError(f"latest value of channel {channel} is being written for {timeout} s")
+            # the writer needs the CPU to finish, so yield it instead of spinning, and back off to 1 ms sleeps if the writer got descheduled
+            tries += 1
+            time.sleep(0 if tries < 16 else 0.001)
+
+    def snapshot(self):
+        """
+        Returns the latest samples of all channels that have one, as a dict with the channel as key and the tuple of read() as value
+        """
+        latest = {}
+        for channel in range(1, self.slots):
+            sample = self.read(channel)
+            if sample is not None: latest[channel] = sample
+        return latest
+
+    def close(self):
+        self.buf.release()
+        self.shm.close()
@@ -0,0 +1,261 @@
+# mhiasinks.py - a module of the mhia pi application, further destinations of the samples besides the MQTT broker
+# Copyright (C) 2023  Iman Ayatollahi, Talwiese IoT Solutions e.U.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio, collections, json, logging, os, ssl, time, urllib.parse
+from modules.inhouse.mhiasched import TimingHistogram
+
+common_logger = logging.getLogger("standard")
+error_logger = logging.getLogger("error")
+
+# Every sink is a task of its own in the event loop of the publisher with a queue of its own. offer() just appends the samples to the queue, so a slow
+# or unreachable sink never holds up the MQTT client or the other sinks, it only fills its own queue (the oldest samples are dropped beyond queue_limit).
+# The task takes up to batch_size samples at a time, at the latest batch_window seconds after the last batch, and writes them. A batch that fails is
+# tried again up to retries times, waiting retry_delay seconds and twice as long after every failure, it is dropped after that.
+# A new kind of sink subclasses Sink and implements write(batch) as a coroutine that raises on failure, and close() if it holds a connection or file.
+
+# types of sinks in config
+INFLUX = "influx"   # InfluxDB line protocol, POSTed to the write endpoint of InfluxDB (v1 /write?db=... or v2 /api/v2/write?org=...&bucket=...)
+HTTP = "http"       # ndjson, one sample per line, POSTed to a collector
+FILE = "file"       # a local file, csv or ndjson
+
+# formats of file sinks
+CSV = "csv"
+NDJSON = "ndjson"
+
+class SinkError(Exception):
+    pass
+
+class Sink:
+    def __init__(self, name, batch_size=500, batch_window=1.0, queue_limit=100000, retries=5, retry_delay=1.0):
+        """
+        The queue and the batching of a sink, write() is up to the subclass. Samples are queued as (channel, epoch timestamp in s, volts, seq).
+        """
+        self.name = name
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.queue_limit = queue_limit
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.queue = collections.deque()    # (channel, timestamp, value, seq, time.monotonic_ns() of offer())
+        self.wakeup = asyncio.Event()
+        self.latency = TimingHistogram()    # from offer() until the batch of the sample was written
+        self.written = 0        # samples
+        self.batches = 0
+        self.failures = 0       # failed attempts
+        self.dropped = 0        # samples dropped because of a full queue or a batch that failed retries + 1 times
+        self.max_depth = 0      # most samples in the queue since the last stats()
+        self.counted = (time.monotonic(), 0)    # time and written of the last stats(), for the rate
+
+    def offer(self, samples):
+        """
+        Queues samples (channel, timestamp, raw, scale, seq) as they come from the sampler, the value is raw * scale
+        """
+        now = time.monotonic_ns()
+        self.queue.extend((channel, timestamp, raw * scale, seq, now) for channel, timestamp, raw, scale, seq in samples)
+        excess = len(self.queue) - self.queue_limit
+        if excess > 0:
+            for k in range(excess): self.queue.popleft()
+            self.dropped += excess
+        if len(self.queue) > self.max_depth: self.max_depth = len(self.queue)
+        if len(self.queue) >= self.batch_size: self.wakeup.set()
+
+    async def run(self):
+        """
+        Writes the queued samples in batches until cancelled
+        """
+        while True:
+            if len(self.queue) < self.batch_size:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), self.batch_window)
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+            if self.queue: await self._deliver(self._take(), self.retries)
+
+    def _take(self):
+        return [self.queue.popleft() for k in range(min(self.batch_size, len(self.queue)))]
+
+    async def _deliver(self, batch, retries):
+        delay = self.retry_delay
+        for attempt in range(retries + 1):
+            try:
+                await self.write([sample[:4] for sample in batch])
+            except Exception as e:     # whatever goes wrong in a sink, the other sinks and the publisher go on
+                self.failures += 1
+                if attempt == retries:
+                    error_logger.error(f"Sink {self.name} dropped {len(batch)} samples after {attempt + 1} failed attempts, last one: {e!r}")
+                    self.dropped += len(batch)
+                    return
+                if attempt == 0: common_logger.warning(f"Sink {self.name} could not write {len(batch)} samples ({e!r}), trying again in {delay} s.")
+                await asyncio.sleep(delay)
+                delay *= 2
+            else:
+                now = time.monotonic_ns()
+                self.latency.add(now - batch[0][4])     # the oldest sample of the batch
+                self.written += len(batch)
+                self.batches += 1
+                return
+
+    async def flush(self):
+        """
+        Writes what is still queued, trying each batch once, for stopping. The task of run() has to be cancelled before.
+        """
+        while self.queue:
+            await self._deliver(self._take(), 0)
+
+    async def write(self, batch):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+    def stats(self):
+        """
+        Returns the counters of the sink as a dict (for json), rate is the samples written per second since the last stats(). The maximum queue depth and
+        the latency start anew.
+        """
+        now = time.monotonic()
+        rate = (self.written - self.counted[1]) / (now - self.counted[0]) if now > self.counted[0] else 0.0
+        stats = {'queue_depth': len(self.queue), 'max_queue_depth': self.max_depth, 'written': self.written, 'rate': round(rate, 1), 'batches': self.batches,
+                 'failures': self.failures, 'dropped': self.dropped, 'latency': self.latency.stats()}
+        self.counted = (now, self.written)
+        self.max_depth = len(self.queue)
+        self.latency.reset()
+        return stats
+
+class HTTPSink(Sink):
+    content_type = "application/x-ndjson"
+
+    def __init__(self, name, url, headers=None, timeout=10.0, **options):
+        """
+        POSTs every batch to url (http or https) over a connection that is kept open, the answer has to be a 2xx status. headers is a dict of further headers.
+        """
+        super().__init__(name, **options)
+        self.url = urllib.parse.urlsplit(url)
+        if self.url.scheme not in ("http", "https"): raise ValueError(f"sink {name}: url has to be http or https, not {url}")
+        self.host = self.url.hostname
+        self.port = self.url.port or (443 if self.url.scheme == "https" else 80)
+        self.target = (self.url.path or "/") + (f"?{self.url.query}" if self.url.query else "")
+        self.headers = "".join(f"{key}: {value}\r\n" for key, value in (headers or {}).items())
+        self.timeout = timeout
+        self.reader, self.writer = None, None
+
+    def body(self, batch):
+        return "".join(json.dumps({'channel': channel, 'timestamp': timestamp, 'value': value, 'seq': seq}) + "\n" for channel, timestamp, value, seq in batch)
+
+    async def write(self, batch):
+        try:
+            await asyncio.wait_for(self._post(self.body(batch).encode()), self.timeout)
+        except BaseException:
+            await self.close()      # the state of the connection is unknown, the next attempt connects anew
+            raise
+
+    async def _post(self, body):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port, ssl=ssl.create_default_context() if self.url.scheme == "https" else None)
+        self.writer.write((f"POST {self.target} HTTP/1.1\r\nHost: {self.url.netloc}\r\nContent-Type: {self.content_type}\r\n"
+                           f"Content-Length: {len(body)}\r\n{self.headers}\r\n").encode() + body)
+        await self.writer.drain()
+        status_line = await self.reader.readline()
+        if not status_line: raise ConnectionError("connection closed by the server")
+        status = int(status_line.split()[1])
+        length, chunked, close = 0, False, False
+        while True:
+            line = (await self.reader.readline()).decode("latin-1").strip().lower()
+            if not line: break
+            key, value = line.split(":", 1)
+            value = value.strip()
+            if key == "content-length": length = int(value)
+            elif key == "transfer-encoding": chunked = "chunked" in value
+            elif key == "connection": close = value == "close"
+        if chunked:
+            while True:
+                size = int((await self.reader.readline()).split(b";")[0], 16)
+                await self.reader.readexactly(size + 2)
+                if size == 0: break
+        elif length:
+            await self.reader.readexactly(length)
+        if close: await self.close()
+        if not 200 <= status < 300: raise SinkError(f"HTTP status {status}")
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader, self.writer = None, None
+
+class InfluxSink(HTTPSink):
+    content_type = "text/plain; charset=utf-8"
+
+    def __init__(self, name, url, token=None, measurement="mhia", tags=None, **options):
+        """
+        Writes to InfluxDB, url is the whole write endpoint with precision=ns, e.g. http://localhost:8086/api/v2/write?org=mhia&bucket=mhia&precision=ns,
+        token for the Authorization header. Each sample is a point of measurement with the tag channel and the tags in the dict tags, the field value
+        (volts) and the field seq.
+        """
+        headers = dict(options.pop('headers', None) or {})
+        if token: headers['Authorization'] = f"Token {token}"
+        super().__init__(name, url, headers=headers, **options)
+        escape = lambda text: str(text).replace(",", r"\,").replace("=", r"\=").replace(" ", r"\ ")
+        self.prefix = escape(measurement) + "".join(f",{escape(key)}={escape(value)}" for key, value in sorted((tags or {}).items()))
+
+    def body(self, batch):
+        return "".join(f"{self.prefix},channel={channel} value={value!r},seq={seq}i {round(timestamp * 1e9)}\n" for channel, timestamp, value, seq in batch)
+
+class FileSink(Sink):
+    def __init__(self, name, path, format=NDJSON, **options):
+        """
+        Appends the samples to the file at path, as ndjson or as csv with a header line in a new file. The file is written in a thread of the executor.
+        """
+        super().__init__(name, **options)
+        if format not in (CSV, NDJSON): raise ValueError(f"sink {name}: unknown format {format}, {CSV} or {NDJSON}")
+        self.path = path
+        self.format = format
+        self.file = None
+
+    def _append(self, text):
+        if self.file is None:
+            new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+            self.file = open(self.path, "a", encoding="utf-8")
+            if new and self.format == CSV: self.file.write("channel,timestamp,value,seq\n")
+        self.file.write(text)
+        self.file.flush()
+
+    async def write(self, batch):
+        if self.format == CSV:
+            text = "".join(f"{channel},{timestamp!r},{value!r},{seq}\n" for channel, timestamp, value, seq in batch)
+        else:
+            text = "".join(json.dumps({'channel': channel, 'timestamp': timestamp, 'value': value, 'seq': seq}) + "\n" for channel, timestamp, value, seq in batch)
+        await asyncio.get_running_loop().run_in_executor(None, self._append, text)
+
+    async def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+SINK_TYPES = {INFLUX: InfluxSink, HTTP: HTTPSink, FILE: FileSink}
+
+def make_sink(config):
+    """
+    Returns the sink for one entry of sinks in config: type, name (the type if left out) and the options of the sink class, raises ValueError
+    """
+    options = dict(config)
+    kind = options.pop('type', None)
+    if kind not in SINK_TYPES: raise ValueError(f"unknown sink type {kind}, one of {', '.join(SINK_TYPES)}")
+    name = options.pop('name', None) or kind
+    try:
+        return SINK_TYPES[kind](name, **options)
+    except TypeError as e:
+        raise ValueError(f"sink {name}: {e}")
@@ -0,0 +1,307 @@
+# mhiaspool.py - a module of the mhia pi application, spooling MQTT messages on disk while the broker is unreachable
+# Copyright (C) 2023  Iman Ayatollahi, Talwiese IoT Solutions e.U.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os, struct, zlib, mmap, time, threading, collections, logging
+import paho.mqtt.client as mqtt
+
+from modules.inhouse.mhiasched import TimingHistogram
+from modules.inhouse.mhiahub import DROP_OLDEST, DROP_NEWEST
+
+common_logger = logging.getLogger("standard")
+error_logger = logging.getLogger("error")
+
+# The spool is a directory of segment files named by their number (00000001.seg, 00000002.seg ...), messages are only ever appended to the newest one.
+# A segment is closed when it has reached segment_bytes, replaying maps the oldest one into memory and deletes it when all its messages are sent.
+# Every message is a RECORD_HEADER followed by the topic (utf-8) and the payload. The header holds the crc32 of everything after the crc, so a message
+# torn by a crash or power loss is recognized, replay goes on with the next segment then. The file "cursor" holds the number of the oldest segment and the
+# offset of the next message to replay in it, it is saved every CURSOR_INTERVAL messages and on close, so after a crash some messages may be sent twice.
+RECORD_HEADER = struct.Struct('!IIBH')  # crc32, length of the payload, flags (qos in bit 0 and 1, retain in bit 7), length of the topic
+CURSOR = struct.Struct('!QQ')
+CURSOR_INTERVAL = 64
+RETAIN = 0x80
+
+# what StoreAndForward does with a message when its queue is full, see there
+SPOOL = "spool"
+OVERFLOW_POLICIES = (SPOOL, DROP_OLDEST, DROP_NEWEST)
+
+class Spool:
+    def __init__(self, directory, segment_bytes=1 << 20, max_bytes=64 << 20):
+        """
+        Opens the spool in directory (created if missing), with the messages left over from earlier runs still to replay.
+        At most max_bytes are kept on disk, if there are more the oldest segments are deleted and their messages counted in dropped.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = min(segment_bytes, max_bytes // 4)    # so deleting the oldest segment frees a good part of the budget
+        os.makedirs(directory, exist_ok=True)
+        self.segments = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith(".seg"))
+        self.sizes = {number: os.path.getsize(self._path(number)) for number in self.segments}
+        self.map = None         # the oldest segment mapped into memory for replay
+        self.writer = None      # the newest segment, open for appending. A new one is started for every run, a torn message may end the last one.
+        self.segment, self.offset = 0, 0     # where replay goes on
+        try:
+            with open(os.path.join(directory, "cursor"), "rb") as f:
+                self.segment, self.offset = CURSOR.unpack(f.read(CURSOR.size))
+        except (FileNotFoundError, struct.error):
+            pass
+        for number in [number for number in self.segments if number < self.segment or self.sizes[number] == 0]:
+            self._delete(number)
+        if not self.segments or self.segments[0] != self.segment: self.segment, self.offset = (self.segments[0] if self.segments else self.segment), 0
+        self.written = 0        # messages appended in this run
+        self.replayed = 0       # messages handed back by next() in this run
+        self.dropped = 0        # messages deleted unsent because of max_bytes
+        self.unsaved = 0        # messages replayed since the cursor was saved
+        self.length = None      # of the message returned by next()
+
+    def _path(self, number):
+        return os.path.join(self.directory, f"{number:08d}.seg")
+
+    @property
+    def bytes(self):
+        return sum(self.sizes.values())
+
+    def empty(self):
+        """
+        True if there are no messages left to replay
+        """
+        return all(self.sizes[number] <= (self.offset if number == self.segment else 0) for number in self.segments)
+
+    def append(self, topic, payload, qos=0, retain=False):
+        if self.writer is None or self.writer.tell() >= self.segment_bytes: self._roll()
+        topic = topic.encode()
+        if isinstance(payload, str): payload = payload.encode()   # paho takes both
+        rest = RECORD_HEADER.pack(0, len(payload), qos | (RETAIN if retain else 0), len(topic))[4:] + topic + payload
+        # written through to the OS right away, lost only on power loss (then the crc tells), not if this process crashes
+        self.writer.write(struct.pack('!I', zlib.crc32(rest)) + rest)
+        self.writer.flush()
+        self.sizes[self.segments[-1]] += 4 + len(rest)
+        self.written += 1
+        while self.bytes > self.max_bytes and len(self.segments) > 1:
+            number = self.segments[0]
+            self.dropped += self._count(number)
+            common_logger.warning(f"Spool is over {self.max_bytes} bytes, deleted segment {number} with messages that were never sent!")
+            self._delete(number)
+
+    def next(self):
+        """
+        Returns the oldest message not replayed yet as (topic, payload, qos, retain), None if there is none. It stays the oldest until advance() is called.
+        """
+        while not self.empty():
+            if self.map is None:
+                if self.segment not in self.sizes: self.segment, self.offset = self.segments[0], 0
+                if self.offset >= self.sizes[self.segment]:
+                    self._delete(self.segment)
+                    continue
+                if self.writer is not None and self.segment == self.segments[-1]: self._roll()    # only closed segments are replayed
+                with open(self._path(self.segment), "rb") as f:
+                    self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            message = self._message(self.offset)
+            if message is not None:
+                self.length = message[4]
+                return message[:4]
+            if self.offset < len(self.map):
+                error_logger.error(f"Spool segment {self.segment} is damaged at byte {self.offset}, skipping its {len(self.map) - self.offset} bytes left!")
+            self._delete(self.segment)
+        return None
+
+    def advance(self):
+        """
+        Marks the message returned by next() as sent
+        """
+        self.offset += self.length
+        self.length = None
+        self.replayed += 1
+        self.unsaved += 1
+        if self.offset >= len(self.map): self._delete(self.segment)   # saves the cursor too
+        elif self.unsaved >= CURSOR_INTERVAL: self._save()
+
+    def close(self):
+        if self.map is not None: self.map.close()
+        if self.writer is not None: self.writer.close()
+        self.map = self.writer = None
+        self._save()
+
+    def _message(self, offset):
+        # the message at offset in the mapped segment and its length, None at the end of the segment or if it is torn
+        if offset + RECORD_HEADER.size > len(self.map): return None
+        crc, length, flags, topic_length = RECORD_HEADER.unpack_from(self.map, offset)
+        end = offset + RECORD_HEADER.size + topic_length + length
+        if end > len(self.map) or zlib.crc32(self.map[offset + 4:end]) != crc: return None
+        topic = self.map[offset + RECORD_HEADER.size:offset + RECORD_HEADER.size + topic_length].decode()
+        return topic, self.map[end - length:end], flags & 3, bool(flags & RETAIN), end - offset
+
+    def _count(self, number):
+        with open(self._path(number), "rb") as f:
+            data = f.read()
+        count, offset = 0, self.offset if number == self.segment else 0
+        while offset + RECORD_HEADER.size <= len(data):
+            crc, length, flags, topic_length = RECORD_HEADER.unpack_from(data, offset)
+            offset += RECORD_HEADER.size + topic_length + length
+            count += 1
+        return count
+
+    def _roll(self):
+        if self.writer is not None:
+            os.fsync(self.writer.fileno())
+            self.writer.close()
+        number = self.segments[-1] + 1 if self.segments else max(self.segment, 1)
+        self.writer = open(self._path(number), "ab")
+        self.segments.append(number)
+        self.sizes[number] = 0
+
+    def _delete(self, number):
+        if number == self.segment and self.map is not None:
+            self.map.close()
+            self.map = None
+        if number == self.segments[-1] and self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        os.remove(self._path(number))
+        self.segments.remove(number)
+        del self.sizes[number]
+        if number == self.segment:
+            self.segment, self.offset = (self.segments[0], 0) if self.segments else (number + 1, 0)
+            self._save()
+
+    def _save(self):
+        path = os.path.join(self.directory, "cursor")
+        with open(path + ".new", "wb") as f:
+            f.write(CURSOR.pack(self.segment, self.offset))
+        os.replace(path + ".new", path)
+        self.unsaved = 0
+
+class StoreAndForward:
+    def __init__(self, client, spool, replay_rate, queue_limit=1000, window=20, overflow=SPOOL):
+        """
+        The way of all messages to the broker. publish() puts a message into a queue of at most queue_limit messages, it is handed to the paho client from there
+        as long as fewer than window messages are in flight, that is handed to the client and not yet sent (qos 0) or acknowledged by the broker (qos 1 and 2).
+        If the queue is full, overflow decides: SPOOL puts the new message into the spool, DROP_OLDEST drops the oldest one in the queue, DROP_NEWEST the new one.
+        While the broker is not connected messages go straight into the spool. Spooled messages are replayed in order by replay() at up to replay_rate messages
+        per second whenever the queue is empty, so new messages keep going out while catching up.
+        connected has to be set in on_connect, disconnected() and published() have to be called from on_disconnect and on_publish of the client.
+        """
+        self.client = client
+        self.spool = spool
+        self.replay_rate = replay_rate
+        self.queue_limit = queue_limit
+        self.window = window
+        self.overflow = overflow
+        self.connected = threading.Event()
+        self.lock = threading.RLock()   # with loop_start() on_publish comes from the thread of the client, without a loop it comes from within client.publish()
+        self.queue = collections.deque()    # (topic, payload, qos, retain, time.monotonic_ns() of publish())
+        self.inflight = {}                  # mid -> (qos, time.monotonic_ns() of publish())
+        self.early = set()                  # mids whose on_publish came before client.publish() returned
+        self.allowance = 0.0
+        self.replayed_at = time.monotonic()
+        self.latency = TimingHistogram()    # from publish() until the message was sent (qos 0) or acknowledged
+        self.max_depth = 0      # most messages in the queue since the last stats()
+        self.dropped = 0        # messages dropped because of a full queue with DROP_OLDEST or DROP_NEWEST
+        self.overflowed = 0     # messages spooled because of a full queue with SPOOL
+        self.lost = 0           # qos 0 messages that were in flight when the connection was lost
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        with self.lock:
+            if not self.connected.is_set():
+                self.spool.append(topic, payload, qos, retain)
+                return
+            if len(self.queue) >= self.queue_limit:
+                if self.overflow == DROP_NEWEST:
+                    self.dropped += 1
+                    return
+                if self.overflow == DROP_OLDEST:
+                    self.queue.popleft()
+                    self.dropped += 1
+                else:
+                    self.spool.append(topic, payload, qos, retain)
+                    self.overflowed += 1
+                    return
+            self.queue.append((topic, payload, qos, retain, time.monotonic_ns()))
+            if len(self.queue) > self.max_depth: self.max_depth = len(self.queue)
+            self.pump()
+
+    def full(self):
+        return len(self.queue) >= self.queue_limit
+
+    def pump(self):
+        """
+        Hands queued messages to the client while the window has room
+        """
+        with self.lock:
+            while self.queue and len(self.inflight) < self.window and self.connected.is_set():
+                topic, payload, qos, retain, queued_ns = self.queue[0]
+                info = self.client.publish(topic, payload, qos=qos, retain=retain)
+                if info.rc != mqtt.MQTT_ERR_SUCCESS: break  # the message stays queued, e.g. the connection was lost just now
+                self.queue.popleft()
+                if info.mid in self.early:
+                    self.early.discard(info.mid)
+                    self.latency.add(time.monotonic_ns() - queued_ns)
+                else:
+                    self.inflight[info.mid] = (qos, queued_ns)
+
+    def published(self, mid):
+        with self.lock:
+            entry = self.inflight.pop(mid, None)
+            if entry is None:
+                self.early.add(mid)
+                return
+            self.latency.add(time.monotonic_ns() - entry[1])
+            if self.queue: self.pump()
+
+    def disconnected(self):
+        with self.lock:
+            self.connected.clear()
+            # paho sends qos 1 and 2 messages again after reconnecting, qos 0 messages not sent yet are gone
+            for mid in [mid for mid, (qos, queued_ns) in self.inflight.items() if qos == 0]:
+                del self.inflight[mid]
+                self.lost += 1
+            self.early.clear()
+            # the queue is spooled, replay keeps the order
+            while self.queue:
+                self.spool.append(*self.queue.popleft()[:4])
+
+    def replay(self):
+        """
+        Replays as many spooled messages as the replay rate allows since the last call, returns the number of messages replayed
+        """
+        now = time.monotonic()
+        self.allowance = min(self.allowance + (now - self.replayed_at) * self.replay_rate, self.replay_rate)    # a burst of at most one second of messages
+        self.replayed_at = now
+        replayed = 0
+        with self.lock:
+            while self.allowance >= 1 and self.connected.is_set() and not self.queue and len(self.inflight) < self.window:
+                message = self.spool.next()
+                if message is None: break
+                topic, payload, qos, retain = message
+                info = self.client.publish(topic, payload, qos=qos, retain=retain)
+                if info.rc != mqtt.MQTT_ERR_SUCCESS: break
+                self.spool.advance()
+                if info.mid in self.early: self.early.discard(info.mid)
+                else: self.inflight[info.mid] = (qos, time.monotonic_ns())
+                self.allowance -= 1
+                replayed += 1
+        return replayed
+
+    def stats(self):
+        """
+        Returns the counters of the pipeline and the spool as a dict (for json), the maximum queue depth and the latency start anew
+        """
+        with self.lock:
+            stats = {'queue_depth': len(self.queue), 'max_queue_depth': self.max_depth, 'inflight': len(self.inflight),
+                     'latency': self.latency.stats(), 'dropped': self.dropped, 'overflowed': self.overflowed, 'lost': self.lost,
+                     'spool': {'spooled': self.spool.written, 'replayed': self.spool.replayed, 'dropped': self.spool.dropped, 'bytes': self.spool.bytes}}
+            self.max_depth = len(self.queue)
+            self.latency.reset()
+        return stats
@@ -10,8 +10,9 @@ Requires smbus2 or python smbus to be installed
 from __future__ import absolute_import, division, print_function, \
                                                     unicode_literals
 try:
-    from smbus2 import SMBus
+    from smbus2 import SMBus, i2c_msg
 except ImportError:
+    i2c_msg = None  # no combined transactions with python smbus
     try:
         from smbus import SMBus
     except ImportError:
@@ -19,6 +20,14 @@ except ImportError:
 import re
 import platform
 import time
+from collections import deque
+import numpy as np
+
+
+# record layout returned by ADCPi.read_sweep, one row per converted channel
+SWEEP_DTYPE = np.dtype([('channel', np.uint8), ('raw', np.int32),
+                        ('voltage', np.float64), ('timestamp', np.float64),
+                        ('monotonic_ns', np.int64)])
 
 
 class Error(Exception):
@@ -45,10 +54,40 @@ class ADCPi(object):
     __adc1_channel = 0x01
     __adc2_channel = 0x01
 
-    __bitrate = 18  # current bitrate
+    # shadow of the config byte last written to each chip, None if unknown
+    __adc1_shadow = None
+    __adc2_shadow = None
+
+    # i2c transaction counters
+    __i2c_writes = 0
+    __i2c_reads = 0
+    __i2c_writes_skipped = 0
+    __i2c_combined = 0
+    __i2c_combined_misses = 0
+
+    # use combined I2C_RDWR transactions, needs smbus2
+    __rdwr = False
+
+    # when the running conversion of each chip was started (time.monotonic)
+    __adc1_started = 0.0
+    __adc2_started = 0.0
+
+    # learned conversion time of each chip in seconds for the current bit rate
+    __adc1_estimate = 0.26666
+    __adc2_estimate = 0.26666
+
+    # polls of the ready bit, of the last read and in total
+    __last_poll_count = 0
+    __poll_count = 0
+    __result_count = 0
+
+    __adc1_bitrate = 18  # current bitrate of chip 1
+    __adc2_bitrate = 18  # current bitrate of chip 2
     __conversionmode = 1  # Conversion Mode
-    __pga = float(0.5)  # current PGA setting
-    __lsb = float(0.0000078125)  # default LSB value for 18 bit
+    __adc1_pga = float(0.5)  # current PGA setting of chip 1
+    __adc2_pga = float(0.5)  # current PGA setting of chip 2
+    __adc1_lsb = float(0.0000078125)  # LSB value of chip 1, default for 18 bit
+    __adc2_lsb = float(0.0000078125)  # LSB value of chip 2, default for 18 bit
     __signbit = 0  # stores the sign bit for the sampled value
 
     # create a byte array and fill it with initial values to define the size
@@ -56,6 +95,16 @@ class ADCPi(object):
 
     __bus = None
 
+    # config bits and divisor for each PGA gain
+    __pga_bits = {1: (0x00, 0.5), 2: (0x01, 1.0), 4: (0x02, 2.0), 8: (0x03, 4.0)}
+
+    # config bits and LSB value for each bit rate
+    __rate_bits = {12: (0x00, 0.0005), 14: (0x04, 0.000125),
+                   16: (0x08, 0.00003125), 18: (0x0C, 0.0000078125)}
+
+    # time in seconds one conversion takes for each bit rate
+    __conversion_time = {12: 0.00416, 14: 0.01666, 16: 0.06666, 18: 0.26666}
+
     # local methods
 
     @staticmethod
@@ -64,12 +113,15 @@ class ADCPi(object):
         Internal method for getting an instance of the i2c bus
 
         :param bus: I2C bus number.  If the value is None the class will 
-                    try to find the i2c bus automatically using the device name
+                    try to find the i2c bus automatically using the device name.
+                    An already opened SMBus compatible object is used as is.
         :type bus: int
         :return: i2c bus for the target device
         :rtype: SMBus
         :raises IOError: Could not open the i2c bus
         """
+        if hasattr(bus, 'read_i2c_block_data'):
+            return bus
         i2c__bus = 1
         if bus is not None:
             i2c__bus = bus
@@ -135,6 +187,81 @@ class ADCPi(object):
         byte |= value
         return byte
 
+    def __write(self, address, byte):
+        """
+        Internal method for writing a byte to a chip, counting the transaction
+
+        :param address: I2C address
+        :type address: int
+        :param byte: byte to write
+        :type byte: int
+        """
+        self.__i2c_writes += 1
+        self.__bus.write_byte(address, byte)
+
+    def __read(self, address, config):
+        """
+        Internal method for reading the output register of a chip, counting
+        the transaction
+
+        :param address: I2C address
+        :type address: int
+        :param config: config byte
+        :type config: int
+        :return: 4 bytes read from the chip
+        :rtype: list
+        """
+        self.__i2c_reads += 1
+        if self.__rdwr:
+            # a plain read, the chip doesn't need the config byte in front
+            msg = i2c_msg.read(address, 4)
+            self.__bus.i2c_rdwr(msg)
+            return list(msg)
+        return self.__bus.read_i2c_block_data(address, config, 4)
+
+    def __read_trigger(self, address, byte):
+        """
+        Internal method for reading the output register of a chip and then
+        writing a byte to it in one I2C_RDWR transaction (repeated start,
+        one ioctl), counting the transaction
+
+        :param address: I2C address
+        :type address: int
+        :param byte: byte to write after the read
+        :type byte: int
+        :return: 4 bytes read from the chip
+        :rtype: list
+        """
+        self.__i2c_combined += 1
+        msg = i2c_msg.read(address, 4)
+        self.__bus.i2c_rdwr(msg, i2c_msg.write(address, [byte]))
+        return list(msg)
+
+    def __sync_config(self):
+        """
+        Internal method for writing the config of both chips to the bus, but
+        only where it differs from the shadow of the last written byte.
+        In one-shot mode a chip that is not converting continuously picks up
+        its new config with the next trigger, so nothing is written here.
+        """
+        if self.__adc1_conf != self.__adc1_shadow:
+            if (self.__conversionmode == 1 or self.__adc1_shadow is None
+                    or self.__adc1_shadow & 0x10):
+                self.__write(self.__adc1_address, self.__adc1_conf)
+                self.__adc1_shadow = self.__adc1_conf
+                self.__adc1_started = time.monotonic()
+            else:
+                self.__i2c_writes_skipped += 1
+        if self.__adc2_conf != self.__adc2_shadow:
+            if (self.__conversionmode == 1 or self.__adc2_shadow is None
+                    or self.__adc2_shadow & 0x10):
+                self.__write(self.__adc2_address, self.__adc2_conf)
+                self.__adc2_shadow = self.__adc2_conf
+                self.__adc2_started = time.monotonic()
+            else:
+                self.__i2c_writes_skipped += 1
+        return
+
     def __setchannel(self, channel):
         """
         Internal method for updating the config to the selected channel
@@ -192,10 +319,12 @@ class ADCPi(object):
         :param rate: bit rate, defaults to 18
         :type rate: int, optional
         :param bus: I2C bus number.  If no value is set the class will try to
-                    find the i2c bus automatically using the device name
+                    find the i2c bus automatically using the device name.
+                    An SMBus compatible object can be passed instead.
         :type bus: int, optional
         """
         self.__bus = self.__get_smbus(bus)
+        self.__rdwr = i2c_msg is not None and hasattr(self.__bus, 'i2c_rdwr')
         if address >= 0x68 and address <= 0x6F:
             self.__adc1_address = address
         else:
@@ -265,8 +394,12 @@ class ADCPi(object):
         raw = self.read_raw(channel)
         voltage = float(0.0)
         if not self.__signbit:
+            if channel <= 4:
+                lsb, pga = self.__adc1_lsb, self.__adc1_pga
+            else:
+                lsb, pga = self.__adc2_lsb, self.__adc2_pga
             voltage = float(
-                (raw * (self.__lsb / self.__pga)) * 2.471)
+                (raw * (lsb / pga)) * 2.471)
 
         return voltage
 
@@ -284,41 +417,242 @@ class ADCPi(object):
         if channel < 1 or channel > 8:
             raise ValueError('read_raw: channel out of range (1 to 8 allowed)')
 
+        config, address = self.__start_conversion(channel)
+        raw, self.__signbit, _ = self.__read_result(channel, config, address)
+        return raw
+
+    def read_sweep(self, channels, pga=None, rate=None):
+        """
+        Reads a set of channels, converting on both chips at the same time.
+        Channels of chip 1 (1 to 4) and chip 2 (5 to 8) are converted in
+        parallel, see iter_sweep.
+
+        :param channels: channels to read, each 1 to 8
+        :type channels: list
+        :param pga: gain per channel, indexed by channel number. If None
+                    the current PGA setting of each chip is kept
+        :type pga: list, optional
+        :param rate: bit rate per channel, indexed by channel number. If None
+                     the current bit rate of each chip is kept
+        :type rate: list, optional
+        :raises ValueError: read_sweep: channel out of range
+        :raises TimeoutError: read_raw: channel x conversion timed out
+        :return: one row per channel with the fields channel, raw, voltage,
+                 timestamp (epoch seconds at conversion start) and
+                 monotonic_ns (time.monotonic_ns at conversion start), in
+                 the order the results were read. Negative readings are
+                 returned as 0, the same way read_voltage does.
+        :rtype: numpy.ndarray of SWEEP_DTYPE
+        """
+        return np.array(list(self.iter_sweep(channels, pga, rate)),
+                        dtype=SWEEP_DTYPE)
+
+    def iter_sweep(self, channels, pga=None, rate=None):
+        """
+        Reads a set of channels, converting on both chips at the same time,
+        and returns a generator handing out the results. The first
+        conversion of each chip is started right away, so sweeps of several
+        ADCPi objects can convert at the same time.
+        Each chip converts its channels in the given order. As
+        soon as the result of a chip is read, its next conversion is
+        started, before the result is handed to the caller. So the chips
+        keep converting while the caller processes the rows. Results are
+        read alternately from chip 1 and chip 2. In one-shot mode with
+        combined transactions (see set_i2c_rdwr) the result is read and the
+        next conversion of the chip triggered in one I2C transaction, as
+        long as both conversions have the same bit rate.
+
+        :param channels: channels to read, each 1 to 8
+        :type channels: list
+        :param pga: gain per channel, indexed by channel number. If None
+                    the current PGA setting of each chip is kept
+        :type pga: list, optional
+        :param rate: bit rate per channel, indexed by channel number. If None
+                     the current bit rate of each chip is kept
+        :type rate: list, optional
+        :raises ValueError: read_sweep: channel out of range
+        :raises TimeoutError: read_raw: channel x conversion timed out
+        :return: generator of tuples (channel, raw, voltage, timestamp,
+                 monotonic_ns), the fields of SWEEP_DTYPE
+        :rtype: generator
+        """
+        chip1 = deque(c for c in channels if 1 <= c <= 4)
+        chip2 = deque(c for c in channels if 5 <= c <= 8)
+        if len(chip1) + len(chip2) != len(channels):
+            raise ValueError('read_sweep: channel out of range (1 to 8 allowed)')
+
+        combined = self.__rdwr and self.__conversionmode == 0
+        running = deque()  # started conversions, in the order they started
+
+        def prepare(channel):
+            if pga is not None:
+                self.__setpga(channel, pga[channel])
+            if rate is not None:
+                self.__setrate(channel, rate[channel])
+            # the scaling is kept, the chip may be set up differently when
+            # the result is handed out
+            if channel <= 4:
+                scale = self.__adc1_lsb / self.__adc1_pga * 2.471
+            else:
+                scale = self.__adc2_lsb / self.__adc2_pga * 2.471
+            config, address = self.__select_channel(channel)
+            return channel, config, address, scale
+
+        def start(prepared):
+            timestamp = time.time()
+            monotonic_ns = time.monotonic_ns()
+            self.__trigger(*prepared[:3])
+            running.append(prepared + (timestamp, monotonic_ns))
+
+        def results():
+            while running:
+                channel, config, address, scale, timestamp, monotonic_ns = \
+                    running.popleft()
+                chip = chip1 if channel <= 4 else chip2
+                following = None
+                if combined and chip and (rate is None
+                                          or rate[chip[0]] == rate[channel]):
+                    # triggered together with reading the result
+                    following = prepare(chip.popleft())
+                raw, signbit, triggered = self.__read_result(
+                    channel, config, address,
+                    None if following is None else following[1])
+                if triggered:
+                    running.append(following + (time.time(),
+                                                time.monotonic_ns()))
+                elif following is not None:
+                    start(following)
+                elif chip:  # read ahead on the idle chip
+                    start(prepare(chip.popleft()))
+                if signbit:
+                    yield (channel, 0, 0.0, timestamp, monotonic_ns)
+                else:
+                    yield (channel, raw, raw * scale, timestamp, monotonic_ns)
+
+        for chip in (chip1, chip2):
+            if chip:
+                start(prepare(chip.popleft()))
+        return results()
+
+    def __start_conversion(self, channel):
+        """
+        Internal method for selecting a channel and, in one-shot mode,
+        triggering a conversion on the chip that holds the channel
+
+        :param channel: 1 to 8
+        :type channel: int
+        :return: config byte and I2C address to read the result with
+        :rtype: tuple
+        """
+        config, address = self.__select_channel(channel)
+        self.__trigger(channel, config, address)
+        return config, address
+
+    def __select_channel(self, channel):
+        """
+        Internal method for updating the config of the chip that holds the
+        selected channel, nothing is written to the chip
+
+        :param channel: 1 to 8
+        :type channel: int
+        :return: config byte and I2C address of the channel
+        :rtype: tuple
+        """
+        self.__setchannel(channel)
+        if channel <= 4:
+            return self.__adc1_conf, self.__adc1_address
+        return self.__adc2_conf, self.__adc2_address
+
+    def __trigger(self, channel, config, address):
+        """
+        Internal method for triggering a conversion in one-shot mode, in
+        continuous mode only a changed config is written
+
+        :param channel: 1 to 8
+        :type channel: int
+        :param config: config byte returned by __select_channel
+        :type config: int
+        :param address: I2C address returned by __select_channel
+        :type address: int
+        """
+        # if the conversion mode is set to one-shot update the ready bit to 1,
+        # the trigger also carries any config change of the chip
+        if self.__conversionmode == 0:
+            self.__write(address, config | (1 << 7))
+            if channel <= 4:
+                self.__adc1_shadow = config
+                self.__adc1_started = time.monotonic()
+            else:
+                self.__adc2_shadow = config
+                self.__adc2_started = time.monotonic()
+        else:
+            self.__sync_config()
+        return
+
+    def __read_result(self, channel, config, address, next_config=None):
+        """
+        Internal method for waiting until the conversion of the selected
+        channel is ready and reading its result. Sleeps for the learned
+        conversion time of the chip first, then polls the ready bit with
+        a growing interval of at most 1/8 of that time.
+        With next_config in one-shot mode and combined transactions enabled
+        the first poll also triggers the next conversion of the chip. If the
+        result wasn't ready, that trigger aborted the conversion, so it is
+        started again and the next conversion is left to the caller.
+
+        :param channel: 1 to 8
+        :type channel: int
+        :param config: config byte returned by __start_conversion
+        :type config: int
+        :param address: I2C address returned by __start_conversion
+        :type address: int
+        :param next_config: config byte of the next conversion of the chip,
+                            already set with __select_channel
+        :type next_config: int, optional
+        :raises TimeoutError: read_raw: channel x conversion timed out
+        :return: raw ADC output without sign bit, sign bit and whether the
+                 next conversion was triggered
+        :rtype: tuple
+        """
         high = 0
         low = 0
         mid = 0
         cmdbyte = 0
 
-        # get the config and i2c address for the selected channel
-        self.__setchannel(channel)        
-        if channel <= 4:
-            config = self.__adc1_conf
-            address = self.__adc1_address
-        else:
-            config = self.__adc2_conf
-            address = self.__adc2_address
-
-        # if the conversion mode is set to one-shot update the ready bit to 1
-        if self.__conversionmode == 0:
-            config = config | (1 << 7)
-            self.__bus.write_byte(address, config)
-            config = config & ~(1 << 7)  # reset the ready bit to 0
+        bitrate = self.__adc1_bitrate if channel <= 4 else self.__adc2_bitrate
 
         # determine a reasonable amount of time to wait for the conversion
-        if self.__bitrate == 18:
-            seconds_per_sample = 0.26666
-        elif self.__bitrate == 16:
-            seconds_per_sample = 0.06666
-        elif self.__bitrate == 14:
-            seconds_per_sample = 0.01666
-        elif self.__bitrate == 12:
-            seconds_per_sample = 0.00416
-        timeout_time = time.time() + (100 * seconds_per_sample)
+        seconds_per_sample = self.__conversion_time[bitrate]
+        timeout_time = time.monotonic() + (100 * seconds_per_sample)
+
+        if channel <= 4:
+            started, estimate = self.__adc1_started, self.__adc1_estimate
+        else:
+            started, estimate = self.__adc2_started, self.__adc2_estimate
+
+        combined = (next_config is not None and self.__rdwr
+                    and self.__conversionmode == 0)
+        missed = False
+
+        # sleep until the conversion is expected to be finished, a bit
+        # longer if a miss of the combined read would cost a conversion
+        delay = started + estimate - time.monotonic()
+        if combined:
+            delay += seconds_per_sample / 32
+        if delay > 0:
+            time.sleep(delay)
+        backoff = max(estimate / 50, 0.00005)
+        polls = 0
 
         # keep reading the ADC data until the conversion result is ready
         while True:
-            __adcreading = self.__bus.read_i2c_block_data(address, config, 4)
-            if self.__bitrate == 18:
+            if combined:
+                __adcreading = self.__read_trigger(address,
+                                                   next_config | (1 << 7))
+            else:
+                __adcreading = self.__read(address, config)
+            polls += 1
+            if bitrate == 18:
                 high = __adcreading[0]
                 mid = __adcreading[1]
                 low = __adcreading[2]
@@ -330,36 +664,136 @@ class ADCPi(object):
             # check if bit 7 of the command byte is 0.
             if(cmdbyte & (1 << 7)) == 0:
                 break
-            elif time.time() > timeout_time:
+            elif combined:
+                # the trigger aborted the conversion, start it once more
+                # and expect the chip to be slower than estimated
+                combined = False
+                missed = True
+                self.__i2c_combined_misses += 1
+                self.__write(address, config | (1 << 7))
+                started = time.monotonic()
+                estimate = min(estimate * 1.1, 1.5 * seconds_per_sample)
+                time.sleep(estimate)
+            elif time.monotonic() > timeout_time:
                 msg = 'read_raw: channel %i conversion timed out' % channel
                 raise TimeoutError(msg)
             else:
-                time.sleep(0.00001)  # sleep for 10 microseconds
+                time.sleep(backoff)
+                backoff = min(backoff * 2, estimate / 8)
+
+        # learn the conversion time: if the first poll was already ready we
+        # may have slept too long, otherwise move towards the measured time
+        now = time.monotonic()
+        if combined:
+            # a combined read can't tell how early it was, creep slowly
+            estimate = estimate * 0.9995
+        elif missed:
+            pass
+        elif polls == 1:
+            estimate = estimate * 0.98
+        else:
+            estimate = 0.8 * estimate + 0.2 * (now - started)
+        estimate = min(max(estimate, 0.5 * seconds_per_sample),
+                       1.5 * seconds_per_sample)
+        if channel <= 4:
+            self.__adc1_estimate = estimate
+        else:
+            self.__adc2_estimate = estimate
+        if self.__conversionmode == 1 or combined:
+            # a continuously converting chip starts the next one right away,
+            # a combined read has just triggered it
+            if channel <= 4:
+                self.__adc1_started = now
+            else:
+                self.__adc2_started = now
+        if combined:
+            if channel <= 4:
+                self.__adc1_shadow = next_config
+            else:
+                self.__adc2_shadow = next_config
+        elif missed:
+            if channel <= 4:
+                self.__adc1_shadow = config
+            else:
+                self.__adc2_shadow = config
+        self.__last_poll_count = polls
+        self.__poll_count += polls
+        self.__result_count += 1
 
-        self.__signbit = False
+        signbit = False
         raw = 0
         # extract the returned bytes and combine them in the correct order
-        if self.__bitrate == 18:
+        if bitrate == 18:
             raw = ((high & 0x03) << 16) | (mid << 8) | low
-            self.__signbit = bool(raw & (1 << 17))
+            signbit = bool(raw & (1 << 17))
             raw = raw & ~(1 << 17)  # reset sign bit to 0
 
-        elif self.__bitrate == 16:
+        elif bitrate == 16:
             raw = (high << 8) | mid
-            self.__signbit = bool(raw & (1 << 15))
+            signbit = bool(raw & (1 << 15))
             raw = raw & ~(1 << 15)  # reset sign bit to 0
 
-        elif self.__bitrate == 14:
+        elif bitrate == 14:
             raw = ((high & 0b00111111) << 8) | mid
-            self.__signbit = bool(raw & (1 << 13))
+            signbit = bool(raw & (1 << 13))
             raw = raw & ~(1 << 13)  # reset sign bit to 0
 
-        elif self.__bitrate == 12:
+        elif bitrate == 12:
             raw = ((high & 0x0f) << 8) | mid
-            self.__signbit = bool(raw & (1 << 11))
+            signbit = bool(raw & (1 << 11))
             raw = raw & ~(1 << 11)  # reset sign bit to 0
 
-        return raw
+        return raw, signbit, combined
+
+    def __setpga(self, channel, gain):
+        """
+        Internal method for updating the PGA bits in the config of the chip
+        that holds the selected channel
+
+        :param channel: 1 to 8
+        :type channel: int
+        :param gain: 1, 2, 4 or 8
+        :type gain: int
+        :raises ValueError: set_pga: gain out of range
+        """
+        if gain not in self.__pga_bits:
+            raise ValueError('set_pga: gain out of range')
+        bits, divisor = self.__pga_bits[gain]
+        if channel <= 4:
+            self.__adc1_conf = self.__updatebyte(self.__adc1_conf, 0xFC, bits)
+            self.__adc1_pga = divisor
+        else:
+            self.__adc2_conf = self.__updatebyte(self.__adc2_conf, 0xFC, bits)
+            self.__adc2_pga = divisor
+        return
+
+    def __setrate(self, channel, rate):
+        """
+        Internal method for updating the bit rate bits in the config of the
+        chip that holds the selected channel
+
+        :param channel: 1 to 8
+        :type channel: int
+        :param rate: 12, 14, 16 or 18
+        :type rate: int
+        :raises ValueError: set_bit_rate: rate out of range
+        """
+        if rate not in self.__rate_bits:
+            raise ValueError('set_bit_rate: rate out of range')
+        bits, lsb = self.__rate_bits[rate]
+        if channel <= 4:
+            if rate != self.__adc1_bitrate:
+                self.__adc1_estimate = self.__conversion_time[rate]
+            self.__adc1_conf = self.__updatebyte(self.__adc1_conf, 0xF3, bits)
+            self.__adc1_bitrate = rate
+            self.__adc1_lsb = lsb
+        else:
+            if rate != self.__adc2_bitrate:
+                self.__adc2_estimate = self.__conversion_time[rate]
+            self.__adc2_conf = self.__updatebyte(self.__adc2_conf, 0xF3, bits)
+            self.__adc2_bitrate = rate
+            self.__adc2_lsb = lsb
+        return
 
     def set_pga(self, gain):
         """
@@ -373,31 +807,10 @@ class ADCPi(object):
         :raises ValueError: set_pga: gain out of range
         """
 
-        if gain == 1:
-            # bit 0 = 0, bit 1 = 0
-            self.__adc1_conf = self.__updatebyte(self.__adc1_conf, 0xFC, 0x00)
-            self.__adc2_conf = self.__updatebyte(self.__adc2_conf, 0xFC, 0x00)
-            self.__pga = 0.5
-        elif gain == 2:
-            # bit 0 = 1, bit 1 = 0
-            self.__adc1_conf = self.__updatebyte(self.__adc1_conf, 0xFC, 0x01)
-            self.__adc2_conf = self.__updatebyte(self.__adc2_conf, 0xFC, 0x01)
-            self.__pga = 1.0
-        elif gain == 4:
-            # bit 0 = 0, bit 1 = 1
-            self.__adc1_conf = self.__updatebyte(self.__adc1_conf, 0xFC, 0x02)
-            self.__adc2_conf = self.__updatebyte(self.__adc2_conf, 0xFC, 0x02)
-            self.__pga = 2.0
-        elif gain == 8:
-            # bit 0 = 1, bit 1 = 1
-            self.__adc1_conf = self.__updatebyte(self.__adc1_conf, 0xFC, 0x03)
-            self.__adc2_conf = self.__updatebyte(self.__adc2_conf, 0xFC, 0x03)
-            self.__pga = 4.0
-        else:
-            raise ValueError('set_pga: gain out of range')
+        self.__setpga(1, gain)
+        self.__setpga(5, gain)
 
-        self.__bus.write_byte(self.__adc1_address, self.__adc1_conf)
-        self.__bus.write_byte(self.__adc2_address, self.__adc2_conf)
+        self.__sync_config()
         return
 
     def set_bit_rate(self, rate):
@@ -412,35 +825,12 @@ class ADCPi(object):
         :raises ValueError: set_bit_rate: rate out of range
         """
 
-        if rate == 12:
-            # bit 2 = 0, bit 3 = 0
-            self.__adc1_conf = self.__updatebyte(self.__adc1_conf, 0xF3, 0x00)
-            self.__adc2_conf = self.__updatebyte(self.__adc2_conf, 0xF3, 0x00)
-            self.__bitrate = 12
-            self.__lsb = 0.0005
-        elif rate == 14:
-            # bit 2 = 1, bit 3 = 0
-            self.__adc1_conf = self.__updatebyte(self.__adc1_conf, 0xF3, 0x04)
-            self.__adc2_conf = self.__updatebyte(self.__adc2_conf, 0xF3, 0x04)
-            self.__bitrate = 14
-            self.__lsb = 0.000125
-        elif rate == 16:
-            # bit 2 = 0, bit 3 = 1
-            self.__adc1_conf = self.__updatebyte(self.__adc1_conf, 0xF3, 0x08)
-            self.__adc2_conf = self.__updatebyte(self.__adc2_conf, 0xF3, 0x08)
-            self.__bitrate = 16
-            self.__lsb = 0.00003125
-        elif rate == 18:
-            # bit 2 = 1, bit 3 = 1
-            self.__adc1_conf = self.__updatebyte(self.__adc1_conf, 0xF3, 0x0C)
-            self.__adc2_conf = self.__updatebyte(self.__adc2_conf, 0xF3, 0x0C)
-            self.__bitrate = 18
-            self.__lsb = 0.0000078125
-        else:
-            raise ValueError('set_bit_rate: rate out of range')
+        self.__setrate(1, rate)
+        self.__setrate(5, rate)
+        self.__adc1_estimate = self.__conversion_time[rate]
+        self.__adc2_estimate = self.__conversion_time[rate]
 
-        self.__bus.write_byte(self.__adc1_address, self.__adc1_conf)
-        self.__bus.write_byte(self.__adc2_address, self.__adc2_conf)
+        self.__sync_config()
         return
 
     def set_conversion_mode(self, mode):
@@ -455,14 +845,77 @@ class ADCPi(object):
         if mode == 0:
             # bit 4 = 0
             self.__adc1_conf = self.__updatebyte(self.__adc1_conf, 0xEF, 0x00)
-            self.__adc2_conf = self.__updatebyte(self.__adc1_conf, 0xEF, 0x00)
+            self.__adc2_conf = self.__updatebyte(self.__adc2_conf, 0xEF, 0x00)
             self.__conversionmode = 0
         elif mode == 1:
             # bit 4 = 1
             self.__adc1_conf = self.__updatebyte(self.__adc1_conf, 0xEF, 0x10)
-            self.__adc2_conf = self.__updatebyte(self.__adc1_conf, 0xEF, 0x10)
+            self.__adc2_conf = self.__updatebyte(self.__adc2_conf, 0xEF, 0x10)
             self.__conversionmode = 1
         else:
             raise ValueError('set_conversion_mode: mode out of range')
 
+        self.__sync_config()
+        return
+
+    def set_i2c_rdwr(self, enabled):
+        """
+        Use combined I2C_RDWR transactions: a poll is a plain read and a
+        sweep reads a result and triggers the next conversion of the chip
+        in one transaction, which saves an ioctl per sample. Enabled by
+        default when smbus2 is installed and the bus supports it.
+
+        :param enabled: True to use combined transactions
+        :type enabled: bool
+        :raises ValueError: set_i2c_rdwr: bus doesn't support i2c_rdwr
+        """
+        if enabled and (i2c_msg is None
+                        or not hasattr(self.__bus, 'i2c_rdwr')):
+            raise ValueError("set_i2c_rdwr: bus doesn't support i2c_rdwr")
+        self.__rdwr = bool(enabled)
         return
+
+    def get_i2c_counters(self):
+        """
+        Get the number of i2c transactions since creation or the last reset.
+        Each transaction is one ioctl on the bus device.
+
+        :return: dict with the keys writes, reads, combined (read and
+                 trigger in one transaction), combined_misses (combined
+                 reads that came too early and cost a conversion) and
+                 writes_skipped, the latter counts config writes saved by
+                 the shadow registers
+        :rtype: dict
+        """
+        return {'writes': self.__i2c_writes, 'reads': self.__i2c_reads,
+                'combined': self.__i2c_combined,
+                'combined_misses': self.__i2c_combined_misses,
+                'writes_skipped': self.__i2c_writes_skipped}
+
+    def reset_i2c_counters(self):
+        """
+        Set all i2c transaction counters and poll statistics to 0
+        """
+        self.__i2c_writes = 0
+        self.__i2c_reads = 0
+        self.__i2c_writes_skipped = 0
+        self.__i2c_combined = 0
+        self.__i2c_combined_misses = 0
+        self.__poll_count = 0
+        self.__result_count = 0
+
+    def get_poll_stats(self):
+        """
+        Get statistics about waiting for conversion results
+
+        :return: dict with the keys last_poll_count (ready bit polls of the
+                 last read), average_poll_count (since the last reset) and
+                 conversion_time1/conversion_time2 (learned conversion time
+                 of each chip in seconds)
+        :rtype: dict
+        """
+        average = self.__poll_count / self.__result_count if self.__result_count else 0.0
+        return {'last_poll_count': self.__last_poll_count,
+                'average_poll_count': average,
+                'conversion_time1': self.__adc1_estimate,
+                'conversion_time2': self.__adc2_estimate}
@@ -17,10 +17,17 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 
-import struct, socket, ssl, os.path, logging, logging.config, sys, subprocess, json
+import struct, ssl, os.path, logging, logging.config, sys, subprocess, json, time, signal, asyncio
 import paho.mqtt.client as mqtt
-from modules.inhouse.signalhandler import SignalHandler
 from modules.inhouse.mhiacfg import MhiaConfig
+from modules.inhouse.mhiaframing import SampleDecoder, SequenceTracker, SAMPLE, COMPACT, PLAIN, SOCKET, SHARED_MEMORY, hello
+from modules.inhouse.mhiashm import SampleRingReader, LatestValuesReader
+from modules.inhouse.mhiabatch import PayloadBatcher, PER_CHANNEL, ALL_CHANNELS, PACKED, COLUMNAR
+from modules.inhouse.mhiaspool import Spool, StoreAndForward, SPOOL, OVERFLOW_POLICIES
+from modules.inhouse.mhiamqtt import AsyncMQTT
+from modules.inhouse.mhiadeadband import Deadband
+from modules.inhouse.mhiahistory import History
+from modules.inhouse.mhiasinks import make_sink
 
 CONFIG_PATH = "./config.yaml" if os.path.isfile("./config.yaml") else "./config_default.yaml"
 CONFIG = MhiaConfig(CONFIG_PATH).get_config()
@@ -38,15 +45,73 @@ cafile=CONFIG['publisher']['cafile_path']
 brokerhost=CONFIG['publisher']['broker_host']
 brokerport=CONFIG['publisher']['broker_port']
 val_qos = CONFIG['publisher']['qos_for_sensor_values']
+compact_payload = bool(CONFIG['publisher'].get('compact_payload', False))
+COMPACT_PAYLOAD = struct.Struct('!qi')  # epoch timestamp in ns (int64) and raw count (int32), volts = raw count * scale of the channel
+# with sequence_in_payload the sequence number of the sample in its channel (uint32) is appended to either payload, subscribers can tell lost samples by gaps
+sequence_in_payload = bool(CONFIG['publisher'].get('sequence_in_payload', False))
+SEQUENCE = struct.Struct('!I')
+stats_interval = float(CONFIG['publisher'].get('stats_interval', 60))   # seconds between publishing the counters of lost samples
 meta_qos = CONFIG['publisher']['qos_for_meta_data']
+# with batch set to channel or all, samples are collected per channel or for all channels and published together on live/batch/ch_N or live/batch/all,
+# as soon as the first one is batch_window seconds old or the payload would get longer than batch_bytes (see mhiabatch.py for the payload)
+batch_mode = CONFIG['publisher'].get('batch') or None
+if batch_mode not in (None, PER_CHANNEL, ALL_CHANNELS):
+    error_logger.error(f"Unknown batch mode {batch_mode} in config, publishing every sample on its own!")
+    batch_mode = None
+batch_window = float(CONFIG['publisher'].get('batch_window', 1.0))
+batch_bytes = int(CONFIG['publisher'].get('batch_bytes', 4096))
+# columnar batches are delta encoded (see mhiapayload.py), with batch_deflate the batches are compressed too
+batch_encoding = CONFIG['publisher'].get('batch_encoding', PACKED)
+if batch_encoding not in (PACKED, COLUMNAR):
+    error_logger.error(f"Unknown batch encoding {batch_encoding} in config, using {PACKED}!")
+    batch_encoding = PACKED
+batch_deflate = bool(CONFIG['publisher'].get('batch_deflate', False))
+# all messages wait in a queue of at most max_queued_messages, at most max_inflight_messages of them are handed to the mqtt client and not yet sent (qos 0)
+# or acknowledged (qos 1 and 2). overflow_policy tells what happens to new messages when the queue is full: spool, drop-oldest or drop-newest.
+# While the broker is unreachable (and with spool on overflow) messages are spooled on disk in spool_directory, at most spool_max_bytes in segment files
+# of spool_segment_bytes, and replayed in order at up to spool_replay_rate messages per second (see mhiaspool.py)
+spool_directory = CONFIG['publisher'].get('spool_directory', "./spool")
+spool_segment_bytes = int(CONFIG['publisher'].get('spool_segment_bytes', 1 << 20))
+spool_max_bytes = int(CONFIG['publisher'].get('spool_max_bytes', 64 << 20))
+spool_replay_rate = float(CONFIG['publisher'].get('spool_replay_rate', 200))
+max_queued_messages = int(CONFIG['publisher'].get('max_queued_messages', 1000))
+max_inflight_messages = int(CONFIG['publisher'].get('max_inflight_messages', 20))
+overflow_policy = CONFIG['publisher'].get('overflow_policy', SPOOL)
+if overflow_policy not in OVERFLOW_POLICIES:
+    error_logger.error(f"Unknown overflow policy {overflow_policy} in config, using {SPOOL}!")
+    overflow_policy = SPOOL
+# channels with deadband, deadband_percent or heartbeat in channels_config are published by exception (see mhiadeadband.py). Besides, with
+# last_value_interval the latest sample of each channel is published retained on last_value/ch_N every last_value_interval seconds, whether it moved or not
+last_value_interval = float(CONFIG['publisher'].get('last_value_interval') or 0)
+# the latest history_samples samples of each channel and rollups of history_rollup seconds each, history_rollups of them, are kept in memory for answering
+# history requests (see mhiahistory.py), history_samples 0 for none
+history_samples = int(CONFIG['publisher'].get('history_samples', 36000) or 0)
+history_rollups = int(CONFIG['publisher'].get('history_rollups') or 3600)
+history_rollup = float(CONFIG['publisher'].get('history_rollup') or 1.0)
+history = History(history_samples, history_rollups, history_rollup) if history_samples else None
+# further destinations of all samples besides the broker: InfluxDB, http collectors and local files, each with a queue and a task of its own (see mhiasinks.py)
+sink_configs = CONFIG['publisher'].get('sinks') or []
+transport = CONFIG.get('sample_transport', SOCKET)  # with shared_memory the samples are read from the ring of the sampler, the socket just wakes this process up
 
 HOSTNAME = subprocess.run(["hostname"], capture_output=True, text=True).stdout.strip()
 top_level_topic = CONFIG['publisher']['top_level_topic']
 top_level_topic += ("/" + HOSTNAME + "/") if CONFIG['publisher']['add_hostname_to_topic'] else "/"
 topic_for_current_sensor_data = top_level_topic + "live/"
+topic_for_batches = top_level_topic + "live/batch/"
+topic_for_last_values = top_level_topic + "last_value/"
+topic_for_history = top_level_topic + "history/"
 topic_for_channels_config = top_level_topic + "channels_config"
 topic_for_active_channels = top_level_topic + "active_channels"
+topic_for_channel_scales = top_level_topic + "channel_scales"
+topic_for_pipeline_stats = top_level_topic + "pipeline_stats"
+topic_for_latest_values = top_level_topic + "latest_values"
 topic_for_listening = top_level_topic + "requests"
+socket_path = "./uds_samples"
+# the topics of the samples of each channel and of their batches (see mhiabatch.py), the batches of all channels have the key 0
+live_topics = {channel: f"{topic_for_current_sensor_data}ch_{channel}" for channel in CONFIG['active_channels']}
+batch_topics = {channel: f"{topic_for_batches}ch_{channel}" for channel in CONFIG['active_channels']}
+batch_topics[0] = topic_for_batches + "all"
+last_value_topics = {channel: f"{topic_for_last_values}ch_{channel}" for channel in CONFIG['active_channels']}
 
 def on_connect(client, userdata, flags, rc):
     """
@@ -56,73 +121,253 @@ def on_connect(client, userdata, flags, rc):
     # Subscribing in on_connect() means that if we lose the connection and
     # reconnect then subscriptions will be renewed.
     #client.subscribe("$SYS/#")
+    if rc != 0: return
+    client.subscribe(topic_for_listening, 2)
+    common_logger.info(f"Subscribed topic:{topic_for_listening} ")
+    userdata.connected.set()    # userdata is the StoreAndForward of main(), it stops spooling and starts replaying
+
+def on_disconnect(client, userdata, rc):
+    """
+    Called whenever the connection to the broker is lost or closed, messages are spooled on disk until on_connect() is called again
+    """
+    userdata.disconnected()
+    if rc != 0: common_logger.warning(f"Lost connection to MQTT broker (result code {rc}), spooling messages until it is back!")
+
+def on_publish(client, userdata, mid):
+    """
+    Called when a message was sent (qos 0) or acknowledged by the broker (qos 1 and 2), frees its place in the window of messages in flight
+    """
+    userdata.published(mid)
 
 def on_message(client, userdata, msg):
     """
-    This callback will be called by a seperate thread (part of paho.mqtt.client) whenever messsage arrives for topic_for_listening
+    This callback will be called in the event loop (see mhiamqtt.py) whenever messsage arrives for topic_for_listening
     """
     common_logger.info(f"Received {str(msg.payload)} about {str(msg.topic)}")
     if msg.payload == b"channels_config":
-        client.publish(topic_for_channels_config, json.dumps(CONFIG['channels_config']), qos=meta_qos, retain=True)
+        userdata.publish(topic_for_channels_config, json.dumps(CONFIG['channels_config']), qos=meta_qos, retain=True)
     elif msg.payload == b"active_channels":
-        client.publish(topic_for_active_channels, json.dumps(CONFIG['active_channels']), qos=meta_qos, retain=True)
-
-def main():
-    signalhandler = SignalHandler()
-    socket_path = "./uds_samples"
-    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-    sock.settimeout(2)
+        userdata.publish(topic_for_active_channels, json.dumps(CONFIG['active_channels']), qos=meta_qos, retain=True)
+    elif msg.payload == b"latest_values":
+        # read from the table of the sampler in shared memory, not from the stream of samples this process publishes
+        try:
+            reader = LatestValuesReader()
+        except FileNotFoundError:
+            error_logger.error("No table of latest values, sampler not running?")
+            return
+        try:
+            latest = {channel: {'seq': seq, 'timestamp': timestamp, 'raw': raw, 'value': value} for channel, (seq, monotonic_ns, timestamp, raw, value) in reader.snapshot().items()}
+        finally:
+            reader.close()
+        userdata.publish(topic_for_latest_values, json.dumps(latest), qos=meta_qos, retain=False)
+    elif msg.payload.startswith(b"{"):
+        # a history request like {"history": 3, "seconds": 600, "bucket": 1}, answered on history/ch_N from the samples in memory (see mhiapayload.py)
+        try:
+            request = json.loads(msg.payload)
+            channel = int(request['history'])
+            if history is None: raise ValueError("history_samples is 0")
+            payload = history.response(channel, float(request.get('seconds', 600)), float(request.get('bucket', 1)), time.time())
+        except (ValueError, KeyError, TypeError, AttributeError, OverflowError) as e:    # whatever a request looks like, it mustn't get into the event loop
+            error_logger.error(f"Could not answer request {msg.payload!r}: {e}")
+            return
+        userdata.publish(f"{topic_for_history}ch_{channel}", payload, qos=meta_qos, retain=False)
 
-    # establishing uds connection to sampler
-    conn_attempt = 0
-    while not (signalhandler.interrupt or signalhandler.terminate):
+async def connect_to_sampler():
+    """
+    Returns the reader and writer of the stream from the sampler, None if the sampler can't be reached
+    """
+    for conn_attempt in range(1, 31):
         try:
-            sock.connect(socket_path)
-        except Exception as e:
-            if conn_attempt <= 30: conn_attempt += 1
-            else:
-                error_logger.error(f"Could not connect to sampler after {conn_attempt} tries!")
-                common_logger.info("Exiting, could not establish uds connection with sampler!")
-                sys.exit(1)
+            reader, writer = await asyncio.open_unix_connection(socket_path)
+        except OSError:
+            await asyncio.sleep(0.5)
         else:
-            sock.send("publ".encode(encoding = 'UTF-8'))
-            break
+            writer.write("publ".encode(encoding = 'UTF-8'))
+            writer.write(hello(encoding=COMPACT if compact_payload else PLAIN, transport=transport, sequence=True))
+            return reader, writer
+    error_logger.error(f"Could not connect to sampler after {conn_attempt} tries!")
+    return None
+
+def sample_payload(channel, timestamp, raw, scale, seq):
+    """
+    Returns the payload of a sample published on its own, on live/ch_N or last_value/ch_N
+    """
+    if compact_payload:
+        payload = COMPACT_PAYLOAD.pack(int(timestamp * 1e9), raw)
+    else:
+        payload = SAMPLE.pack(channel, timestamp, raw * scale) #!idd means: int (4 bytes), double (8 bytes), double (8 bytes)
+    if sequence_in_payload: payload += SEQUENCE.pack(seq)
+    return payload
+
+async def publish_samples(reader, forward, sinks):
+    """
+    Publishes the samples coming from the sampler through forward and offers them to the sinks until the sampler closes the connection or the task is cancelled
+    """
+    # the sampler sends frames of several samples, each sample is published on its own
+    # as the 20 bytes of the struct !idd (channel, epoch timestamp, volts) or with compact_payload as 12 bytes of COMPACT_PAYLOAD,
+    # the scales for converting raw counts to volts are published retained on topic_for_channel_scales then
+    # the sequence numbers of the received samples are counted in tracker, its counters of gaps, duplicates and late samples per channel
+    # are published every stats_interval seconds as json on topic_for_pipeline_stats, together with the samples lost in the ring and the counters of the publish queue and the spool
+    # all messages go through forward, which spools them while the broker is unreachable and replays them a few at a time in every pass of the loop
+    # samples of channels with a deadband are filtered by deadband before they are published or batched, the suppressed ones leave gaps in the sequence numbers
+    tracker = SequenceTracker()
+    decoder = SampleDecoder(tracker)
+    published_scales = {}
+    deadband = Deadband(CONFIG['channels_config'])
+    last_values = {}    # channel -> latest sample, filtered or not
+    last_values_published = time.monotonic()
+    batcher = PayloadBatcher(batch_mode, compact_payload, sequence_in_payload, batch_window, batch_bytes, batch_encoding, batch_deflate) if batch_mode else None
+    ring = SampleRingReader() if transport == SHARED_MEMORY else None  # the sampler created it before accepting connections
+    lost_reported = 0
+    stats_published = time.monotonic()
+    try:
+        while True:
+            # without samples for a while the loop goes on anyway, for replaying the spool and publishing batches that are due
+            try:
+                data = await asyncio.wait_for(reader.read(65536), timeout=0.1)
+            except asyncio.TimeoutError:
+                data = None
+            if data == b"":
+                error_logger.error("Sampler closed the connection!")
+                return
+            samples = decoder.feed_raw(data) if data else []
+            if ring is not None:
+                decoder.others.clear()  # NOTIFY frames, the ring is read on every wake up anyway
+                # compact samples need the scales of the META frame, which may come after the first records are in the ring, they wait in the ring until then
+                records = ring.read().tolist() if decoder.scales or not compact_payload else []   # (seq, channel, monotonic_ns, timestamp, raw, value, channel_seq) each
+                if compact_payload:
+                    unscaled = sum(record[1] not in decoder.scales for record in records)
+                    if unscaled:
+                        error_logger.error(f"{unscaled} samples from the ring of channels without a scale in the META frame, they are not published!")
+                        records = [record for record in records if record[1] in decoder.scales]
+                    samples = [(record[1], record[3], record[4], decoder.scales[record[1]], record[6]) for record in records]
+                else:
+                    samples = [(record[1], record[3], record[5], 1.0, record[6]) for record in records]
+                for sample in samples: tracker.add(sample[0], sample[4])
+                if ring.lost > lost_reported:
+                    common_logger.warning(f"Publishing fell behind, {ring.lost - lost_reported} samples were overwritten in the ring before they could be published!")
+                    lost_reported = ring.lost
+            if last_value_interval:
+                for sample in samples: last_values[sample[0]] = sample
+            if history is not None: history.add(samples)
+            for sink in sinks: sink.offer(samples)
+            samples = deadband.filter(samples)
+            for channel, timestamp, raw, scale, seq in samples:
+                # one read can bring more samples than the queue takes, the client gets a turn to send before the overflow policy has to decide
+                if forward.full(): await asyncio.sleep(0)
+                if batcher is not None:
+                    for key, batch in batcher.add(channel, int(timestamp * 1e9) if compact_payload else timestamp, raw if compact_payload else raw * scale, seq, time.monotonic()):
+                        forward.publish(batch_topics[key], batch, qos=val_qos, retain=False)
+                    continue
+                forward.publish(live_topics[channel], sample_payload(channel, timestamp, raw, scale, seq), qos=val_qos, retain=False)
+            if batcher is not None:
+                for key, batch in batcher.due(time.monotonic()):
+                    forward.publish(batch_topics[key], batch, qos=val_qos, retain=False)
+            if compact_payload and decoder.scales != published_scales:
+                published_scales = dict(decoder.scales)
+                forward.publish(topic_for_channel_scales, json.dumps(published_scales), qos=meta_qos, retain=True)
+            if last_value_interval and time.monotonic() - last_values_published >= last_value_interval:
+                for channel, sample in last_values.items():
+                    forward.publish(last_value_topics[channel], sample_payload(*sample), qos=meta_qos, retain=True)
+                last_values.clear()     # a channel that stopped keeps its retained last value
+                last_values_published = time.monotonic()
+            forward.replay()
+            if time.monotonic() - stats_published >= stats_interval:
+                stats = {'channels': tracker.stats(), 'ring_lost': ring.lost if ring is not None else None, 'publish': forward.stats(), 'deadband': deadband.stats(),
+                         'sinks': {sink.name: sink.stats() for sink in sinks}}
+                forward.publish(topic_for_pipeline_stats, json.dumps(stats), qos=meta_qos, retain=True)
+                common_logger.info(f"Sequence counters of received samples: {stats}")
+                stats_published = time.monotonic()
+            # reading from the stream doesn't give way to the event loop while the sampler keeps it filled, the mqtt client gets to send here
+            await asyncio.sleep(0)
+    finally:
+        if batcher is not None:
+            for key, batch in batcher.flush():
+                forward.publish(batch_topics[key], batch, qos=val_qos, retain=False)
+        if ring is not None: ring.close()
+
+async def run():
+    """
+    Publishes the samples until SIGINT or SIGTERM, returns the exit code. Everything runs in one thread, in the event loop: reading the samples,
+    the mqtt client (see mhiamqtt.py) and its callbacks.
+    """
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    loop.add_signal_handler(signal.SIGINT, stop.set)
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+
+    # establishing uds connection to sampler
+    connection = await connect_to_sampler()
+    if connection is None:
+        common_logger.info("Exiting, could not establish uds connection with sampler!")
+        return 1
+    reader, writer = connection
     common_logger.info("Connected to sampler...")
     mqttc = mqtt.Client()
     mqttc.on_connect = on_connect
+    mqttc.on_disconnect = on_disconnect
     mqttc.on_message = on_message
+    mqttc.on_publish = on_publish
+    mqttc.max_inflight_messages_set(max_inflight_messages)
+    forward = StoreAndForward(mqttc, Spool(spool_directory, spool_segment_bytes, spool_max_bytes), spool_replay_rate,
+                              queue_limit=max_queued_messages, window=max_inflight_messages, overflow=overflow_policy)
+    mqttc.user_data_set(forward)
+    if not forward.spool.empty(): common_logger.info(f"{forward.spool.bytes} bytes of messages left in the spool, they are replayed once connected.")
     common_logger.info(f"Attempting to connect to MQTT broker using client cert:{certfile} and using cafile:{cafile} to authenticate server (broker).")
     mqttc.tls_set(ca_certs=cafile, certfile=certfile, keyfile=keyfile, cert_reqs=ssl.CERT_REQUIRED, tls_version=ssl.PROTOCOL_TLS, ciphers=None) 
     common_logger.info("Will use this top level topic: " + top_level_topic)
+    sinks = []
+    for sink_config in sink_configs:
+        try:
+            sinks.append(make_sink(sink_config))
+        except ValueError as e:
+            error_logger.error(f"Leaving out sink {sink_config}: {e}")
+    sinking = [asyncio.create_task(sink.run()) for sink in sinks]
+    if sinks: common_logger.info(f"Sinks besides the broker: {', '.join(sink.name for sink in sinks)}")
 
-    #establish connection to mqtt broker, when established start mqtt loop and subscribe to topic_for_listening
-    try:
-        mqttc.connect(brokerhost, port=brokerport, keepalive=60, bind_address="")
-    except Exception as e:
+    # the connection to the mqtt broker is established in the background and again whenever it is lost, on_connect subscribes to topic_for_listening.
+    # Samples are published right from the start, they are spooled until the broker is connected.
+    client = AsyncMQTT(mqttc, loop)
+    connecting = asyncio.create_task(client.keep_connected(brokerhost, brokerport, keepalive=60, min_delay=1, max_delay=60))
+    publishing = asyncio.create_task(publish_samples(reader, forward, sinks))
+    stopping = asyncio.create_task(stop.wait())
+    await asyncio.wait((connecting, publishing, stopping), return_when=asyncio.FIRST_COMPLETED)
+    exit_code = 0
+    if stopping.done():
+        common_logger.info("Exiting because of SIGINT or SIGTERM!")
+    elif connecting.done():
+        e = connecting.exception()
         if ("CERTIFICATE_VERIFY_FAILED" in str(e)): common_logger.info("Certificate not valid (anymore)! Contact administrator of the MQTT broker!")
         error_logger.error(f"CERTIFICATE_VERIFY_FAILED while trying to connect to MQTT broker!")
         common_logger.info("Exiting, could not establish MQTT connection.")
         print("Error: Could not establish secure MQTT connection!")
-        #other exceptions
-        sys.exit(1)
+        exit_code = 1
+    elif publishing.exception() is not None:
+        error_logger.error(f"Publishing failed: {publishing.exception()!r}")
+        exit_code = 1
     else:
-        # when mqttc.connect() works, the mqtt loop is started and publisher subscribes to "topic_for_listening" for receiving data/commands...
-        common_logger.info(f"Connected to MQTT broker at {brokerhost}:{brokerport}.")
-        mqttc.loop_start()
-        (subs_result, subs_mid) = mqttc.subscribe(topic_for_listening, 2)
-        common_logger.info(f"Subscribed topic:{topic_for_listening} ")
-        #print(subs_result, subs_mid)
-    finally: pass
-
-    while not (signalhandler.interrupt or signalhandler.terminate):
-        # exception handling is still missing here, tbd
-            byx = sock.recv(20)
-            channel, timestamp, value = struct.unpack('!idd', byx) #!idd means: int (4 bytes), double (8 bytes), double (8 bytes)
-            mqttc.publish(topic_for_current_sensor_data + "ch_" + str(channel), byx, qos=val_qos, retain=False)
-    
-    common_logger.info("Exiting because of SIGINT or SIGTERM!")
-    mqttc.loop_stop()
-    mqttc.disconnect()
-    sys.exit(0)
+        common_logger.info("Exiting, sampler is gone.")
+        exit_code = 1
+    for task in (connecting, publishing, stopping):
+        task.cancel()
+    await asyncio.gather(connecting, publishing, stopping, return_exceptions=True)
+    # what the sinks still have queued gets one attempt, as far as 2 seconds allow, a sink that is down doesn't hold up stopping
+    for task in sinking:
+        task.cancel()
+    await asyncio.gather(*sinking, return_exceptions=True)
+    try:
+        await asyncio.wait_for(asyncio.gather(*(sink.flush() for sink in sinks)), timeout=2)
+    except asyncio.TimeoutError:
+        common_logger.warning(f"Sinks not flushed within 2 s: {', '.join(sink.name for sink in sinks if sink.queue)}")
+    for sink in sinks:
+        await sink.close()
+    client.close()
+    forward.spool.close()
+    writer.close()
+    return exit_code
+
+def main():
+    sys.exit(asyncio.run(run()))
+
 if __name__=="__main__":
-    main()    
+    main()
@@ -17,11 +17,15 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 
-import os, sys, time, struct, socket, logging, logging.config
+import os, sys, time, socket, queue, atexit, logging, logging.config
 
 from modules.inhouse.signalhandler import SignalHandler
 from modules.thirdparty.abelectronics.ADCPi import ADCPi
 from modules.inhouse.mhiacfg import MhiaConfig
+from modules.inhouse.mhiabus import BusSampler, SWEEP_END, pair_of
+from modules.inhouse.mhiaframing import SHARED_MEMORY
+from modules.inhouse.mhiashm import SampleRing, LatestValues
+from modules.inhouse.mhiahub import SampleHub, DROP_OLDEST, BLOCK
 
 CONFIG_PATH = "./config.yaml" if os.path.isfile("./config.yaml") else "./config_default.yaml"
 CONFIG = MhiaConfig(CONFIG_PATH).get_config()
@@ -32,12 +36,8 @@ error_logger = logging.getLogger("error")
 
 common_logger.info("Starting sampler...")
 
-def capture(adc, channel, pga):
-    timestamp = time.time()
-    adc.set_pga(pga)
-    value = adc.read_voltage(channel)      # for raw binary value = adc.read_raw(channel) for voltage (calculated by ADCPi lib) adc.read_voltage(channel)
-    duration = time.time() - timestamp
-    return duration, timestamp, value
+# maximum samples per second of the MCP3424 for each resolution
+MAX_SPS = {12: 240, 14: 60, 16: 15, 18: 3.75}
 
 def main():
     """
@@ -56,28 +56,67 @@ def main():
             sys.exit(1)
         else: pass
     
-    pga = [int] * 9  
-    
-    #setting up the ADCPi module from ABelectronics (todo: use new selfmade lib at some point?)
-    chip1addr, chip2addr, active_channels, resolution, pga[0] = CONFIG['chip1_address'], CONFIG['chip2_address'], CONFIG['active_channels'], CONFIG['adc_resolution'], CONFIG['adc_gain']
+    # the ADC pairs (two chips with 8 channels together) and their buses, older configs have just the addresses of one pair
+    adc_pairs = CONFIG.get('adc_pairs') or [{'chip1_address': CONFIG['chip1_address'], 'chip2_address': CONFIG['chip2_address']}]
+    active_channels, resolution = CONFIG['active_channels'], CONFIG['adc_resolution']
+    addresses_in_use = set()
+    for pair in adc_pairs:
+        for address in (pair['chip1_address'], pair['chip2_address']):
+            if (pair.get('bus'), address) in addresses_in_use:
+                error_logger.error(f"Address 0x{address:02x} is used twice on bus {pair.get('bus')}, check adc_pairs in config!")
+                common_logger.info("Exiting due to error!")
+                sys.exit(1)
+            addresses_in_use.add((pair.get('bus'), address))
+    for i in active_channels:
+        if not 1 <= i <= 8 * len(adc_pairs):
+            error_logger.error(f"Active channel {i} has no ADC pair, with {len(adc_pairs)} pair(s) in config channels 1 to {8 * len(adc_pairs)} are possible!")
+            common_logger.info("Exiting due to error!")
+            sys.exit(1)
+
+    pga, rate = {}, {}
+    pga[0], rate[0] = CONFIG['adc_gain'], resolution
     #setting channel specific PGA, pga[0] is the default value, it is applied if no "wanted_pga" included in config of channel
+    #same for the resolution, rate[0] is applied if no "adc_resolution" included in config of channel
     for i in active_channels:
         try:
             pga[i] = CONFIG['channels_config'][i]['wanted_pga']
         except KeyError:
             pga[i] = pga[0]
+        try:
+            rate[i] = CONFIG['channels_config'][i]['adc_resolution']
+        except KeyError:
+            rate[i] = rate[0]
+
+    # an oversampled channel is converted "oversampling" times in a row, the conversions are averaged to one value with more effective bits
+    oversampling = {}
+    for i in active_channels:
+        try:
+            oversampling[i] = int(CONFIG['channels_config'][i]['oversampling'])
+        except KeyError:
+            oversampling[i] = 1
+    oversampled = {i: oversampling[i] for i in active_channels if oversampling[i] > 1}
+    if oversampled: common_logger.info(f"Oversampling of channels: {oversampled}")
     
-    common_logger.info(f"ADC parameters read from config: chip1 at 0x{chip1addr:02x}, chip2 at 0x{chip2addr:02x}, resolution = {resolution}bit")
-    
-    adc = ADCPi(chip1addr, chip2addr, resolution)
-    common_logger.info("ADC object created, usind ABElectronics module.")
-    
-    adc.set_conversion_mode(0) # meaning that the ADC will convert in single shot mode, this programm triggers each and every shot
+    # the pairs that have active channels are set up, ADCPi finds the bus of the mhia pi board on its own if a pair has no bus in config
+    adcs = {}
+    for index, pair in enumerate(adc_pairs):
+        if not any(pair_of(i) == index for i in active_channels): continue
+        common_logger.info(f"ADC parameters read from config: pair {index} (channels {8*index+1} to {8*index+8}) on bus {pair.get('bus', 'auto')}, chip1 at 0x{pair['chip1_address']:02x}, chip2 at 0x{pair['chip2_address']:02x}, resolution = {resolution}bit")
+        adcs[index] = ADCPi(pair['chip1_address'], pair['chip2_address'], resolution, bus=pair.get('bus'))
+    common_logger.info("ADC objects created, usind ABElectronics module.")
     
-    pga_time = time.time()
-    #adc.set_pga(pga)
-    pga_time = pga_time - time.time()
-    print(pga_time)
+    # in continuous mode the chips convert on their own and the sampler only reads the results,
+    # this works just with at most one active channel per chip, otherwise the chip would have to switch channels all the time
+    continuous_wanted = CONFIG.get('adc_conversion_mode', "one-shot") == "continuous"
+    chip_of_channel = [(i - 1) // 4 for i in active_channels]
+    one_channel_per_chip = len(chip_of_channel) == len(set(chip_of_channel))
+    continuous = continuous_wanted and one_channel_per_chip
+    if continuous_wanted and not continuous:
+        common_logger.warning(f"Continuous conversion needs at most one active channel per chip, active channels are {active_channels}. Falling back to one-shot mode.")
+    for adc in adcs.values():
+        adc.set_conversion_mode(1 if continuous else 0) # continuous: the ADC converts at its maximum rate, each new result is read once, 0: this programm triggers each and every shot
+    if continuous:
+        common_logger.info(f"ADC converts continuously at {[MAX_SPS[rate[i]] for i in active_channels]} sps.")
     common_logger.info("ADC set and ready for sampling.")
 
     # the requested sample rate for different resolutions is read from config
@@ -85,10 +124,19 @@ def main():
     requested_sampling_interval = float(CONFIG['requested_sampling_interval'][resolution]/1000)
     common_logger.info(f"Requested sampling interval for {resolution} bit conversion is {requested_sampling_interval*1000} ms")    
 
-    # initialising lists with current values, timestamps; the indices represent the channel number - 1
-    sample_values = [int] * 8
-    sample_timestamps = [float] * 8
-    actual_sampling_duration = [float] * 8
+    # the chips convert in parallel, so by default a channel is sampled every requested interval (for its resolution) times the channel count of the busiest chip
+    # a channel can have its own interval in ms, set as "sampling_interval" in its config
+    conversions_per_sweep = max(chip_of_channel.count(chip) for chip in chip_of_channel)
+    channel_interval = {}
+    for i in active_channels:
+        try:
+            channel_interval[i] = float(CONFIG['channels_config'][i]['sampling_interval']/1000)
+        except KeyError:
+            channel_interval[i] = float(CONFIG['requested_sampling_interval'][rate[i]]/1000) * conversions_per_sweep
+    if continuous: # read_sweep waits for the next result of the free running chips, so no extra sleep is wanted
+        channel_interval = {i: 1 / MAX_SPS[rate[i]] for i in active_channels}
+        common_logger.info("Continuous mode ignores the requested sampling intervals.")
+    common_logger.info(f"Sampling interval in ms per channel: { {i: round(channel_interval[i]*1000, 1) for i in active_channels} }")
 
     # this running process is named "sampler", other mhia processes (modules) have also self explanatory names
     # in config file these modules can be activated or deactivated depending on customers' use case   
@@ -98,101 +146,127 @@ def main():
     common_logger.info("Config wants publisher.") if publisher_wanted else None
     storer_wanted = True if CONFIG['enabled_modules']['storer'] else False
     common_logger.info("Config wants storer.") if storer_wanted else None
-    displayer_connected, publisher_connected, storer_connected = False, False, False
-    
-    tempstr = ""
+    wanted = [name for name, is_wanted in (("disp", displayer_wanted), ("publ", publisher_wanted), ("stor", storer_wanted)) if is_wanted]
+
+    # with sample_transport shared_memory the samples are written once into a ring in shared memory (see mhiashm.py), every process reads them there
+    # at its own pace, a slow process loses the samples it didn't fetch in time but never holds up the sampler. The ring exists before any process connects.
+    ring = None
+    if CONFIG.get('sample_transport', "socket") == SHARED_MEMORY:
+        ring = SampleRing(int(CONFIG.get('ring_capacity', 65536)))
+        atexit.register(ring.close)
+        common_logger.info(f"Samples are passed in shared memory, ring for {ring.capacity} samples created.")
+
+    # the latest sample of every channel is kept in a table in shared memory (see mhiashm.py), any process can look it up without following the samples
+    latest = LatestValues(8 * len(adc_pairs))
+    atexit.register(latest.close)
 
-    # binding a unix domain socket for inter-process communication
+    # binding a unix domain socket for inter-process communication, processes connect to it whenever they like (see mhiahub.py)
     sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     sock.bind(socket_path)
-    sock.settimeout(0.2)
     sock.listen()
     common_logger.info("Unix domain socket created and listening...")
 
-    #this while loop lets the required modules get connected to the uds 
-    wanted = displayer_wanted + publisher_wanted + storer_wanted
-    connected = displayer_connected + publisher_connected + storer_connected    
-
     signalhandler = SignalHandler() 
-    temp_counter = 0
-    common_logger.info("socket is listening ...")
-    
-    while (wanted > connected) and not (signalhandler.interrupt or signalhandler.terminate):
-        # this loop contains a try block, that is repeated max 30 times. Process exits if the wanted processes didn't connect during this time.
-        try:
-            temp_sock, client_address = sock.accept()
-        except Exception as e:
-            if temp_counter <= 30: temp_counter += 1    # tries 30 times   
-            else: 
-                error_logger.error(f"waited {temp_counter * sock.gettimeout()} seconds for requested processes, at least one of them did not connect!")
-                common_logger.info("Exiting, at least one needed process didn't connect in time!")
-                print("Error: A needed process is not running. Sampler should in general be started by the mhia script!")
-                sys.exit(1)
-        else:
-            tempstr = temp_sock.recv(4).decode(encoding = 'UTF-8')
-            if tempstr == "publ":
-                publisher_connected = True
-                publisher_socket = temp_sock.dup()
-                common_logger.info("Publisher connected!")
-                del temp_sock 
-            elif tempstr == "disp":
-                displayer_connected = True
-                displayer_socket = temp_sock.dup() 
-                common_logger.info("Displayer connected!")
-                del temp_sock 
-            elif tempstr == "stor":
-                storer_connected = True
-                storer_socket = temp_sock.dup()
-                common_logger.info("Storer connected!")
-                del temp_sock 
-        finally: 
-            connected = displayer_connected + publisher_connected + storer_connected            
-    # "temp_sock" (socket object) is to find out what process got connected 
     
-    common_logger.info("All requested processes connected!")
+    common_logger.info(f"Starting capturing and sampling these channels: {active_channels}, quantizing in {[rate[i] for i in active_channels]} bit! ")
     
-    #sock.setblocking(False)
-    if displayer_connected: displayer_socket.setblocking(False)
-    if publisher_connected: publisher_socket.setblocking(False)
+    # every conversion has a deadline on a fixed grid per channel, so time spent for sending doesn't add up to drift
+    # with pipelined sampling all due channels are converted back to back, taking turns between the chips, and the next conversion
+    # of a chip is triggered before the current result is sent, so converting overlaps with the work done here in python
+    pipelined = bool(CONFIG.get('pipelined_sampling', True))
+    interval_ns = {i: int(channel_interval[i] * 1e9) for i in active_channels}
+    conversion_ns = {i: int(oversampling[i] * 1e9 / MAX_SPS[rate[i]]) for i in active_channels}
+    if pipelined:
+        chips = {}
+        for i in active_channels: chips.setdefault((i - 1) // 4, []).append(i)
+        conversion_order = [chip[k] for k in range(conversions_per_sweep) for chip in chips.values() if k < len(chip)]
+        common_logger.info(f"Pipelined sampling, channels due at the same time are converted in the order {conversion_order} instead of {active_channels}.")
 
+    # separate buses don't contend, so each bus gets a worker thread of its own that samples its ADC pairs, all samples are merged into one queue
+    # the queue is bounded: while the loop below waits for a process with the block policy the workers fill it and then wait too, their scheduler skips
+    # the slots missed meanwhile (logged as overrun) instead of the queue growing without limit
+    merged = queue.Queue(maxsize=16384)     # samples and sweep ends, about 2 MB
+    workers = []
+    for bus in dict.fromkeys(adc_pairs[index].get('bus') for index in adcs):
+        on_bus = {index: adc for index, adc in adcs.items() if adc_pairs[index].get('bus') == bus}
+        channels = [i for i in active_channels if pair_of(i) in on_bus]
+        workers.append(BusSampler(bus, on_bus, merged, {i: pga[i] for i in channels}, {i: rate[i] for i in channels}, {i: oversampling[i] for i in channels},
+                                  {i: interval_ns[i] for i in channels}, {i: conversion_ns[i] for i in channels}, continuous, pipelined))
+    common_logger.info(f"{len(workers)} sampling worker(s) for bus(es) {[worker.bus for worker in workers]}.")
+    for worker in workers: worker.start()
+    
+    # the samples are collected and sent as frames of many samples each (see mhiaframing.py), that means far fewer sends than one per sample
+    # a frame is sent at the end of a sweep once its oldest sample waited frame_latency ms, a long sweep is cut after twice that time
+    # processes with the compact encoding get raw counts and integer times (see mhiaframing.py), the volts per count of each channel are sent once before
+    frame_latency_ns = int(float(CONFIG.get('frame_latency', 20)) * 1e6)
+    frame_limit = 32768     # bytes, a frame is sent anyway when it gets that long
+    oldest_ns = None    # when the oldest sample not sent yet was received
+    ring_batch = []     # samples for the ring, written together with the frames
 
+    # every connected process has a queue of its own, a process that doesn't take its frames loses them as its drop policy says (see mhiahub.py)
+    # instead of stopping the sampler, the display gets the latest samples and the publisher (block) gets all of them unless it stalls for 2 seconds,
+    # while it stalls the other processes still get the frames queued for them, but sampling waits once merged is full
+    scales = {}
+    for worker in workers: scales.update(worker.scale)
+    policies = {"disp": DROP_OLDEST, "publ": BLOCK, "stor": BLOCK}
+    policies.update(CONFIG.get('drop_policy') or {})
+    hub = SampleHub(sock, scales, queue_limit=int(CONFIG.get('consumer_queue_limit', 256)) * 1024, policies=policies, shared_memory=ring is not None)
+    period_of_time_for_eval = 60 # seconds, used for info level logging of the counters of the connected processes
+    last_eval_ns = time.monotonic_ns()
+    wanted_deadline_ns = last_eval_ns + 6 * 10**9   # the processes started with the sampler by the mhia script should be there by then
 
+    def flush():
+        if ring_batch:
+            ring.write(ring_batch)
+            ring_batch.clear()
+            hub.notify()
+        hub.flush()
     
-    common_logger.info(f"Starting capturing and sampling these channels: {active_channels}, quantizing in {resolution} bit, will try to sample every {requested_sampling_interval * 1000} ms! ")
-    
-    period_of_time_for_moving_average = 60 # seconds, used for debug or info level logging. 
-    average_sampling_duration = requested_sampling_interval / 2 # just a starting value, will get more precise in every iteration of the main loop
-    count_for_eval = int(period_of_time_for_moving_average / requested_sampling_interval)   
-    
-    struct_def = '!idd'     # over the uds connection a struct is passed that is packed, !idd stands for one int and two doubles, that is 4+8+8=20 bytes
-    
-    # this loop calls capture continuesly, calculates the variable sleep time till next capture call and sends data to connected processes    
+    # this loop takes the samples of all workers and hands them to the hub, which sends them to the connected processes
     while not (signalhandler.interrupt or signalhandler.terminate):
-        for i in active_channels:
-            j=i-1 # active_channels is between 1 and 8, j as index for the lists between 0 and 7, be carefull here what is i and what is j
-            actual_sampling_duration[j], sample_timestamps[j], sample_values[j] = capture(adc, i, pga[i])
-            data2send = bytearray(struct.pack(struct_def, i, sample_timestamps[j],sample_values[j]))
-            try:
-                if displayer_connected: displayer_socket.send(data2send)
-                if publisher_connected: publisher_socket.send(data2send)
-            except Exception as e:
-                error_logger.error(f"Could not send data over to other processes: {e} !")
-                if displayer_connected: displayer_socket.close()
-                if publisher_connected: publisher_socket.close()
-                common_logger.info("Exiting due to error!")
-                sys.exit(1)       
-            average_sampling_duration = (average_sampling_duration + actual_sampling_duration[j])/2
-            count_for_eval = count_for_eval - 1
-            if count_for_eval > 1: pass
-            else: 
-                if average_sampling_duration > requested_sampling_interval:
-                    common_logger.warn(f"mean sampling duration {average_sampling_duration*1000:.1f} ms, higher than {requested_sampling_interval*1000:.1f}.")
-                common_logger.info(f"mean sampling duration {average_sampling_duration*1000:.1f} ms, lower than {requested_sampling_interval*1000:.1f}.")
-                count_for_eval = int(period_of_time_for_moving_average / requested_sampling_interval)
-            sleepval = requested_sampling_interval - actual_sampling_duration[j]
-            time.sleep(sleepval)   
-    if displayer_connected: displayer_socket.close()
-    if publisher_connected: publisher_socket.close()
+        timeout = 0.1 if oldest_ns is None else max(oldest_ns + 2 * frame_latency_ns - time.monotonic_ns(), 0) / 1e9
+        try:
+            sample = merged.get(timeout=timeout)
+        except queue.Empty:
+            if oldest_ns is not None:   # a long sweep, its samples waited long enough
+                flush()
+                oldest_ns = None
+            hub.poll()
+            continue
+        if sample is None:  # a worker failed, it logged why
+            common_logger.info("Exiting due to error!")
+            break
+        if sample is SWEEP_END:
+            if oldest_ns is not None and time.monotonic_ns() - oldest_ns >= frame_latency_ns:
+                flush()
+                oldest_ns = None
+            hub.poll()
+            now_ns = time.monotonic_ns()
+            if wanted_deadline_ns is not None and now_ns >= wanted_deadline_ns:
+                missing = [name for name in wanted if name not in hub.tags()]
+                if missing: error_logger.error(f"{missing} wanted by config not connected, sampling goes on anyway!")
+                wanted_deadline_ns = None
+            if now_ns - last_eval_ns >= period_of_time_for_eval * 1e9:
+                hub.report()
+                last_eval_ns = now_ns
+            continue
+        latest.write(*sample)
+        longest = hub.add(sample)
+        if ring is not None: ring_batch.append(sample)
+        if oldest_ns is None: oldest_ns = time.monotonic_ns()
+        if longest >= frame_limit or len(ring_batch) >= frame_limit:
+            flush()
+            oldest_ns = None
+    for worker in workers: worker.stop.set()
+    stop_deadline = time.monotonic() + 1
+    while any(worker.is_alive() for worker in workers) and time.monotonic() < stop_deadline:
+        try:
+            merged.get(timeout=0.05)    # a worker may be waiting for room in the full queue
+        except queue.Empty:
+            pass
+    hub.close()
+    if any(worker.failed for worker in workers):
+        sys.exit(1)
     common_logger.info("Exiting because of SIGINT or SIGTERM!")
     
     sys.exit(0)
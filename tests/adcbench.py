@@ -0,0 +1,58 @@
+# adcbench.py - compares sampling rates of the ADCPi module on a simulated bus, run it from within the tests directory
+import sys, time, struct, socket
+sys.path.append("../")
+from modules.thirdparty.abelectronics.ADCPi import ADCPi
+from fakesmbus import FakeSMBus
+
+channels = [1, 2, 3, 4, 5, 6, 7, 8]
+resolution = int(sys.argv[1]) if len(sys.argv) > 1 else 12
+seconds = 2
+
+bus = FakeSMBus()
+adc = ADCPi(0x68, 0x6d, resolution, bus=bus)
+adc.set_conversion_mode(0)
+pga = [1] * 9
+
+# stands in for the work the sampler does with every sample: packing it and sending it to the other processes
+sender, receiver = socket.socketpair()
+receiver.setblocking(False)
+def process(i, timestamp, value):
+    sender.send(struct.pack('!idd', i, timestamp, value))
+    try: receiver.recv(4096)
+    except BlockingIOError: pass
+
+def bench(label, sweep):
+    bus.reset_counters()
+    adc.reset_i2c_counters()
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        count += sweep()
+    elapsed = time.perf_counter() - start
+    print(f"{label:32}{count/elapsed:8.1f} sps, {bus.writes/count:.2f} writes and {bus.reads/count:.2f} reads per sample, {adc.get_i2c_counters()['writes_skipped']/count:.2f} writes skipped, {adc.get_poll_stats()['average_poll_count']:.2f} polls per read")
+
+# one channel after the other, like the sampler did before read_sweep
+def one_by_one():
+    for i in channels:
+        adc.set_pga(pga[i])
+        process(i, time.time(), adc.read_voltage(i))
+    return len(channels)
+
+# both chips converting at the same time, processing after the sweep
+def sweep_then_process():
+    rows = adc.read_sweep(channels, pga).tolist()
+    for i, raw, value, timestamp, monotonic_ns in rows:
+        process(i, timestamp, value)
+    return len(rows)
+
+# both chips converting at the same time, processing while the next conversions run
+def pipelined():
+    count = 0
+    for i, raw, value, timestamp, monotonic_ns in adc.iter_sweep(channels, pga):
+        process(i, timestamp, value)
+        count += 1
+    return count
+
+bench("read_voltage:", one_by_one)
+bench("read_sweep, then processing:", sweep_then_process)
+bench("iter_sweep, pipelined:", pipelined)
@@ -0,0 +1,71 @@
+# batchtest.py - encodes batches of samples with mhiabatch.py and decodes them with mhiapayload.py, run it from within the tests directory
+# python3 batchtest.py [seed]
+# Every combination of batching mode, compact or plain samples, sequence numbers, packed or columnar encoding and deflate, for random batches and edge
+# cases: a single sample, negative and extreme raw counts, sequence numbers wrapping around 2^32, NaN, inf and -0.0 volts, timestamps out of order.
+# The decoded samples have to be bit-exact the ones added, floats compared by their bits. The only exception is documented in mhiapayload.py:
+# timestamps in s of plain columnar batches are rounded to the ns, they have to be exactly round(timestamp * 1e9) / 1e9 then.
+import sys, random, struct, itertools
+sys.path.append("../")
+from modules.inhouse.mhiabatch import PayloadBatcher, PER_CHANNEL, ALL_CHANNELS, PACKED, COLUMNAR
+from modules.inhouse.mhiapayload import unpack_batch, BATCH_HEADER, BATCH_COLUMNAR
+
+seed = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+rng = random.Random(seed)
+t0 = 1.7e9
+
+def bits(number):
+    return struct.pack('!d', number) if isinstance(number, float) else number
+
+def random_samples(n, channels=8):
+    # (channel, timestamp in s, raw count, volts, seq), on a grid of 10 ms with jitter, the seq of each channel counting on from somewhere
+    seqs = {channel: rng.randrange(2**32) for channel in range(1, channels + 1)}
+    samples = []
+    for k in range(n):
+        channel = rng.randrange(1, channels + 1)
+        samples.append((channel, t0 + k * 0.01 + rng.uniform(-1e-3, 1e-3), rng.randrange(-131072, 131072), rng.uniform(-10, 10), seqs[channel]))
+        seqs[channel] = (seqs[channel] + rng.choice((1, 1, 1, 2, 7))) % 2**32    # now and then a gap, e.g. of the deadband
+    return samples
+
+nan = struct.unpack('!d', bytes.fromhex("7ff8000000000123"))[0]     # a NaN with a payload, has to keep it
+cases = {
+    "random": random_samples(3000),
+    "single sample": [(3, t0, 12345, 0.123, 7)],
+    "negative raws": [(1, t0 + k * 0.01, raw, raw * 1e-5, k) for k, raw in enumerate((-1, -131072, -2**31, 2**31 - 1, 0, -2**31, -5, 2**31 - 1))],
+    "seq wrap": [(channel, t0 + k * 0.01, k, k * 0.5, (2**32 - 3 + k) % 2**32) for k in range(6) for channel in (2, 5)],
+    "nan and inf": [(4, t0 + k * 0.01, k, value, k) for k, value in enumerate((float('nan'), nan, float('inf'), float('-inf'), -0.0, 0.0, 5e-324, -1.7976931348623157e308, 1.5))],
+    "time going back": [(6, t0 + dt, k, k * 0.25, k) for k, dt in enumerate((0.0, 0.01, 0.005, 100.0, -3600.0, 0.02))],
+}
+
+def expected(sample, compact, sequence, columnar):
+    channel, timestamp, raw, value, seq = sample
+    if compact: record = (channel, int(timestamp * 1e9), raw)
+    else: record = (channel, round(timestamp * 1e9) / 1e9 if columnar else timestamp, value)
+    return record + (seq,) if sequence else record
+
+checked = 0
+for mode, compact, sequence, encoding, deflate in itertools.product((PER_CHANNEL, ALL_CHANNELS), (True, False), (True, False), (PACKED, COLUMNAR), (False, True)):
+    for name, samples in cases.items():
+        if compact and name == "nan and inf": continue  # compact batches carry raw counts, not volts
+        for max_bytes in (1400, 65536):     # many batches per key, or one
+            batcher = PayloadBatcher(mode, compact, sequence, 1.0, max_bytes, encoding, deflate)
+            payloads = []
+            for channel, timestamp, raw, value, seq in samples:
+                payloads += batcher.add(channel, int(timestamp * 1e9) if compact else timestamp, raw if compact else value, seq, 0.0)
+            payloads += batcher.flush()
+            decoded = {}    # key -> records in the order of the batches
+            for key, payload in payloads:
+                flags, channel = BATCH_HEADER.unpack_from(payload)[1:3]
+                assert channel == key and bool(flags & BATCH_COLUMNAR) == (encoding == COLUMNAR)
+                decoded.setdefault(key, []).extend(unpack_batch(payload))
+            for key, records in decoded.items():
+                wanted = [expected(sample, compact, sequence, encoding == COLUMNAR) for sample in samples if mode == ALL_CHANNELS or sample[0] == key]
+                if encoding == COLUMNAR:
+                    # each columnar batch groups its samples by channel, so only the order within a channel is kept
+                    by_channel = lambda rows: {c: [tuple(map(bits, row)) for row in rows if row[0] == c] for c in set(row[0] for row in rows)}
+                    assert by_channel(records) == by_channel(wanted), (mode, compact, sequence, encoding, deflate, name, key)
+                else:
+                    assert [tuple(map(bits, row)) for row in records] == [tuple(map(bits, row)) for row in wanted], (mode, compact, sequence, encoding, deflate, name, key)
+            assert sum(map(len, decoded.values())) == len(samples)
+            checked += 1
+    print(f"{mode:7} {'compact' if compact else 'plain':7} {'seq' if sequence else 'no seq':6} {encoding:8} {'deflate' if deflate else '':7} all cases bit-exact")
+print(f"{checked} encodings of {len(cases)} cases decoded bit-exact (seed {seed})")
@@ -0,0 +1,78 @@
+# deadbandtest.py - checks the deadband filter of the publisher (mhiadeadband.py) against a plain sequential reference, run it from within the tests directory
+# python3 deadbandtest.py [seed]
+# The filter searches windows of samples with numpy and switches to testing one by one, the reference tests every sample in order. Both have to let
+# through exactly the same samples, for channels that are quiet, moving, noisy right at the deadband, moving by exactly the deadband, with a heartbeat
+# only, with deadband_percent and without rules, interleaved and fed in reads of random size like the publisher gets them, some samples without sequence numbers (seq None).
+import sys, random
+sys.path.append("../")
+from modules.inhouse.mhiadeadband import Deadband
+
+seed = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+rng = random.Random(seed)
+
+channels_config = {
+    1: {'deadband': 0.01, 'heartbeat': 2.0},                            # quiet, with steps now and then
+    2: {'deadband': 0.01},                                              # a ramp, nearly every sample passes
+    3: {'deadband': 0.05, 'heartbeat': 0.5},                            # noise of about the deadband
+    4: {'heartbeat': 1.0},                                              # heartbeat only
+    5: {'deadband_percent': 1, 'min_voltage': -5, 'max_voltage': 5},    # 0.1 V
+    6: {},                                                              # not filtered
+    7: {'deadband': 0.0625},                                            # moves by exactly the deadband, which doesn't pass
+}
+scales = {channel: 1e-4 for channel in channels_config}     # volts per raw count
+scales[7] = 2**-10  # so the steps of channel 7 are exactly 64 counts = 0.0625 V
+
+counts = {}     # samples of each channel so far
+
+def raw(channel, k):
+    if channel == 1: return (k // 700) * 500 + rng.randrange(-20, 21)
+    if channel == 2: return k * 150
+    if channel == 3: return rng.randrange(-600, 601)
+    if channel == 5: return round(3000 * ((k // 50) % 5)) + rng.randrange(-900, 901)
+    if channel == 7:
+        # steps of 64 counts and now and then 65, on every sample for a while (tested one by one), then on every 8th (searched in windows)
+        n = counts[7] = counts.get(7, -1) + 1
+        steps = n if n // 200 % 2 == 0 else n // 8 + 25
+        return steps * 64 + steps // 3
+    return rng.randrange(-100000, 100000)
+
+def reference(samples, rules, last):
+    passed = []
+    for sample in samples:
+        channel, timestamp, value = sample[0], sample[1], sample[2] * sample[3]
+        if channel not in rules:
+            passed.append(sample)
+            continue
+        deadband, heartbeat = rules[channel]
+        if channel not in last or abs(value - last[channel][0]) > deadband or (heartbeat is not None and timestamp - last[channel][1] >= heartbeat):
+            passed.append(sample)
+            last[channel] = (value, timestamp)
+    return passed
+
+samples, t0 = [], 1.7e9
+for k in range(20000):
+    channel = rng.randrange(1, 8)
+    samples.append((channel, t0 + k * 0.004, raw(channel, k), scales[channel], None if k % 3 == 0 else k))
+
+deadband = Deadband(channels_config)
+rules = dict(deadband.rules)    # channel -> (deadband in V, heartbeat in s or None)
+last = {}
+filtered, expected, position = [], [], 0
+while position < len(samples):
+    read = samples[position:position + rng.choice((1, 3, 8, 50, 400, 3000))]
+    position += len(read)
+    filtered += deadband.filter(read)
+    expected += reference(read, rules, last)
+assert filtered == expected, next(k for k, (a, b) in enumerate(zip(filtered, expected)) if a != b)
+assert deadband.filter([]) == []
+
+stats = deadband.stats()
+for channel in sorted(channels_config):
+    total = sum(sample[0] == channel for sample in samples)
+    kept = sum(sample[0] == channel for sample in expected)
+    if channel in stats:
+        assert stats[channel] == {'published': kept, 'suppressed': total - kept}, (channel, stats[channel])
+    else:
+        assert kept == total
+    print(f"channel {channel}: {kept} of {total} published, same as the reference")
+print(f"{len(expected)} of {len(samples)} samples published, same samples as the sequential reference (seed {seed})")
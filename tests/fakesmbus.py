@@ -0,0 +1,112 @@
+# fakesmbus.py - a simulated i2c bus with MCP3424 chips on it, for running the ADCPi module without hardware
+# Copyright (C) 2023  Iman Ayatollahi, Talwiese IoT Solutions e.U.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time, random, ctypes
+
+class FakeMCP3424:
+    # conversion time in seconds for the sample rate bits (bit 2 and 3) of the config register
+    _conversion_time = {0x00: 1/240, 0x04: 1/60, 0x08: 1/15, 0x0C: 1/3.75}
+    _bits = {0x00: 12, 0x04: 14, 0x08: 16, 0x0C: 18}
+
+    def __init__(self, values=None, noise=0.0):
+        """
+        One simulated MCP3424. values is a list of 4 voltages (before the 2.471 divider of the mhia pi board) for channel 1 to 4 of the chip.
+        noise is the rms of gaussian noise in V added to every conversion.
+        """
+        self.config = 0x90
+        self.values = values if values else [0.5, 1.0, 1.5, 2.0]
+        self.noise = noise
+        self.started = 0.0      # when the current conversion was started
+        self.fetched = True     # True when the latest result was already read
+
+    def write(self, value):
+        self.config = value & 0x7F
+        if (value & 0x80) or (value & 0x10):
+            self.started = time.perf_counter()
+            self.fetched = False
+
+    def read(self, length):
+        rate = self.config & 0x0C
+        duration = self._conversion_time[rate]
+        elapsed = time.perf_counter() - self.started
+        if self.config & 0x10:  # continuous mode, chip keeps converting
+            if elapsed >= duration:
+                self.started += duration * int(elapsed / duration)
+                self.fetched = False
+                elapsed = 0
+            ready = (not self.fetched) and (self.started > 0)
+        else:
+            ready = (not self.fetched) and (elapsed >= duration)
+        gain = 1 << (self.config & 0x03)
+        lsb = 2 * 2.048 / (1 << self._bits[rate])
+        value = self.values[(self.config >> 5) & 0x03] + (random.gauss(0, self.noise) if self.noise else 0)
+        count = max(int(value / 2.471 * gain / lsb), 0)
+        if self._bits[rate] == 18:
+            data = [(count >> 16) & 0x03, (count >> 8) & 0xFF, count & 0xFF]
+        else:
+            data = [(count >> 8) & 0xFF, count & 0xFF]
+        if ready: self.fetched = True
+        cfg = self.config | (0 if ready else 0x80)
+        return (data + [cfg] * length)[:length]
+
+
+class FakeSMBus:
+    def __init__(self, chips=None, clock_hz=None):
+        """
+        SMBus compatible object, pass it as bus to ADCPi. chips is a dict with i2c address as key and FakeMCP3424 as value.
+        With clock_hz every transaction takes as long as its bits would take on a real bus with that clock (9 bits per byte, plus start and stop).
+        """
+        self.chips = chips if chips else {0x68: FakeMCP3424(), 0x6d: FakeMCP3424([2.5, 3.0, 3.5, 4.0])}
+        self.clock_hz = clock_hz
+        self.writes = 0     # count of i2c write transactions
+        self.reads = 0      # count of i2c read transactions
+        self.ioctls = 0     # count of calls that would be a syscall on a real bus
+
+    def _transfer(self, *lengths):
+        # one message per length (address byte plus data bytes), a repeated start between them
+        if self.clock_hz:
+            until = time.perf_counter() + (2 + sum(9 * (1 + length) + 1 for length in lengths)) / self.clock_hz
+            while time.perf_counter() < until: pass
+
+    def write_byte(self, address, value):
+        self.ioctls += 1
+        self.writes += 1
+        self._transfer(1)
+        self.chips[address].write(value)
+
+    def read_i2c_block_data(self, address, cmd, length):
+        self.ioctls += 1
+        self.reads += 1
+        self._transfer(1, length)   # the command byte is written first
+        return self.chips[address].read(length)
+
+    def i2c_rdwr(self, *msgs):
+        """
+        Takes smbus2 i2c_msg objects like SMBus.i2c_rdwr does, all of them in one ioctl
+        """
+        self.ioctls += 1
+        self._transfer(*(msg.len for msg in msgs))
+        for msg in msgs:
+            if msg.flags & 0x0001:  # I2C_M_RD
+                self.reads += 1
+                ctypes.memmove(msg.buf, bytes(self.chips[msg.addr].read(msg.len)), msg.len)
+            else:
+                self.writes += 1
+                for value in msg:
+                    self.chips[msg.addr].write(value)
+
+    def reset_counters(self):
+        self.writes, self.reads, self.ioctls = 0, 0, 0
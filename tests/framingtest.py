@@ -0,0 +1,93 @@
+# framingtest.py - decodes the frames of the socket protocol (mhiaframing.py) as a stream socket may hand them over, run it from within the tests directory
+# python3 framingtest.py
+# A stream of frames of every kind, encoded by SampleFramer in each encoding, with META and NOTIFY frames, an empty body and a kind the decoder doesn't
+# know, is fed split at every byte offset (so headers and bodies split between two chunks), in three chunks at random offsets, byte by byte and at once
+# (several frames in one chunk). Every way has to give the same samples and the same other frames, and the samples have to be the ones put in.
+# Then the SequenceTracker of the decoder, channel by channel: in order, a gap, a duplicate, late within the memory of missing numbers and beyond it,
+# the sequence numbers wrapping around 2^32 with and without a gap, all channels interleaved so each has to be counted on its own.
+import sys, random
+sys.path.append("../")
+from modules.inhouse.mhiaframing import SampleFramer, SampleDecoder, FrameDecoder, SequenceTracker, frame, meta, PLAIN, COMPACT, NOTIFY, MAX_BODY, FRAME_HEADER, SEQ_MODULO
+
+rng = random.Random(1)
+UNKNOWN = 99    # no kind of mhiaframing.py, has to end up in others
+scales = {channel: 0.001 * channel for channel in range(1, 9)}
+
+def stream(encoding, sequence):
+    # the frames the sampler would send a process, and the samples in them as (channel, monotonic_ns, timestamp, raw, value, seq)
+    framer = SampleFramer(encoding, anchor_period_ns=50 * 10**6, sequence=sequence)
+    data, samples = bytearray(meta(scales) if encoding == COMPACT else b""), []
+    monotonic_ns, timestamp = 10**12, 1.7e9
+    for k in range(120):
+        channel = rng.randrange(1, 9)
+        monotonic_ns += rng.randrange(1, 20 * 10**6)
+        raw = rng.randrange(-131072, 131072)
+        sample = (channel, monotonic_ns, timestamp + (monotonic_ns - 10**12) / 1e9, raw, raw * scales[channel], rng.randrange(2**32))
+        framer.add(*sample)
+        samples.append(sample)
+        if k % 17 == 0: data += framer.take()
+        if k == 40: data += frame(NOTIFY, b"")
+        if k == 80: data += frame(UNKNOWN, b"\x00\x01\x02")
+    data += framer.take()
+    return bytes(data), samples
+
+def decode(chunks):
+    decoder = SampleDecoder()
+    samples = []
+    for chunk in chunks: samples += decoder.feed_raw(chunk)
+    assert not decoder.frames.buffer, "bytes left over"
+    return samples, decoder.others
+
+for encoding in (PLAIN, COMPACT):
+    for sequence in (False, True):
+        data, originals = stream(encoding, sequence)
+        whole, others = decode([data])
+        assert others == [(NOTIFY, b""), (UNKNOWN, b"\x00\x01\x02")], others
+        assert len(whole) == len(originals)
+        for (channel, timestamp, raw, scale, seq), original in zip(whole, originals):
+            if encoding == COMPACT:
+                assert (channel, raw, scale) == (original[0], original[3], scales[original[0]])
+                assert abs(timestamp - original[2]) < 1e-6     # from the anchor, exact to the ns but for the float
+            else:
+                assert (channel, timestamp, raw, scale) == (original[0], original[2], original[4], 1.0)
+            assert seq == (original[5] if sequence else None)
+        for offset in range(len(data) + 1):
+            assert decode([data[:offset], data[offset:]]) == (whole, others), (encoding, sequence, offset)
+        for k in range(200):
+            first, second = sorted(rng.sample(range(len(data) + 1), 2))
+            assert decode([data[:first], data[first:second], data[second:]]) == (whole, others), (encoding, sequence, first, second)
+        assert decode([data[k:k + 1] for k in range(len(data))]) == (whole, others)
+        print(f"{encoding:7} {'seq' if sequence else 'no seq':6} {len(data)} bytes, {len(whole)} samples: the same split at every offset, in 3 chunks and byte by byte")
+
+# a header announcing more than MAX_BODY means the stream is out of step, also when the header comes in two chunks
+header = FRAME_HEADER.pack(MAX_BODY + 1, NOTIFY)
+decoder = FrameDecoder()
+assert decoder.feed(header[:3]) == []
+try:
+    decoder.feed(header[3:])
+except ValueError as e:
+    print(f"a frame longer than MAX_BODY is refused: {e}")
+else:
+    raise AssertionError("a frame longer than MAX_BODY wasn't refused")
+# channel -> the sequence numbers as they arrive and the counters they have to give, with a memory of 4 missing numbers per channel
+cases = {
+    1: ([5, 6, 7, 8, 9], {'received': 5, 'gaps': 0, 'duplicates': 0, 'late': 0}),                    # in order, from wherever it starts
+    2: ([0, 1, 4, 5], {'received': 4, 'gaps': 2, 'duplicates': 0, 'late': 0}),                        # 2 and 3 lost
+    3: ([0, 1, 1, 2], {'received': 4, 'gaps': 0, 'duplicates': 1, 'late': 0}),                        # 1 twice
+    4: ([0, 3, 1, 2], {'received': 4, 'gaps': 0, 'duplicates': 0, 'late': 2}),                        # 1 and 2 after 3, taken off the gaps
+    5: ([0, 10, 7, 2], {'received': 4, 'gaps': 8, 'duplicates': 1, 'late': 1}),                       # only 6 to 9 remembered, so 2 looks like a duplicate
+    6: ([SEQ_MODULO - 2, SEQ_MODULO - 1, 0, 1], {'received': 4, 'gaps': 0, 'duplicates': 0, 'late': 0}),  # wrapping around
+    7: ([SEQ_MODULO - 1, 1, 0, 1], {'received': 4, 'gaps': 0, 'duplicates': 1, 'late': 1}),           # 0 late across the wrap, then 1 again
+    8: ([SEQ_MODULO - 3, 2, 1], {'received': 3, 'gaps': 3, 'duplicates': 0, 'late': 1}),              # a gap across the wrap, 1 late
+}
+tracker = SequenceTracker(memory=4)
+for k in range(max(len(seqs) for seqs, counters in cases.values())):
+    for channel, (seqs, counters) in cases.items():
+        if k < len(seqs): tracker.add(channel, seqs[k])
+stats = tracker.stats()
+for channel, (seqs, counters) in cases.items():
+    assert stats[channel] == counters, (channel, seqs, stats[channel])
+tracker.restart()   # e.g. after subscribing to other channels, the numbers skipped in between aren't gaps
+tracker.add(2, 1000)
+assert tracker.stats()[2] == {'received': 5, 'gaps': 2, 'duplicates': 0, 'late': 0}, tracker.stats()[2]
+print(f"SequenceTracker: in order, gaps, duplicates, late within and beyond its memory and wrapping around 2^32 counted right on {len(cases)} channels")
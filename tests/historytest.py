@@ -0,0 +1,44 @@
+# historytest.py - checks the answers to history requests (mhiahistory.py, decoded with mhiapayload.py) against a brute-force reference, run it from within the tests directory
+# Buckets from the ring of samples and from the rollups (the query reaches back further than the samples), samples added a few at a time like the publisher
+# does, and requests with parameters that have to be refused with ValueError.
+import sys, math
+sys.path.append("../")
+from modules.inhouse.mhiahistory import History
+from modules.inhouse.mhiapayload import unpack_history
+
+history = History(5000, 3600, 1.0)
+t0 = 1.7e9
+samples = [(3, t0 + k * 0.1, k % 100, 0.01, None if k % 5 == 0 else k) for k in range(20000)]     # channel 3 at 10 sps for 2000 s, some without seq
+for k in range(0, len(samples), 7): history.add(samples[k:k + 7])
+now = t0 + 2000
+values = [(timestamp, raw * scale) for channel, timestamp, raw, scale, seq in samples]
+
+def check(seconds, bucket):
+    channel, rows = unpack_history(history.response(3, seconds, bucket, now))
+    assert channel == 3
+    length = rows[1][0] - rows[0][0]
+    for k, (start, low, high, mean, n) in enumerate(rows):
+        inside = [value for timestamp, value in values if rows[0][0] + k * length <= timestamp < rows[0][0] + (k + 1) * length]
+        assert n == len(inside), (k, n, len(inside))
+        if inside:
+            assert abs(low - min(inside)) < 1e-6 and abs(high - max(inside)) < 1e-6 and abs(mean - sum(inside) / len(inside)) < 1e-5, (k, rows[k])
+        else:
+            assert math.isnan(low) and math.isnan(high) and math.isnan(mean)
+    print(f"{seconds} s in buckets of {bucket} s: {len(rows)} buckets of {length:g} s, same as the reference")
+
+check(400, 10)      # from the samples
+check(60, 0.5)
+check(1500, 7.3)    # from the rollups, the buckets become 7 s
+check(2500, 60)     # reaching back before the first sample, empty buckets at the start
+
+for seconds, bucket in ((600, 0), (600, -1), (0, 1), (-600, 1), (math.nan, 1), (600, math.nan), (math.inf, 1), (600, math.inf), (86400, 0.001)):
+    try:
+        history.response(3, seconds, bucket, now)
+    except ValueError as e:
+        print(f"seconds {seconds}, bucket {bucket} refused: {e}")
+    else:
+        raise AssertionError(f"seconds {seconds}, bucket {bucket} not refused")
+try:
+    history.response(5, 600, 1, now)
+except ValueError as e:
+    print(f"channel 5 refused: {e}")
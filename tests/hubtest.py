@@ -0,0 +1,156 @@
+# hubtest.py - connects processes to the hub of the sampler (mhiahub.py) over socket pairs and checks what becomes of them, run it from within the tests directory
+# python3 hubtest.py
+# Handshakes and subscriptions that must not stop sampling: HELLOs that are valid json but no object, invalid json, a truncated HELLO, a name alone
+# and subscriptions that are no object or ask for impossible rates. A display that connects through the listener like the real one gets samples all
+# along and has to get every one of them, in order. The truncated HELLO has to be given up on, the processes with a bad HELLO get the plain encoding.
+# Then the drop policies, each with a process that reads nothing while its queue fills up and starts reading later: the queue has to stay within its
+# limit (plus the entry being sent and the anchor and scales put in front of it), and the samples that arrive have to decode to the right times and
+# volts, also after the ANCHOR and META frames were dropped (a SUBSCRIBE while the queue is full queues the META frame again). drop-oldest has to keep
+# the latest samples, drop-newest the first ones, block all of them while the process reads slowly, and disconnect it when it doesn't read at all.
+import sys, os, socket, selectors, tempfile, time, threading
+sys.path.append("../")
+from modules.inhouse import mhiahub
+from modules.inhouse.mhiahub import SampleHub, DROP_OLDEST, DROP_NEWEST, BLOCK
+from modules.inhouse.mhiaframing import SampleDecoder, SequenceTracker, frame, hello, subscribe, HELLO, SUBSCRIBE, COMPACT, PLAIN
+
+mhiahub.HANDSHAKE_LIMIT = 0.3   # gives up on the truncated HELLO sooner
+scales = {channel: 0.001 * channel for channel in range(1, 9)}
+
+def make_hub(**options):
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(os.path.join(tempfile.mkdtemp(), "uds_samples"))
+    listener.listen()
+    return SampleHub(listener, scales, **options)
+
+def attach(hub, data):
+    # hands one end of a socket pair to the hub like SampleHub._accept() does with an accepted socket, sends data from the other end
+    process, sock = socket.socketpair()
+    sock.setblocking(False)
+    hub.pending[sock] = (time.monotonic_ns() + int(hub.hello_timeout * 1e9), bytearray())
+    hub.selector.register(sock, selectors.EVENT_READ, None)
+    process.sendall(data)
+    return process
+
+def closed(process):
+    process.setblocking(False)
+    try:
+        while process.recv(65536): pass
+    except BlockingIOError:
+        return False
+    return True
+
+hub = make_hub(hello_timeout=0.1)
+display = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+display.connect(hub.listener.getsockname())
+display.sendall(b"disp" + hello(encoding=COMPACT, sequence=True))
+display.setblocking(False)
+while "disp" not in hub.tags(): hub.poll(0.01)
+processes = {     # connecting while sampling goes on
+    "lst1": attach(hub, b"lst1" + frame(HELLO, b"[1]")),
+    "str1": attach(hub, b"str1" + frame(HELLO, b'"x"')),
+    "nul1": attach(hub, b"nul1" + frame(HELLO, b"null")),
+    "bad1": attach(hub, b"bad1" + frame(HELLO, b'{"encoding": "compact"')),
+    "opt1": attach(hub, b"opt1" + hello(drop_policy=[1], channels="ab", max_rate="5")),
+    "name": attach(hub, b"name"),
+    "subs": attach(hub, b"subs" + hello(encoding=COMPACT) + b"".join(frame(SUBSCRIBE, body) for body in
+                   (b"[1]", b'"x"', b"null", b"{", b'{"max_rate": NaN}', b'{"max_rate": 1e-320}', b'{"max_rate": "5"}', b'{"channels": 5}'))),
+}
+truncated = attach(hub, b"trun" + frame(HELLO, b'{"encoding": "compact"}')[:12])
+
+decoder = SampleDecoder(SequenceTracker())
+received, seq, start = [], 0, time.monotonic()
+while time.monotonic() - start < 1.0:
+    for channel in range(1, 9): hub.add((channel, time.monotonic_ns(), time.time(), seq, seq * scales[channel], seq))
+    seq += 1
+    hub.flush()
+    hub.poll(0.005)
+    try:
+        received += decoder.feed_raw(display.recv(65536))
+    except BlockingIOError:
+        pass
+hub.poll(0.05)
+try:
+    received += decoder.feed_raw(display.recv(1 << 20))
+except BlockingIOError:
+    pass
+
+encodings = {consumer.tag: consumer.encoding for consumer in hub.consumers.values()}
+print(f"connected: {encodings}")
+for tag in ("lst1", "str1", "nul1", "bad1", "opt1", "name"):
+    assert encodings.get(tag) == PLAIN, (tag, encodings.get(tag))
+assert encodings.get("subs") == COMPACT and encodings.get("disp") == COMPACT
+assert "trun" not in encodings and closed(truncated), "the truncated HELLO wasn't given up on"
+assert not any(closed(process) for process in processes.values())
+stats = decoder.tracker.stats()
+assert sorted(stats) == list(range(1, 9)) and all(counts['received'] == seq and counts['gaps'] == 0 for counts in stats.values()), stats
+assert all(scale == scales[channel] for channel, timestamp, raw, scale, s in received), "samples without the scales of the META frame"
+print(f"the display got all {seq} samples of each of the 8 channels in order while the hub handled the bad handshakes and subscriptions")
+
+def fill(policy, reading):
+    # 600 rounds of a sample per channel, 0.25 s apart in sampling time, so there is an ANCHOR frame every 40 rounds (10 s), a flush per round.
+    # The process reads nothing until round 400 (or never) and subscribes again in round 200, when its queue is full. With block the rounds stop at
+    # the first full queue, so the process starts reading 0.2 s after the first round instead, while the hub waits for it. Returns the decoded
+    # samples, the largest queue seen, the counters of the process and whether the hub disconnected it.
+    hub = make_hub(queue_limit=4096, block_timeout=0.5)
+    process = attach(hub, b"test" + hello(encoding=COMPACT, sequence=True, drop_policy=policy))
+    while not hub.consumers: hub.poll(0.01)
+    consumer = next(iter(hub.consumers.values()))
+    consumer.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    process.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    received, start_reading = [], threading.Event()
+
+    def read():
+        start_reading.wait()
+        while True:
+            data = process.recv(4096)
+            if not data: break
+            received.append(data)
+            time.sleep(0.0005)  # slower than the hub fills the queue
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    if reading and policy == BLOCK: threading.Timer(0.2, start_reading.set).start()     # within block_timeout
+    m0, t0, largest = 10**12, 1.7e9, 0
+    for k in range(600):
+        if k == 200:
+            process.sendall(subscribe())
+            hub.poll(0.01)
+        if k == 400 and reading: start_reading.set()
+        for channel in range(1, 9):
+            monotonic_ns = m0 + k * 250 * 10**6
+            hub.add((channel, monotonic_ns, t0 + (monotonic_ns - m0) / 1e9, k - 300, (k - 300) * scales[channel], k))
+        hub.flush()
+        hub.poll(0)
+        if consumer.sock not in hub.consumers: break
+        largest = max(largest, consumer.queued_bytes)
+    disconnected = consumer.sock not in hub.consumers
+    deadline = time.monotonic() + 5
+    while consumer.queue and not disconnected and time.monotonic() < deadline: hub.poll(0.01)
+    hub.close()
+    start_reading.set()
+    reader.join(5)
+    decoder = SampleDecoder(SequenceTracker())
+    samples = decoder.feed_raw(b"".join(received))
+    for channel, timestamp, raw, scale, seq in samples:
+        assert abs(timestamp - (t0 + seq * 0.25)) < 1e-6, (policy, "wrong time, the anchor of the sample got lost", channel, seq, timestamp - t0)
+        assert scale == scales[channel] and raw == seq - 300, (policy, "wrong volts, the scales got lost", channel, seq, scale)
+    return samples, largest, consumer, disconnected
+
+for policy, reading in ((DROP_OLDEST, True), (DROP_NEWEST, True), (BLOCK, True), (BLOCK, False)):
+    samples, largest, consumer, disconnected = fill(policy, reading)
+    rounds = sorted(set(seq for channel, timestamp, raw, scale, seq in samples))
+    # an entry is a round of 8 samples (141 bytes) and maybe an ANCHOR frame (21 bytes), the entry being sent may have the anchor and the scales
+    # (77 bytes) in front and stay in the queue beyond the limit
+    assert largest <= 4096 + 141 + 21 + 21 + 77, (policy, largest)
+    if policy == DROP_OLDEST:
+        # the reader is slower than the hub, so it drops until the end, the queue at the end is about 28 rounds
+        assert consumer.frames_dropped > 0 and len(rounds) < 600 and rounds[-25:] == list(range(575, 600)), (policy, rounds[-5:])
+    elif policy == DROP_NEWEST:
+        # the first rounds fill the socket buffers and the queue and are all there, later ones only when the reader made room
+        assert consumer.frames_dropped > 0 and len(rounds) < 600 and rounds[:30] == list(range(30)), (policy, rounds[:3], rounds[-3:])
+    elif reading:
+        assert consumer.frames_dropped == 0 and not disconnected and rounds == list(range(600)) and len(samples) == 600 * 8, (policy, len(samples))
+    else:
+        assert consumer.frames_dropped == 0 and disconnected and rounds == list(range(len(rounds))), (policy, rounds[-3:])
+    print(f"{policy:11} {'reading later' if reading else 'never reading'}: {len(samples)} samples arrived with the right times and volts, "
+          f"{consumer.frames_dropped} frames dropped, queue at most {largest} bytes{', disconnected' if disconnected else ''}")
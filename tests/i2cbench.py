@@ -0,0 +1,28 @@
+# i2cbench.py - counts i2c syscalls per sample with and without combined I2C_RDWR transactions on a simulated bus, run it from within the tests directory
+import sys, time
+sys.path.append("../")
+from modules.thirdparty.abelectronics.ADCPi import ADCPi
+from fakesmbus import FakeSMBus
+
+channels = [1, 2, 3, 4, 5, 6, 7, 8]
+resolution = int(sys.argv[1]) if len(sys.argv) > 1 else 12
+clock_hz = int(sys.argv[2]) if len(sys.argv) > 2 else 100000   # the default i2c clock of the raspberry pi
+seconds = 3
+
+bus = FakeSMBus(clock_hz=clock_hz)
+adc = ADCPi(0x68, 0x6d, resolution, bus=bus)
+adc.set_conversion_mode(0)
+
+for rdwr in (False, True):
+    adc.set_i2c_rdwr(rdwr)
+    bus.reset_counters()
+    adc.reset_i2c_counters()
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        for row in adc.iter_sweep(channels):
+            count += 1
+    elapsed = time.perf_counter() - start
+    counters = adc.get_i2c_counters()
+    print(f"{'i2c_rdwr' if rdwr else 'write_byte/read_i2c_block_data':32}{count/elapsed:8.1f} sps, {bus.ioctls/count:.2f} syscalls per sample, "
+          f"{counters['combined']/count:.2f} combined, {counters['combined_misses']} misses")
@@ -0,0 +1,129 @@
+# mqttstandin.py - a minimal MQTT 3.1.1 broker that can be stopped and started, for trying out the publisher without a real broker
+# Copyright (C) 2023  Iman Ayatollahi, Talwiese IoT Solutions e.U.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Accepts any client without TLS, acknowledges CONNECT, PUBLISH (qos 0 to 2), SUBSCRIBE and PINGREQ and keeps every published message in received,
+# nothing is forwarded to subscribers. stop() closes all connections as a broker going down would, start() listens again on the same port.
+# python3 mqttstandin.py [port] prints the topic and length of every message until ctrl-c.
+
+import socket, struct, threading, sys, time
+
+class MQTTStandIn:
+    def __init__(self, port=1883, host="127.0.0.1"):
+        self.address = (host, port)
+        self.received = []      # (topic, payload, qos, retain) in the order of arrival
+        self.arrivals = []      # time.time() of the arrival of each message in received
+        self.lock = threading.Lock()
+        self.listener = None
+        self.connections = []
+
+    def start(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(self.address)
+        self.listener.listen()
+        threading.Thread(target=self._accept, args=(self.listener,), daemon=True).start()
+
+    def stop(self):
+        # shutdown wakes up the thread waiting in accept(), close alone doesn't
+        try:
+            self.listener.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.listener.close()
+        for conn in self.connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            conn.close()
+        self.connections = []
+
+    def messages(self):
+        with self.lock:
+            return list(self.received)
+
+    def _accept(self, listener):
+        while True:
+            try:
+                conn, addr = listener.accept()
+            except OSError:
+                return  # stopped
+            self.connections.append(conn)
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _read(self, conn, n):
+        data = b""
+        while len(data) < n:
+            chunk = conn.recv(n - len(data))
+            if not chunk: raise ConnectionError("client closed the connection")
+            data += chunk
+        return data
+
+    def _packet(self, conn):
+        first = self._read(conn, 1)[0]
+        length, shift = 0, 0
+        while True:
+            byte = self._read(conn, 1)[0]
+            length |= (byte & 0x7F) << shift
+            if byte < 0x80: break
+            shift += 7
+        return first >> 4, first & 0x0F, self._read(conn, length)
+
+    def _serve(self, conn):
+        try:
+            while True:
+                kind, flags, body = self._packet(conn)
+                if kind == 1:       # CONNECT
+                    conn.sendall(bytes((0x20, 2, 0, 0)))
+                elif kind == 3:     # PUBLISH
+                    qos, retain = (flags >> 1) & 3, bool(flags & 1)
+                    topic_length = struct.unpack_from('!H', body)[0]
+                    topic = body[2:2 + topic_length].decode()
+                    pos = 2 + topic_length
+                    if qos: packet_id, pos = body[pos:pos + 2], pos + 2
+                    with self.lock:
+                        self.received.append((topic, body[pos:], qos, retain))
+                        self.arrivals.append(time.time())
+                    if qos == 1: conn.sendall(bytes((0x40, 2)) + packet_id)
+                    elif qos == 2: conn.sendall(bytes((0x50, 2)) + packet_id)
+                elif kind == 6:     # PUBREL
+                    conn.sendall(bytes((0x70, 2)) + body[:2])
+                elif kind == 8:     # SUBSCRIBE, every topic filter is granted qos 0
+                    filters, pos = 0, 2
+                    while pos < len(body):
+                        pos += 2 + struct.unpack_from('!H', body, pos)[0] + 1
+                        filters += 1
+                    conn.sendall(bytes((0x90, 2 + filters)) + body[:2] + bytes(filters))
+                elif kind == 12:    # PINGREQ
+                    conn.sendall(bytes((0xD0, 0)))
+                elif kind == 14:    # DISCONNECT
+                    break
+        except (ConnectionError, OSError):
+            pass
+        conn.close()
+
+if __name__ == "__main__":
+    broker = MQTTStandIn(int(sys.argv[1]) if len(sys.argv) > 1 else 1883)
+    broker.start()
+    shown = 0
+    try:
+        while True:
+            time.sleep(0.5)
+            for topic, payload, qos, retain in broker.messages()[shown:]:
+                print(f"{topic} qos {qos}{' retained' if retain else ''}: {len(payload)} bytes")
+                shown += 1
+    except KeyboardInterrupt:
+        broker.stop()
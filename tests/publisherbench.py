@@ -0,0 +1,54 @@
+# publisherbench.py - measures latency and throughput of publisher.py against the MQTT stand-in, run it from within the tests directory
+# python3 publisherbench.py [samples per second, 0 for as fast as possible] [number of samples]
+# publisher.py runs in a copy of the application in a temporary directory, without TLS, fed by a fake sampler with samples of 8 channels.
+# Latency is the time from the timestamp of a sample to its arrival at the stand-in. Shutdown is the time from SIGTERM until the process is gone.
+import sys, os, time, socket, shutil, subprocess, struct, signal, tempfile, yaml
+sys.path.append("../")
+from modules.inhouse.mhiaframing import SampleFramer, PLAIN
+from mqttstandin import MQTTStandIn
+
+rate = float(sys.argv[1]) if len(sys.argv) > 1 else 240
+count = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+port = 18840
+
+directory = os.path.join(tempfile.mkdtemp(), "mhia")
+shutil.copytree("../", directory, ignore=shutil.ignore_patterns(".git", "log", "spool", "config.yaml", "uds_samples"))
+os.makedirs(os.path.join(directory, "log"), exist_ok=True)
+config = yaml.safe_load(open(os.path.join(directory, "config_default.yaml")))
+config['active_channels'] = list(range(1, 9))
+config['publisher'].update(broker_host="127.0.0.1", broker_port=port, sequence_in_payload=True, stats_interval=1000)
+yaml.safe_dump(config, open(os.path.join(directory, "config.yaml"), "w"))
+
+broker = MQTTStandIn(port)
+broker.start()
+sampler = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+sampler.bind(os.path.join(directory, "uds_samples"))
+sampler.listen()
+without_tls = "import runpy, paho.mqtt.client as mqtt; mqtt.Client.tls_set = lambda *args, **kwargs: None; runpy.run_path('publisher.py', run_name='__main__')"
+publisher = subprocess.Popen([sys.executable, "-c", without_tls], cwd=directory)
+conn, addr = sampler.accept()
+conn.recv(4)
+time.sleep(0.5)     # HELLO and connecting to the broker
+
+framer = SampleFramer(PLAIN, sequence=True)
+start = time.monotonic()
+for i in range(0, count, 8):
+    now = time.time()
+    for channel in range(1, 9): framer.add(channel, 0, now, 0, 1.0, i // 8)
+    conn.sendall(framer.take())
+    if rate:
+        wait = start + (i + 8) / rate - time.monotonic()
+        if wait > 0: time.sleep(wait)
+deadline = time.time() + 30
+while len(broker.messages()) < count and time.time() < deadline: time.sleep(0.05)
+
+arrived = [(arrival, payload) for (topic, payload, qos, retain), arrival in zip(broker.messages(), broker.arrivals) if "/live/" in topic]
+latency = sorted((arrival - struct.unpack('!iddI', payload)[1]) * 1000 for arrival, payload in arrived)
+print(f"received {len(arrived)} of {count}, {len(arrived) / (arrived[-1][0] - arrived[0][0]):.0f} messages per second, "
+      f"latency in ms median {latency[len(latency) // 2]:.2f}, 99% {latency[int(len(latency) * 0.99)]:.2f}, max {latency[-1]:.2f}")
+start = time.monotonic()
+publisher.send_signal(signal.SIGTERM)
+publisher.wait(10)
+print(f"shutdown {(time.monotonic() - start) * 1000:.0f} ms, exit code {publisher.returncode}")
+broker.stop()
+shutil.rmtree(os.path.dirname(directory))
@@ -0,0 +1,133 @@
+# ringtest.py - runs the ring of samples in shared memory (mhiashm.py) across processes, run it from within the tests directory
+# python3 ringtest.py [seconds]
+# This process writes batches of random size into a small ring, many times around it, some batches larger than the ring.
+# Two reader processes attach to it: one keeps up (it loses records only to the batches larger than the ring), the other sleeps between reads so
+# the writer laps it. Every record carries values derived from
+# its seq, so a record torn by the writer would show. Each reader checks that its records are intact and in order and that the records it got plus
+# the ones counted as lost are exactly the ones written since it attached. The lapped reader has to have lost some.
+# Then the table of latest values: a thread of this process writes the channels over and over while a reader process reads them, every value
+# derived from a counter too, so a read mixing two writes would show, and no channel may go back. At the end the writer stops in the middle of a
+# slot, the reader has to give up on that channel after its timeout and still read the others.
+import sys, json, time, random, subprocess, threading
+import numpy as np
+sys.path.append("../")
+from modules.inhouse.mhiashm import SampleRing, SampleRingReader, LatestValues, LatestValuesReader, LATEST_HEADER, LATEST_SLOT, LATEST_COUNTER
+
+NAME = "mhia_ringtest"
+CAPACITY = 1024
+STUCK = 2    # the channel of the table of latest values the writer stops in the middle of
+
+def sample(seq):
+    # channel, monotonic_ns, timestamp, raw, value, channel_seq
+    return (seq % 8 + 1, seq * 1000, seq / 10, seq % 1000000 - 500000, seq * 0.5, seq % 2**32)
+
+def read(pause):
+    ring = SampleRingReader(name=NAME)
+    start = ring.cursor
+    print("attached", flush=True)
+    got, gaps, reads, last = 0, 0, 0, start - 1
+    while True:
+        batch = ring.read()
+        reads += 1
+        if len(batch):
+            seq = batch['seq'].astype(np.int64)
+            assert (np.diff(seq) == 1).all(), "records of a batch not consecutive"
+            assert seq[0] > last, "records read twice or out of order"
+            gaps += int(seq[0]) - last - 1
+            last = int(seq[-1])
+            got += len(batch)
+            assert (batch['channel'] == seq % 8 + 1).all() and (batch['monotonic_ns'] == seq * 1000).all(), "torn record"
+            assert (batch['timestamp'] == seq / 10).all() and (batch['raw'] == seq % 1000000 - 500000).all(), "torn record"
+            assert (batch['value'] == seq * 0.5).all() and (batch['channel_seq'] == seq % 2**32).all(), "torn record"
+        elif ring.cursor == int(ring.header['committed'][0]) and int(ring.header['magic'][0]) == 0:
+            break   # the writer cleared the magic after its last batch and everything is read
+        if pause: time.sleep(pause)
+    assert gaps == ring.lost, f"{gaps} records missing, but {ring.lost} counted as lost"
+    print(json.dumps({'start': start, 'end': ring.cursor, 'got': got, 'lost': ring.lost, 'reads': reads}), flush=True)
+    ring.close()
+
+def latest(k):
+    # monotonic_ns, timestamp, raw, value, channel_seq of the k-th write of the table of latest values
+    return k * 1000, k / 10, k % 1000000 - 500000, k * 0.5, k % 2**32
+
+def read_latest():
+    table = LatestValuesReader(name=NAME + "_latest")
+    print("attached", flush=True)
+    reads, newer, last = 0, 0, {}
+    while True:
+        channel = random.randrange(1, 5)
+        try:
+            sample = table.read(channel, timeout=0.5)
+        except TimeoutError:
+            assert channel == STUCK, f"channel {channel} timed out"
+            break   # the writer stopped in the middle of it, which ends the test
+        reads += 1
+        if sample is None: continue
+        seq, monotonic_ns, timestamp, raw, value = sample
+        k = monotonic_ns // 1000
+        assert k % 4 + 1 == channel and (monotonic_ns, timestamp, raw, value, seq) == latest(k), f"torn latest value of channel {channel}: {sample}"
+        assert k >= last.get(channel, 0), f"latest value of channel {channel} going back"
+        newer += k > last.get(channel, 0)
+        last[channel] = k
+    assert all(table.read(channel) is not None for channel in range(1, 5) if channel != STUCK), "the other channels don't read any more"
+    print(json.dumps({'reads': reads, 'newer': newer}), flush=True)
+    table.close()
+
+if __name__ == "__main__" and len(sys.argv) > 2 and sys.argv[1] == "reader":
+    read(float(sys.argv[2]))
+    sys.exit()
+if __name__ == "__main__" and len(sys.argv) > 1 and sys.argv[1] == "latest":
+    read_latest()
+    sys.exit()
+
+seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 3
+ring = SampleRing(CAPACITY, name=NAME)
+readers = {name: subprocess.Popen([sys.executable, __file__, "reader", str(pause)], stdout=subprocess.PIPE, text=True)
+           for name, pause in (("keeping up", 0), ("lapped", 0.05))}
+for process in readers.values(): assert process.stdout.readline().strip() == "attached"
+
+written, batches, start = 0, 0, time.monotonic()
+while time.monotonic() - start < seconds:
+    size = CAPACITY + random.randrange(1, 600) if random.random() < 0.01 else random.randrange(1, 300)
+    ring.write([sample(seq) for seq in range(written, written + size)])
+    written += size
+    batches += 1
+    time.sleep(0.0005)  # still far faster than sampling, but a reader that doesn't sleep can keep up
+ring.header['magic'] = 0    # tells the readers the writing is done
+print(f"wrote {written} records in {batches} batches, {written // CAPACITY} times around a ring of {CAPACITY}")
+
+results = {}
+for name, process in readers.items():
+    output, _ = process.communicate(timeout=30)
+    assert process.returncode == 0, f"reader {name} failed"
+    result = results[name] = json.loads(output.splitlines()[-1])
+    assert result['end'] == written and result['got'] + result['lost'] == written - result['start'], result
+    print(f"reader {name}: attached at {result['start']}, got {result['got']} records intact and in order in {result['reads']} reads, lost {result['lost']}")
+assert results['lapped']['lost'] > 0, "the lapped reader wasn't lapped"
+ring.close()
+
+table = LatestValues(4, name=NAME + "_latest")
+reader = subprocess.Popen([sys.executable, __file__, "latest"], stdout=subprocess.PIPE, text=True)
+assert reader.stdout.readline().strip() == "attached"
+done = threading.Event()
+
+def write():
+    k = 0
+    while not done.is_set():
+        k += 1
+        monotonic_ns, timestamp, raw, value, seq = latest(k)
+        table.write(k % 4 + 1, monotonic_ns, timestamp, raw, value, seq)
+
+writer = threading.Thread(target=write)
+writer.start()
+time.sleep(min(seconds, 2))
+done.set()
+writer.join()
+offset = LATEST_HEADER.size + STUCK * LATEST_SLOT.size
+LATEST_COUNTER.pack_into(table.buf, offset, table.counters[STUCK] + 1)    # odd as if the writer died right there
+output, _ = reader.communicate(timeout=30)
+assert reader.returncode == 0, "reader of the latest values failed"
+result = json.loads(output.splitlines()[-1])
+assert result['newer'] > 100, f"the reader hardly saw the writer write: {result}"
+print(f"latest values: {result['reads']} reads while a thread wrote, {result['newer']} of them a newer value, none torn, the slot left in the middle of a write timed out")
+table.close()
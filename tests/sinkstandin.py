@@ -0,0 +1,77 @@
+# sinkstandin.py - a minimal HTTP server taking POSTed batches, standing in for InfluxDB and an http collector when trying out the sinks of the publisher
+# Copyright (C) 2023  Iman Ayatollahi, Talwiese IoT Solutions e.U.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Keeps the body of every POST in received as (path, body), on any path, and answers 204 like the write endpoint of InfluxDB does.
+# delay makes every answer that many seconds late (a slow endpoint), fail answers the next fail requests with 500 (an endpoint with hiccups).
+# python3 sinkstandin.py [port] prints the path and the number of lines of every POST until ctrl-c.
+
+import http.server, threading, sys, time
+
+class SinkStandIn:
+    def __init__(self, port=8086, host="127.0.0.1", delay=0.0, fail=0):
+        self.received = []      # (path, body) in the order of arrival
+        self.requests = 0       # all POSTs, the failed ones too
+        self.delay = delay
+        self.fail = fail
+        self.lock = threading.Lock()
+        standin = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"   # keeps the connection open like the sinks expect
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                time.sleep(standin.delay)
+                with standin.lock:
+                    standin.requests += 1
+                    failing = standin.fail > 0
+                    if failing: standin.fail -= 1
+                    else: standin.received.append((self.path, body))
+                self.send_response(500 if failing else 204)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def lines(self):
+        with self.lock:
+            return [line for path, body in self.received for line in body.decode().splitlines()]
+
+if __name__ == "__main__":
+    standin = SinkStandIn(int(sys.argv[1]) if len(sys.argv) > 1 else 8086)
+    standin.start()
+    shown = 0
+    try:
+        while True:
+            time.sleep(0.5)
+            with standin.lock:
+                new = standin.received[shown:]
+            for path, body in new:
+                print(f"{path}: {len(body.splitlines())} lines")
+                shown += 1
+    except KeyboardInterrupt:
+        standin.stop()
@@ -0,0 +1,52 @@
+# sinktest.py - feeds the sinks of the publisher at sampling rate: an InfluxDB stand-in with hiccups, a slow http collector and a csv file, run it from within the tests directory
+# python3 sinktest.py [seconds]
+# Shows that the sinks don't hold each other up nor the event loop: the samples are offered on time (the lag of the feeding loop stays small) although
+# the collector takes 2 s per batch, and every sample arrives at each sink once, in order, the failed batches of the InfluxDB stand-in included.
+import sys, os, asyncio, time, tempfile, json
+sys.path.append("../")
+from modules.inhouse.mhiasinks import make_sink
+from sinkstandin import SinkStandIn
+
+seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+rate = 240      # samples per second, 30 sps on 8 channels
+directory = tempfile.mkdtemp()
+
+influx = SinkStandIn(18086, fail=3)
+collector = SinkStandIn(18080, delay=2.0)
+influx.start()
+collector.start()
+
+async def main():
+    sinks = [make_sink({'type': 'influx', 'url': "http://127.0.0.1:18086/api/v2/write?org=mhia&bucket=mhia&precision=ns", 'token': "secret",
+                        'tags': {'site': "test"}, 'batch_size': 100, 'retry_delay': 0.2}),
+             make_sink({'type': 'http', 'name': "collector", 'url': "http://127.0.0.1:18080/samples", 'batch_size': 200, 'timeout': 5}),
+             make_sink({'type': 'file', 'path': os.path.join(directory, "samples.csv"), 'format': "csv", 'batch_window': 0.5})]
+    tasks = [asyncio.create_task(sink.run()) for sink in sinks]
+    sent, lag = 0, 0.0
+    start = time.monotonic()
+    while time.monotonic() - start < seconds:
+        due = start + sent / rate
+        lag = max(lag, time.monotonic() - due)
+        for sink in sinks: sink.offer([(sent % 8 + 1, time.time(), sent, 0.001, sent // 8)])    # channel, timestamp, raw, scale, seq
+        sent += 1
+        await asyncio.sleep(max(0, start + sent / rate - time.monotonic()))
+    print(f"offered {sent} samples in {seconds:g} s, the feeding loop lagged at most {lag * 1000:.1f} ms")
+    for sink in sinks: print(sink.name, json.dumps(sink.stats()))
+    for task in tasks: task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    flushed = time.monotonic()
+    await asyncio.gather(*(sink.flush() for sink in sinks))
+    print(f"flushed in {time.monotonic() - flushed:.1f} s")
+    for sink in sinks: await sink.close()
+    return sent
+
+sent = asyncio.run(main())
+seqs = [int(line.split(",seq=")[1].split("i")[0]) * 8 + int(line.split(",channel=")[1].split(" ")[0]) - 1 for line in influx.lines()]
+print(f"influx: {influx.requests} requests, {len(seqs)} points, all in order: {seqs == list(range(sent))}")
+seqs = [json.loads(line)['seq'] * 8 + json.loads(line)['channel'] - 1 for line in collector.lines()]
+print(f"collector: {collector.requests} requests, {len(seqs)} samples, all in order: {seqs == list(range(sent))}")
+rows = open(os.path.join(directory, "samples.csv")).read().splitlines()
+seqs = [int(row.split(",")[3]) * 8 + int(row.split(",")[0]) - 1 for row in rows[1:]]
+print(f"csv: header {rows[0]}, {len(seqs)} rows, all in order: {seqs == list(range(sent))}")
+influx.stop()
+collector.stop()
@@ -0,0 +1,60 @@
+# spooltest.py - publishes through the spool of the publisher while the broker stand-in goes down and comes back, run it from within the tests directory
+import sys, time, shutil, tempfile, struct
+sys.path.append("../")
+import paho.mqtt.client as mqtt
+from modules.inhouse.mhiaspool import Spool, StoreAndForward
+from mqttstandin import MQTTStandIn
+
+port = int(sys.argv[1]) if len(sys.argv) > 1 else 18830
+rate = 240          # messages per second, 30 sps on 8 channels
+replay_rate = 400   # messages per second, catching up takes about as long as the broker was down then
+directory = tempfile.mkdtemp()
+
+broker = MQTTStandIn(port)
+broker.start()
+client = mqtt.Client()
+client.reconnect_delay_set(min_delay=1, max_delay=1)
+forward = StoreAndForward(client, Spool(directory, segment_bytes=16 * 1024), replay_rate)
+client.on_connect = lambda client, userdata, flags, rc: forward.connected.set()
+client.on_disconnect = lambda client, userdata, rc: forward.disconnected()
+client.on_publish = lambda client, userdata, mid: forward.published(mid)
+client.connect("127.0.0.1", port)
+client.loop_start()
+
+spooled = []    # numbers of the messages that went to the spool
+
+def run(seconds, sent):
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        written = forward.spool.written
+        forward.publish(f"live/ch_{sent % 8 + 1}", struct.pack('!I', sent))
+        if forward.spool.written > written: spooled.append(sent)
+        sent += 1
+        forward.replay()
+        time.sleep(1 / rate)
+    return sent
+
+sent = run(1, 0)
+broker.stop()
+print(f"broker stopped after {sent} messages")
+sent = run(3, sent)
+print(f"{len(spooled)} messages spooled while the broker was down, restarting it")
+broker.start()
+start = time.monotonic()
+sent = run(3, sent)
+while not forward.spool.empty() and time.monotonic() - start < 20:
+    forward.replay()
+    time.sleep(0.01)
+print(f"caught up {time.monotonic() - start:.1f} s after the broker came back")
+time.sleep(0.5)
+client.loop_stop()
+forward.spool.close()
+shutil.rmtree(directory)
+
+numbers = [struct.unpack('!I', payload)[0] for topic, payload, qos, retain in broker.messages()]
+missing = sorted(set(range(sent)) - set(numbers))
+# with qos 0 the messages paho sent just before it noticed the broker was gone are lost, a few right after sent
+print(f"sent {sent}, received {len(numbers)}, {len(set(numbers))} distinct, missing {len(missing)}: {missing[:20]}")
+spooled = set(spooled)
+replayed = [n for n in numbers if n in spooled]
+print(f"{len(spooled)} spooled, {len(replayed)} of them received, in order: {replayed == sorted(replayed)}")